@@ -0,0 +1,306 @@
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+import PIL
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+import font_cache
+import weather_icons
+from image_metadata import read_metadata
+from image_modification import ImageModification
+from subject_detection import find_subject
+from perceptual_hash import dhash
+from process_stats import current_rss, peak_rss, reset_peak_rss
+import globals
+
+parser = ArgumentParser(
+    description="Time (and measure the memory of) every stage of showing a "
+                "slide on generated test images."
+)
+parser.add_argument(
+    "--megapixels",
+    type=float,
+    nargs="+",
+    help="sizes of the generated test images",
+    default=[2, 12, 24]
+)
+parser.add_argument(
+    "--width",
+    type=int,
+    default=globals.RENDER_SCREEN_SIZE[0]
+)
+parser.add_argument(
+    "--height",
+    type=int,
+    default=globals.RENDER_SCREEN_SIZE[1]
+)
+parser.add_argument(
+    "--iterations",
+    type=int,
+    default=5
+)
+parser.add_argument(
+    "--cold_caches",
+    action="store_true",
+    help="clear the font and icon caches before every iteration"
+)
+parser.add_argument(
+    "--text_style",
+    choices=["stroke", "adaptive"],
+    help="how the text is drawn, see TEXT_STYLE",
+    default=globals.TEXT_STYLE
+)
+parser.add_argument(
+    "--fixture_dir",
+    type=str,
+    help="where the test images are generated (reused between runs)",
+    default=os.path.join(tempfile.gettempdir(), "photo_frame_fixtures")
+)
+parser.add_argument(
+    "--output",
+    type=str,
+    help="json file for the results",
+    default=os.path.join(globals.PROJECT_DIR, "temp",
+                         f"benchmark_{time.strftime('%Y-%m-%d_%H%M')}.json")
+)
+
+FIXTURE_TITLE = "Benchmark fixture"
+FIXTURE_CREATION_TIME = "2019:05:04 10:30:00"
+# width:height of a typical camera
+FIXTURE_ASPECT = (4, 3)
+
+
+def get_fixture_size(megapixels):
+    aspect_width, aspect_height = FIXTURE_ASPECT
+    unit = (megapixels * 1000000 / (aspect_width * aspect_height)) ** 0.5
+    return int(unit * aspect_width), int(unit * aspect_height)
+
+
+def create_fixture(path, size, with_exif):
+    # noise so the test images compress like photos, not flat colours
+    bands = [Image.effect_noise(size, 64) for _ in range(3)]
+    img = Image.merge("RGB", bands)
+    gradient = Image.linear_gradient("L").resize(size).convert("RGB")
+    img = Image.blend(img, gradient, 0.5)
+
+    save_kwargs = {}
+    if with_exif:
+        if path.endswith(".png"):
+            png_info = PngInfo()
+            png_info.add_text("Creation Time",
+                              "Sat 04 May 2019 10:30:00 +1000")
+            save_kwargs["pnginfo"] = png_info
+        else:
+            exif = img.getexif()
+            exif[270] = FIXTURE_TITLE
+            exif[36867] = FIXTURE_CREATION_TIME
+            save_kwargs["exif"] = exif.tobytes()
+    img.save(path, **save_kwargs)
+
+
+def get_fixtures(fixture_dir, megapixels_list):
+    """
+    JPEG and PNG test images of every size, with and without metadata.
+    They are kept in "fixture_dir" as they take a while to generate.
+    """
+    if not os.path.exists(fixture_dir):
+        os.makedirs(fixture_dir)
+
+    fixtures = []
+    for megapixels in megapixels_list:
+        size = get_fixture_size(megapixels)
+        for extension in ("jpg", "png"):
+            for with_exif in (True, False):
+                exif_name = "exif" if with_exif else "no_exif"
+                name = f"{megapixels:g}mp_{exif_name}.{extension}"
+                # the location is taken from the directory name
+                path = os.path.join(fixture_dir, "2019_Benchmark_Trip", name)
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    print(f"Generating {path} {size}")
+                    create_fixture(path, size, with_exif)
+                fixtures.append((name, path))
+    return fixtures
+
+
+class StageTimer:
+    """
+    Collects the duration and the memory used by every run of a stage.
+    The memory is how far the RSS peaked above where it started.
+    """
+
+    def __init__(self):
+        self.seconds = OrderedDict()
+        self.peak_memory = OrderedDict()
+
+    def run(self, stage, function, *args, **kwargs):
+        reset_peak_rss()
+        rss_before = current_rss()
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        peak = peak_rss()
+
+        self.seconds.setdefault(stage, []).append(seconds)
+        if rss_before is not None and peak is not None:
+            self.peak_memory.setdefault(stage, []).append(
+                max(0, peak - rss_before))
+        return result
+
+    def summary(self):
+        stages = OrderedDict()
+        for stage, seconds in self.seconds.items():
+            stages[stage] = {
+                "runs": len(seconds),
+                "mean_ms": round(sum(seconds) / len(seconds) * 1000, 3),
+                "p50_ms": round(percentile(seconds, 50) * 1000, 3),
+                "p90_ms": round(percentile(seconds, 90) * 1000, 3),
+                "p99_ms": round(percentile(seconds, 99) * 1000, 3),
+                "max_ms": round(max(seconds) * 1000, 3),
+                "peak_memory": max(self.peak_memory.get(stage, [0])),
+            }
+        return stages
+
+
+def percentile(values, percent):
+    # nearest rank
+    ordered = sorted(values)
+    rank = max(1, int(round(percent / 100 * len(ordered))))
+    return ordered[rank - 1]
+
+
+def load_image(path):
+    img = Image.open(path)
+    img.load()
+    return img
+
+
+def load_draft_image(path, size):
+    img = Image.open(path)
+    img.draft("RGB", size)
+    img.load()
+    return img
+
+
+def get_photo_image_converter():
+    """
+    ImageTk.PhotoImage needs a Tk root (and so a display), returns None
+    when there is none.
+    """
+    try:
+        import tkinter as tk
+        from PIL import ImageTk
+        root = tk.Tk()
+        root.withdraw()
+    except Exception as e:
+        print(f"Skipping the PhotoImage stage: {e!r}")
+        return None
+    return ImageTk.PhotoImage
+
+
+def clear_caches():
+    font_cache.get_font.cache_clear()
+    font_cache._get_text_size.cache_clear()
+    font_cache.get_base_font_size.cache_clear()
+    with weather_icons._icons_lock:
+        weather_icons._icons.clear()
+
+
+def benchmark_fixture(path, screen_size, iterations, cold_caches,
+                      photo_image):
+    timer = StageTimer()
+    for _ in range(iterations):
+        if cold_caches:
+            clear_caches()
+
+        original = timer.run("open", load_image, path)
+        timer.run("open_draft", load_draft_image, path, screen_size)
+        metadata = timer.run("read_metadata", read_metadata, path)
+        # background indexing pass, for the "fill" fit mode
+        timer.run("find_subject", find_subject, path)
+        timer.run("dhash", dhash, path)
+        resized = timer.run("resize", original.resize, screen_size,
+                            Image.ANTIALIAS)
+        original.close()
+
+        modified_img = timer.run(
+            "ImageModification.__init__", ImageModification,
+            resized, path, "01d", "21\N{DEGREE SIGN}", metadata=metadata)
+        timer.run("add_img_title", modified_img.add_img_title)
+        timer.run("add_img_creation_date",
+                  modified_img.add_img_creation_date)
+        timer.run("add_img_location", modified_img.add_img_location)
+        current_date_x = timer.run("add_current_date",
+                                   modified_img.add_current_date)
+        timer.run("add_current_time", modified_img.add_current_time)
+        weather_x = timer.run("add_weather", modified_img.add_weather,
+                              current_date_x)
+        timer.run("add_temperature", modified_img.add_temperature,
+                  weather_x)
+        timer.run("render_dynamic_layer", modified_img.render_dynamic_layer)
+
+        # the whole static layer, as the slideshow draws it
+        static_img = ImageModification(
+            resized.copy(), path, None, None, metadata=metadata)
+        timer.run("add_static_info", static_img.add_static_info)
+        static_img.img.close()
+
+        if photo_image is not None:
+            timer.run("PhotoImage", photo_image, resized)
+
+    return timer.summary()
+
+
+def print_results(results):
+    for fixture, stages in results["fixtures"].items():
+        print(f"\n{fixture}")
+        for stage, stats in stages.items():
+            print(f"  {stage:28} p50 {stats['p50_ms']:9.2f}ms  "
+                  f"p90 {stats['p90_ms']:9.2f}ms  "
+                  f"p99 {stats['p99_ms']:9.2f}ms  "
+                  f"peak {stats['peak_memory'] / (1024 * 1024):7.1f}MB")
+
+
+def main(args):
+    globals.TEXT_STYLE = args.text_style
+    screen_size = (args.width, args.height)
+    fixtures = get_fixtures(args.fixture_dir, args.megapixels)
+    photo_image = get_photo_image_converter()
+
+    results = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": sys.version.split()[0],
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "screen_size": screen_size,
+        "iterations": args.iterations,
+        "cold_caches": args.cold_caches,
+        "text_style": args.text_style,
+        "fixtures": OrderedDict(),
+    }
+    for name, path in fixtures:
+        print(f"Benchmarking {name}")
+        results["fixtures"][name] = benchmark_fixture(
+            path, screen_size, args.iterations, args.cold_caches,
+            photo_image)
+
+    print_results(results)
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"\nResults: {args.output}")
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
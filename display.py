@@ -0,0 +1,321 @@
+import os
+import mmap
+import logging
+from collections import OrderedDict
+
+import tkinter as tk
+from PIL import ImageTk
+
+from instrumentation import stats
+import globals
+from globals import (
+    DISPLAY_OUTPUT_PATH,
+    DISPLAY_OUTPUT_QUALITY,
+    FRAMEBUFFER_DEVICE,
+)
+
+logger = logging.getLogger(__name__)
+
+# framebuffer bits per pixel -> PIL raw mode of its pixels
+FRAMEBUFFER_RAW_MODES = {
+    32: "BGRX",
+    24: "BGR",
+}
+
+
+class TkDisplay:
+    """
+    Shows the frames on a full screen Tk canvas, with the clock / weather
+    overlay as a separate canvas item on top of the photo.
+
+    Converting a 4K frame to a PhotoImage copies all of its pixels through
+    Tcl, so prepare() does that for the upcoming frames while the current
+    one is on screen, into a ring of "ring_size" PhotoImages that are
+    reused for every slide (by default one on screen plus one for each of
+    the PREFETCH_DEPTH upcoming slides).  Showing a prepared frame only
+    has to point the canvas at its PhotoImage.
+
+    The window is blank when the slideshow starts, show_file() can show
+    the last frame of the previous run until the first slide is ready.
+    """
+
+    separate_overlay = True
+    transitions = True
+    startup_frame = True
+
+    def __init__(self, root, ring_size=None):
+        self.size = (root.winfo_screenwidth(), root.winfo_screenheight())
+        root.overrideredirect(True)
+        root.geometry(f"{self.size[0]}x{self.size[1]}+0+0")
+
+        self.canvas = tk.Canvas(
+            root, bg="black", highlightthickness=0, borderwidth=0)
+        self.canvas.pack(expand=True, fill="both")
+        self.photo_item = self.canvas.create_image(0, 0, anchor="nw")
+        self.overlay_item = self.canvas.create_image(0, 0, anchor="nw")
+        self.photo = None
+        self.overlay = None
+        # the downscaled transition frame and the full size one it is
+        # zoomed into
+        self._transition_small = None
+        self._transition = None
+
+        # worked out here rather than at import time, so --PREFETCH_DEPTH
+        # counts
+        if ring_size is None:
+            ring_size = globals.PREFETCH_DEPTH + 1
+        self.ring_size = ring_size
+        self._ring = []
+        self._shown = None
+        # image path -> index in the ring, oldest first
+        self._prepared = OrderedDict()
+
+    def _free_slot(self):
+        if len(self._ring) < self.ring_size:
+            self._ring.append(ImageTk.PhotoImage("RGB", self.size))
+            return len(self._ring) - 1
+
+        in_use = set(self._prepared.values())
+        in_use.add(self._shown)
+        for slot in range(len(self._ring)):
+            if slot not in in_use:
+                return slot
+        # the oldest prepared frame is probably no longer upcoming
+        _, slot = self._prepared.popitem(last=False)
+        return slot
+
+    def _convert(self, image):
+        if image.size != self.size:
+            logger.debug(f"Frame size {image.size} does not match the "
+                         f"screen size {self.size}")
+            return None
+        slot = self._free_slot()
+        with stats.timer("PhotoImage"):
+            self._ring[slot].paste(image)
+        return slot
+
+    def prepare(self, image_path, image):
+        if image_path in self._prepared:
+            return
+        slot = self._convert(image)
+        if slot is not None:
+            self._prepared[image_path] = slot
+
+    def is_prepared(self, image_path):
+        return image_path in self._prepared
+
+    def show_frame(self, image_path, image):
+        slot = self._prepared.pop(image_path, None)
+        if slot is not None:
+            stats.increment("display_ring.hit")
+        else:
+            stats.increment("display_ring.miss")
+            slot = self._convert(image)
+
+        if slot is None:
+            photo = ImageTk.PhotoImage(image)
+        else:
+            photo = self._ring[slot]
+        self.canvas.itemconfig(self.photo_item, image=photo)
+        # keep a reference, Tk does not
+        self.photo = photo
+        self._shown = slot
+
+    def show_file(self, path):
+        """
+        Show a PNG file, loaded by Tk itself so it does not have to wait
+        for PIL.  Raises tk.TclError if it cannot be read.
+        """
+        photo = tk.PhotoImage(file=path)
+        self.canvas.itemconfig(self.photo_item, image=photo)
+        self.photo = photo
+
+    def show_transition_frame(self, image, zoom):
+        """
+        Show a frame at 1/"zoom" of the screen size, scaled up by Tk.
+        """
+        if (self._transition_small is None or
+                image.size != (self._transition_small.width(),
+                               self._transition_small.height())):
+            self._transition_small = ImageTk.PhotoImage(image)
+        else:
+            self._transition_small.paste(image)
+        if self._transition is None:
+            self._transition = ImageTk.PhotoImage("RGB", self.size)
+
+        self.canvas.tk.call(str(self._transition), "copy",
+                            str(self._transition_small), "-zoom", zoom, zoom)
+        self.canvas.itemconfig(self.photo_item, image=self._transition)
+        self.photo = self._transition
+
+    def show_overlay(self, region, box):
+        if (self.overlay is not None and
+                region.size == (self.overlay.width(), self.overlay.height())):
+            # the same size as last minute, reuse the PhotoImage
+            overlay = self.overlay
+            overlay.paste(region)
+        else:
+            overlay = ImageTk.PhotoImage(region)
+        self.canvas.itemconfig(self.overlay_item, image=overlay)
+        self.canvas.coords(self.overlay_item, box[0], box[1])
+        self.overlay = overlay
+
+    def update_region(self, image, box):
+        raise NotImplementedError("the overlay is shown separately")
+
+    def close(self):
+        self._prepared.clear()
+        self._ring = []
+        self._transition_small = None
+        self._transition = None
+
+
+class FileDisplay:
+    """
+    Writes the finished frame (with the clock and weather drawn on it) to
+    "output_path" for an external viewer to show, e.g.
+
+        feh --fullscreen --reload 10 display_photo/output.jpg
+
+    The file is replaced atomically, so the viewer never reads half of it.
+    """
+
+    separate_overlay = False
+    transitions = False
+    # what they showed last is still there after a restart
+    startup_frame = False
+
+    def __init__(self, size, output_path=DISPLAY_OUTPUT_PATH,
+                 quality=DISPLAY_OUTPUT_QUALITY):
+        self.size = size
+        self.output_path = output_path
+        self.quality = quality
+
+        output_dir = os.path.dirname(self.output_path)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+    def _write(self, image):
+        tmp_path = f"{self.output_path}.tmp"
+        try:
+            with stats.timer("display_file.write"):
+                image.save(tmp_path, "JPEG", quality=self.quality)
+            os.replace(tmp_path, self.output_path)
+        except OSError as error:
+            logger.warning(f"Could not write {self.output_path}: {error}")
+
+    def prepare(self, image_path, image):
+        pass
+
+    def is_prepared(self, image_path):
+        return False
+
+    def show_frame(self, image_path, image):
+        self._write(image)
+
+    def show_file(self, path):
+        raise NotImplementedError("the last frame is still shown")
+
+    def show_overlay(self, region, box):
+        raise NotImplementedError("the overlay is drawn onto the frame")
+
+    def update_region(self, image, box):
+        # a file can only be replaced as a whole
+        self._write(image)
+
+    def close(self):
+        pass
+
+
+class FramebufferDisplay:
+    """
+    Copies the frames straight into the Linux framebuffer "device"
+    (memory mapped), without going through Tk or X.  Clock updates only
+    copy the rows of the part of the frame that changed.
+    """
+
+    separate_overlay = False
+    transitions = False
+    # what they showed last is still there after a restart
+    startup_frame = False
+
+    def __init__(self, device=FRAMEBUFFER_DEVICE):
+        sys_dir = f"/sys/class/graphics/{os.path.basename(device)}"
+        width, height = read_sys_value(sys_dir, "virtual_size").split(",")
+        bits_per_pixel = int(read_sys_value(sys_dir, "bits_per_pixel"))
+        self.stride = int(read_sys_value(sys_dir, "stride"))
+        self.size = (int(width), int(height))
+
+        if bits_per_pixel not in FRAMEBUFFER_RAW_MODES:
+            raise OSError(f"{bits_per_pixel} bits per pixel framebuffers "
+                          f"are not supported")
+        self.raw_mode = FRAMEBUFFER_RAW_MODES[bits_per_pixel]
+        self.bytes_per_pixel = bits_per_pixel // 8
+
+        self._file = open(device, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), self.stride * self.size[1])
+        logger.info(f"Framebuffer {device}: {self.size}, "
+                    f"{bits_per_pixel} bits per pixel")
+
+    def prepare(self, image_path, image):
+        pass
+
+    def is_prepared(self, image_path):
+        return False
+
+    def show_frame(self, image_path, image):
+        self.update_region(image, (0, 0) + image.size)
+
+    def show_file(self, path):
+        raise NotImplementedError("the last frame is still shown")
+
+    def show_overlay(self, region, box):
+        raise NotImplementedError("the overlay is drawn onto the frame")
+
+    def update_region(self, image, box):
+        left, top, right, bottom = box
+        right = min(right, self.size[0], image.size[0])
+        bottom = min(bottom, self.size[1], image.size[1])
+        if right <= left or bottom <= top:
+            return
+
+        with stats.timer("display_framebuffer.write"):
+            region = image.crop((left, top, right, bottom))
+            pixels = region.tobytes("raw", self.raw_mode)
+            region.close()
+            row_bytes = (right - left) * self.bytes_per_pixel
+            for row in range(bottom - top):
+                offset = ((top + row) * self.stride +
+                          left * self.bytes_per_pixel)
+                self._map[offset:offset + row_bytes] = pixels[
+                    row * row_bytes:(row + 1) * row_bytes]
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def read_sys_value(sys_dir, name):
+    with open(os.path.join(sys_dir, name)) as sys_file:
+        return sys_file.read().strip()
+
+
+DISPLAY_BACKENDS = ("tk", "file", "framebuffer")
+
+
+def create_display(name, root):
+    """
+    The display backend called "name".  Tk's main loop still runs the
+    slideshow with the other backends, their window is hidden.
+    """
+    if name == "tk":
+        return TkDisplay(root)
+
+    root.withdraw()
+    if name == "file":
+        return FileDisplay(
+            (root.winfo_screenwidth(), root.winfo_screenheight()))
+    if name == "framebuffer":
+        return FramebufferDisplay()
+    raise ValueError(f"Unknown display: {name}, choose from: "
+                     f"{', '.join(DISPLAY_BACKENDS)}")
@@ -0,0 +1,200 @@
+import time
+import logging
+import threading
+from collections import deque
+
+from perceptual_hash import NearDuplicates
+from instrumentation import stats
+from globals import (
+    DUPLICATE_DISTANCE,
+    DUPLICATE_SPACING,
+    DUPLICATE_LOOKAHEAD,
+)
+
+logger = logging.getLogger(__name__)
+
+# marks where the next pass of the wrapped slides starts
+NEW_PASS = object()
+
+
+def has_paths(image_paths):
+    return any(image_path is not NEW_PASS for image_path in image_paths)
+
+
+class DuplicateClusters:
+    """
+    The groups of near duplicate images in an ImageIndex (burst shots,
+    copies of the same photo), worked out from the perceptual hashes
+    stored in the index.  The first load() is slow for a large library,
+    so it is meant to be run on a background thread, get() can be called
+    from any thread meanwhile.  After that load() only adds the images
+    hashed since (see ImageIndex.hashed_ids).  Removed images stay in the
+    clusters, they are not shown anyway.
+    """
+
+    def __init__(self, image_index, max_distance=DUPLICATE_DISTANCE):
+        self.image_index = image_index
+        self.max_distance = max_distance
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._duplicates = NearDuplicates(max_distance)
+        # how many of image_index.hashed_ids have been added
+        self._hashed_count = 0
+
+    def load(self):
+        start = time.perf_counter()
+        hashed_count = len(self.image_index.hashed_ids)
+        if self.loaded:
+            hashes = self.image_index.iter_hashes(
+                self.image_index.hashed_ids[self._hashed_count:hashed_count])
+        else:
+            hashes = self.image_index.iter_hashes()
+        added = 0
+        for image_path, dhash in hashes:
+            with self._lock:
+                self._duplicates.add(image_path, dhash)
+            added += 1
+        self._hashed_count = hashed_count
+        self.loaded = True
+        logger.info(
+            f"Added {added} images to the groups of near duplicates in "
+            f"{time.perf_counter() - start:.2f}s")
+
+    def get(self, image_path):
+        with self._lock:
+            return self._duplicates.cluster(image_path)
+
+
+class DuplicateSpacing:
+    """
+    Wraps the slides of a scheduler so near duplicates (see
+    DuplicateClusters) are not shown close together.  With the "space"
+    mode a slide from the same cluster as one of the last "spacing" slides
+    is put off for up to "lookahead" slides, with the "collapse" mode only
+    one slide of each cluster is shown per pass.
+
+    Up to "lookahead" slides are taken from the wrapped scheduler ahead
+    of time, so after a restart the shuffle may carry on a little past
+    the last slide that was shown.
+    """
+
+    def __init__(self, slides, clusters, mode, spacing=DUPLICATE_SPACING,
+                 lookahead=DUPLICATE_LOOKAHEAD):
+        self.slides = slides
+        self.clusters = clusters
+        self.mode = mode
+        self.lookahead = lookahead
+        self.position = 0
+
+        # paths taken from self.slides (and NEW_PASS marks) not shown yet
+        self._buffer = []
+        # clusters of the last "spacing" slides
+        self._recent = deque(maxlen=spacing)
+        # clusters shown this pass
+        self._shown = set()
+
+    def _take(self, count):
+        """
+        Take "count" more paths from the wrapped slides, returns them.
+        Fewer are returned if the wrapped slides run out (there are no
+        images).
+        """
+        taken = []
+        for _ in range(count):
+            if (self.slides.at_end_of_pass() and
+                    (taken[-1:] or self._buffer[-1:]) != [NEW_PASS]):
+                taken.append(NEW_PASS)
+            try:
+                taken.append(next(self.slides))
+            except StopIteration:
+                break
+        self._buffer.extend(taken)
+        return taken
+
+    def _choose(self, buffer, recent, shown, count_stats, exhausted):
+        """
+        Take the next slide out of "buffer", or return None if more have
+        to be taken from the wrapped slides first.  Once they are
+        "exhausted" the slide is chosen from what is left.
+        """
+        while buffer and buffer[0] is NEW_PASS:
+            buffer.pop(0)
+            shown.clear()
+
+        if self.mode == "collapse":
+            while buffer:
+                image_path = buffer.pop(0)
+                if image_path is NEW_PASS:
+                    shown.clear()
+                    continue
+                cluster = self.clusters.get(image_path)
+                if cluster is None:
+                    return image_path
+                if cluster not in shown:
+                    shown.add(cluster)
+                    return image_path
+                if count_stats:
+                    stats.increment("duplicates.collapsed")
+            return None
+
+        # the passes of the wrapped slides do not matter here
+        candidates = [index for index, image_path in enumerate(buffer)
+                      if image_path is not NEW_PASS][:self.lookahead]
+        if not candidates or (len(candidates) < self.lookahead and
+                              not exhausted):
+            return None
+
+        choice = candidates[0]
+        for index in candidates:
+            cluster = self.clusters.get(buffer[index])
+            if cluster is None or cluster not in recent:
+                choice = index
+                break
+        if count_stats and choice != candidates[0]:
+            stats.increment("duplicates.spaced")
+        image_path = buffer.pop(choice)
+        recent.append(self.clusters.get(image_path))
+        return image_path
+
+    def add_new_images(self):
+        self.slides.add_new_images()
+
+    def at_end_of_pass(self):
+        return self.slides.at_end_of_pass() and not has_paths(self._buffer)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        exhausted = False
+        while True:
+            image_path = self._choose(
+                self._buffer, self._recent, self._shown, True, exhausted)
+            if image_path is not None:
+                self.position += 1
+                return image_path
+            if exhausted:
+                raise StopIteration
+            exhausted = not has_paths(self._take(self.lookahead))
+
+    def peek(self, count):
+        """
+        The next "count" paths, without moving on.
+        """
+        buffer = list(self._buffer)
+        recent = deque(self._recent, maxlen=self._recent.maxlen)
+        shown = set(self._shown)
+        image_paths = []
+        exhausted = False
+        while len(image_paths) < count:
+            image_path = self._choose(buffer, recent, shown, False,
+                                      exhausted)
+            if image_path is not None:
+                image_paths.append(image_path)
+                continue
+            if exhausted:
+                break
+            taken = self._take(self.lookahead)
+            buffer.extend(taken)
+            exhausted = not has_paths(taken)
+        return image_paths
@@ -0,0 +1,242 @@
+import os
+import time
+import errno
+import select
+import struct
+import logging
+import threading
+import ctypes
+import ctypes.util
+from concurrent.futures import ThreadPoolExecutor
+
+from globals import ON_LINUX, EXCLUDE_DIRS, WATCH_POLL_INTERVAL
+
+logger = logging.getLogger(__name__)
+insane_logger = logging.getLogger("insane_logger")
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+# how long the watch thread blocks before checking if it should stop, in
+# seconds
+SELECT_TIMEOUT = 1
+
+
+class InotifyWatcher:
+    """
+    Watches every directory of the image index with inotify on a
+    background thread and collects the directories where files were
+    added, removed, renamed or written.  apply() brings just those
+    directories up to date in the index, so new photos show up and
+    removed ones are dropped without rescanning the whole library.
+
+    Raises OSError if inotify is not available (or the watch limit is
+    reached), see create_watcher().
+    """
+
+    def __init__(self, directories):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"),
+                                 use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise_errno("inotify_init1")
+
+        self._lock = threading.Lock()
+        self._changed = set()
+        self._overflowed = False
+        # watch descriptor -> directory path
+        self._watches = {}
+        self._stop = threading.Event()
+
+        try:
+            for dir_path in directories:
+                self._add_watch(dir_path)
+        except OSError:
+            os.close(self._fd)
+            raise
+        logger.info(f"Watching {len(self._watches)} directories")
+
+        self._thread = threading.Thread(
+            target=self._run, name="file_watcher", daemon=True)
+        self._thread.start()
+
+    def _add_watch(self, dir_path):
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                # already gone again
+                return
+            raise_errno(f"inotify_add_watch {dir_path}", error)
+        self._watches[wd] = dir_path
+
+    def _add_watch_tree(self, dir_path):
+        stack = [dir_path]
+        while stack:
+            dir_path = stack.pop()
+            try:
+                self._add_watch(dir_path)
+                files = list(os.scandir(dir_path))
+            except OSError as error:
+                logger.warning(f"Could not watch directory: {error}")
+                continue
+            stack.extend(
+                f"{dir_path}/{file.name}" for file in files
+                if file.is_dir() and file.name not in EXCLUDE_DIRS)
+
+    def _remove_watch_tree(self, dir_path):
+        prefix = f"{dir_path}/"
+        for wd, path in list(self._watches.items()):
+            if path == dir_path or path.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._watches[wd]
+
+    def _run(self):
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._fd], [], [], SELECT_TIMEOUT)
+            if not readable:
+                continue
+            try:
+                data = os.read(self._fd, READ_SIZE)
+            except BlockingIOError:
+                continue
+            except OSError as error:
+                logger.error(f"Could not read file events: {error}")
+                return
+            self._handle_events(data)
+
+    def _handle_events(self, data):
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("Too many file events, rescanning the index")
+                with self._lock:
+                    self._overflowed = True
+                continue
+
+            dir_path = self._watches.get(wd)
+            if dir_path is None:
+                continue
+            if mask & IN_IGNORED:
+                # the directory was removed, its parent has an event too
+                del self._watches[wd]
+                continue
+
+            insane_logger.debug(
+                f"file event {mask:#x}: {dir_path}/{name}")
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                changed.add(dir_path)
+                continue
+
+            changed.add(dir_path)
+            if mask & IN_ISDIR and name not in EXCLUDE_DIRS:
+                sub_dir = f"{dir_path}/{name}"
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_watch_tree(sub_dir)
+                elif mask & IN_MOVED_FROM:
+                    self._remove_watch_tree(sub_dir)
+
+        with self._lock:
+            self._changed.update(changed)
+
+    def apply(self, image_index):
+        """
+        Bring the directories that changed since the last call up to date
+        in the index.  Returns True if there were any.
+        """
+        with self._lock:
+            changed, self._changed = self._changed, set()
+            overflowed, self._overflowed = self._overflowed, False
+
+        if overflowed:
+            image_index.update()
+            return True
+        if changed:
+            logger.info(f"{len(changed)} directories changed")
+            image_index.update_directories(changed)
+            return True
+        return False
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(SELECT_TIMEOUT * 2)
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """
+    Fallback for when inotify is not available: the whole index is
+    refreshed every "interval" seconds.  That only lists the directories
+    whose modification time has changed, but it still stats every
+    directory, so it is done on a background thread.  apply() starts the
+    refresh and returns True once it has finished.
+    """
+
+    def __init__(self, interval=WATCH_POLL_INTERVAL):
+        self.interval = interval
+        self._last_poll = time.monotonic()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="file_watcher")
+        self._update = None
+
+    def apply(self, image_index):
+        if self._update is not None:
+            if not self._update.done():
+                return False
+            update, self._update = self._update, None
+            # raises what update() raised
+            update.result()
+            return True
+
+        if time.monotonic() - self._last_poll >= self.interval:
+            self._last_poll = time.monotonic()
+            self._update = self._executor.submit(image_index.update)
+        return False
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+def raise_errno(action, error=None):
+    if error is None:
+        error = ctypes.get_errno()
+    raise OSError(error, f"{action}: {os.strerror(error)}")
+
+
+def create_watcher(directories):
+    """
+    An InotifyWatcher where possible, otherwise a PollingWatcher.
+    """
+    if ON_LINUX:
+        try:
+            return InotifyWatcher(directories)
+        except (OSError, AttributeError) as error:
+            # AttributeError: a libc without inotify
+            logger.warning(f"Could not watch the image directory, polling "
+                           f"every {WATCH_POLL_INTERVAL} seconds instead: "
+                           f"{error}")
+    return PollingWatcher()
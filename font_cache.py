@@ -0,0 +1,68 @@
+import logging
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+from instrumentation import stats
+from globals import FONT_CACHE_SIZE, TEXT_SIZE_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+BASE_FONT_SAMPLE_TEXT = "Hello World 0158"
+
+# only used to measure text, nothing is drawn on it
+_measure_draw = ImageDraw.Draw(Image.new("L", (1, 1)))
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def get_font(font_path, font_size):
+    logger.debug(f"loading font {font_path} size {font_size}")
+    return ImageFont.truetype(font_path, font_size)
+
+
+@lru_cache(maxsize=TEXT_SIZE_CACHE_SIZE)
+def _get_text_size(text, font_path, font_size):
+    return _measure_draw.textsize(text, get_font(font_path, font_size))
+
+
+def get_text_size(text, font):
+    return _get_text_size(text, font.path, font.size)
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def get_base_font_size(font_path, text_height,
+                       sample_text=BASE_FONT_SAMPLE_TEXT):
+    """
+    Smallest font size at which "sample_text" is at least "text_height"
+    pixels high.  Text height grows with the font size, so the size is
+    found with a binary search instead of trying every size from 1.  The
+    fonts tried along the way are not kept in the font cache.
+    """
+    def sample_height(font_size):
+        font = ImageFont.truetype(font_path, font_size)
+        return _measure_draw.textsize(sample_text, font)[1]
+
+    low, high = 1, 1
+    while sample_height(high) < text_height:
+        low, high = high + 1, high * 2
+
+    while low < high:
+        middle = (low + high) // 2
+        if sample_height(middle) < text_height:
+            low = middle + 1
+        else:
+            high = middle
+
+    logger.debug(f"base font size for text height {text_height}: {high}")
+    return high
+
+
+def get_cache_info():
+    return {
+        "fonts": get_font.cache_info()._asdict(),
+        "text_sizes": _get_text_size.cache_info()._asdict(),
+        "base_font_sizes": get_base_font_size.cache_info()._asdict(),
+    }
+
+
+stats.add_source("font_cache", get_cache_info)
@@ -0,0 +1,243 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from instrumentation import stats
+from globals import (
+    FRAME_CACHE_DIR, FRAME_CACHE_MAX_BYTES, FRAME_CACHE_QUALITY,
+)
+
+logger = logging.getLogger(__name__)
+insane_logger = logging.getLogger("insane_logger")
+
+FRAME_EXTENSION = ".jpg"
+# a .tmp file this old is left over from an interrupted write, younger
+# ones may still be being written by another process
+STALE_TMP_SECONDS = 3600
+# frames stored between scans of the cache directory, see rescan()
+RESCAN_STORES = 50
+
+
+def read_frame(path):
+    with open(path, "rb") as frame_file:
+        frame = Image.open(frame_file)
+        frame.load()
+    return frame
+
+
+def read_file(path):
+    with open(path, "rb") as frame_file:
+        return frame_file.read()
+
+
+class FrameCache:
+    """
+    On disk cache of screen sized frames, so the originals on the (slow)
+    USB drive only have to be decoded and resized once.
+
+    Frames are keyed by the path, modification time and size of the
+    original plus the screen size and the layer drawn on it, so an edited
+    photo, a different TV or a new layout gets a new entry.  The least
+    recently used frames are removed once the cache grows past
+    "max_bytes".  The modification time of each cached file is used as
+    its last use time, so the order survives restarts.
+
+    Several processes can share the cache (e.g. the slideshow and
+    render_frames.py --warm_cache).  A frame stored by another process is
+    found the first time it is asked for, and the cache directory is
+    scanned again every RESCAN_STORES stores, so eviction counts the
+    frames of every process in the order they were last used.
+    """
+
+    def __init__(self, cache_dir=FRAME_CACHE_DIR,
+                 max_bytes=FRAME_CACHE_MAX_BYTES,
+                 quality=FRAME_CACHE_QUALITY):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.quality = quality
+
+        self._lock = threading.Lock()
+        # key -> file size in bytes, least recently used first
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._stores = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.rescan()
+
+    def rescan(self):
+        """
+        Read which frames are in the cache directory (and when they were
+        last used) again, including those other processes have stored or
+        removed, then evict down to "max_bytes".
+        """
+        entries = []
+        now = time.time()
+        for file in os.scandir(self.cache_dir):
+            try:
+                stat = file.stat()
+                if file.name.endswith(".tmp"):
+                    if now - stat.st_mtime > STALE_TMP_SECONDS:
+                        os.remove(file.path)
+                elif file.name.endswith(FRAME_EXTENSION):
+                    key = file.name[:-len(FRAME_EXTENSION)]
+                    entries.append((stat.st_mtime, key, stat.st_size))
+            except FileNotFoundError:
+                # removed by another process in the meantime
+                continue
+        entries.sort()
+
+        with self._lock:
+            self._entries = OrderedDict(
+                (key, size) for _, key, size in entries)
+            self._total_bytes = sum(size for _, _, size in entries)
+            self._stores = 0
+            logger.info(f"Frame cache: {len(self._entries)} frames, "
+                        f"{self._total_bytes} bytes")
+        self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + FRAME_EXTENSION)
+
+    @staticmethod
+    def key(image_path, size, layer=""):
+        stat = os.stat(image_path)
+        width, height = size
+        source = (f"{os.path.abspath(image_path)}\0{stat.st_mtime_ns}\0"
+                  f"{stat.st_size}\0{width}x{height}\0{layer}")
+        return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._entries:
+                return True
+        return os.path.exists(self._path(key))
+
+    def _use(self, key):
+        """
+        Returns whether the frame is cached.  A frame another process has
+        stored since the last scan is adopted.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return True
+            try:
+                size = os.path.getsize(self._path(key))
+            except OSError:
+                return False
+            self._entries[key] = size
+            self._total_bytes += size
+        self._evict()
+        return True
+
+    def _read(self, key, read):
+        """
+        read(path) of the cached frame, or None.  The hit or miss is only
+        counted once it has been read, a frame that cannot be read is a
+        miss.
+        """
+        result = None
+        if self._use(key):
+            path = self._path(key)
+            try:
+                os.utime(path)
+                result = read(path)
+            except FileNotFoundError:
+                # evicted by another process since the last scan
+                self._remove(key)
+            except OSError as error:
+                logger.warning(f"Could not read cached frame {path}: {error}")
+                self._remove(key)
+
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        stats.increment("frame_cache.miss" if result is None
+                        else "frame_cache.hit")
+        return result
+
+    def get(self, key):
+        frame = self._read(key, read_frame)
+        if frame is not None:
+            insane_logger.debug(f"frame cache hit: {key}")
+        return frame
+
+    def get_bytes(self, key):
+        """
+        The cached JPEG file of a frame as it is stored, without decoding
+        it, or None.
+        """
+        return self._read(key, read_file)
+
+    def put(self, key, frame):
+        self._store(key, lambda tmp_path: frame.save(
+            tmp_path, "JPEG", quality=self.quality))
+
+    def put_bytes(self, key, data):
+        """
+        Store a frame that is already a JPEG file, e.g. one downloaded
+        from a frame server.
+        """
+        def write(tmp_path):
+            with open(tmp_path, "wb") as frame_file:
+                frame_file.write(data)
+
+        self._store(key, write)
+
+    def _store(self, key, write):
+        path = self._path(key)
+        # unique to this thread of this process
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as error:
+            logger.warning(f"Could not write cached frame {path}: {error}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        size = os.path.getsize(path)
+        with self._lock:
+            self._total_bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._stores += 1
+            rescan = self._stores >= RESCAN_STORES
+        insane_logger.debug(f"frame cache store: {key} ({size} bytes)")
+        if rescan:
+            self.rescan()
+        else:
+            self._evict()
+
+    def _remove(self, key):
+        with self._lock:
+            self._total_bytes -= self._entries.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._total_bytes <= self.max_bytes or not self._entries:
+                    return
+                key, size = self._entries.popitem(last=False)
+                self._total_bytes -= size
+            insane_logger.debug(f"frame cache evict: {key}")
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
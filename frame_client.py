@@ -0,0 +1,302 @@
+import io
+import os
+import time
+import logging
+import threading
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+import requests
+from PIL import Image
+
+from logging_config import setup_logger
+from frame_cache import FrameCache
+from frame_pipeline import prepare_frame
+from instrumentation import stats
+from globals import FRAME_CLIENT_NAME, FRAME_CLIENT_TIMEOUT
+import globals
+
+parser = ArgumentParser(
+    description="Pretend to be several slideshows showing slides from a "
+                "frame server as fast as possible, to test it on one machine."
+)
+parser.add_argument(
+    "server_url",
+    type=str,
+    help="e.g. http://localhost:8765"
+)
+parser.add_argument(
+    "--clients",
+    type=int,
+    default=3
+)
+parser.add_argument(
+    "--slides",
+    type=int,
+    help="slides shown by each client",
+    default=20
+)
+parser.add_argument(
+    "--width",
+    type=int,
+    default=globals.RENDER_SCREEN_SIZE[0]
+)
+parser.add_argument(
+    "--height",
+    type=int,
+    default=globals.RENDER_SCREEN_SIZE[1]
+)
+parser.add_argument(
+    "--frame_cache",
+    action="store_true",
+    help="keep the downloaded frames in the frame cache, as the slideshow "
+         "does"
+)
+parser.add_argument(
+    "-l",
+    "--LOG_LEVEL",
+    dest="LOG_LEVEL",
+    type=str,
+    default=globals.LOG_LEVEL
+)
+
+logger = logging.getLogger("frame_client")
+
+# slides handed out by the server that are remembered, to look up their
+# id and etag when their frame is needed
+MAX_SLIDES = 64
+
+
+class FrameClient:
+    """
+    Talks to a frame server (see frame_server.py).  prepare_frame() has
+    the same arguments as frame_pipeline.prepare_frame(), so it can be
+    used by a FramePrefetcher.
+
+    Frames are kept in the local frame cache under the ETag the server
+    gave them, so a frame that is already there is not downloaded again.
+    If a frame cannot be downloaded and the image is also on this machine
+    (e.g. the library is shared), it is rendered locally instead.
+    """
+
+    def __init__(self, server_url, name=FRAME_CLIENT_NAME,
+                 timeout=FRAME_CLIENT_TIMEOUT):
+        self.server_url = server_url.rstrip("/")
+        self.name = name
+        self.timeout = timeout
+        self.position = 0
+
+        self._lock = threading.Lock()
+        # a Session per thread (the prefetch workers download at the same
+        # time), each keeps its connection to the server open
+        self._local = threading.local()
+        self._sessions = []
+        # image path -> slide {"id", "path", "etag"}, oldest first
+        self._slides = OrderedDict()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def _request(self, method, path, screen_size, **params):
+        """
+        Raises requests.RequestException (an OSError) if the server
+        cannot be reached or returns an error.
+        """
+        params["width"], params["height"] = screen_size
+        response = self._session().request(
+            method, f"{self.server_url}{path}", params=params,
+            timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    def is_available(self):
+        try:
+            response = self._session().get(
+                f"{self.server_url}/status", timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as error:
+            logger.warning(f"Frame server {self.server_url} is not "
+                           f"available: {error}")
+            return False
+        logger.info(f"Frame server {self.server_url}: "
+                    f"{response.json()['images']} images")
+        return True
+
+    def _remember(self, slides):
+        with self._lock:
+            for slide in slides:
+                self._slides[slide["path"]] = slide
+                self._slides.move_to_end(slide["path"])
+            while len(self._slides) > MAX_SLIDES:
+                self._slides.popitem(last=False)
+
+    def next_slide(self, screen_size):
+        slide = self._request(
+            "POST", f"/clients/{self.name}/next", screen_size).json()
+        self._remember([slide])
+        self.position = slide["position"]
+        return slide["path"]
+
+    def upcoming_slides(self, screen_size, count):
+        slides = self._request(
+            "GET", f"/clients/{self.name}/upcoming", screen_size,
+            count=count).json()
+        self._remember(slides)
+        return [slide["path"] for slide in slides]
+
+    def download_frame(self, slide, screen_size, frame_cache=None):
+        if frame_cache is not None:
+            cached = frame_cache.get(slide["etag"])
+            if cached is not None:
+                return cached
+
+        with stats.timer("frame_client.download"):
+            response = self._request(
+                "GET", f"/frames/{slide['id']}", screen_size)
+        frame = Image.open(io.BytesIO(response.content))
+        frame.load()
+        if frame_cache is not None:
+            frame_cache.put_bytes(slide["etag"], response.content)
+        return frame
+
+    def prepare_frame(self, image_path, screen_size, frame_cache=None,
+                      image_index=None):
+        with self._lock:
+            slide = self._slides.get(image_path)
+        try:
+            if slide is None:
+                raise FileNotFoundError(
+                    f"Not a slide from the frame server: {image_path}")
+            return self.download_frame(slide, screen_size, frame_cache)
+        except OSError as error:
+            # requests.RequestException and PIL errors are OSErrors too
+            if not os.path.exists(image_path):
+                raise
+            logger.warning(f"Could not download {image_path}, rendering it "
+                           f"locally: {error}")
+            stats.increment("frame_client.local")
+            return prepare_frame(image_path, screen_size, frame_cache,
+                                 image_index)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+
+
+class RemoteSlides:
+    """
+    The slides a frame server has chosen for this client, with the same
+    interface as the schedulers.  The server starts every new pass and
+    keeps up with changes to the library itself.
+
+    The upcoming slides are only asked for once per slide (even if the
+    server cannot be reached), the slideshow peeks at them much more often
+    than that.
+    """
+
+    def __init__(self, frame_client, screen_size):
+        self.frame_client = frame_client
+        self.screen_size = screen_size
+        self._upcoming = None
+        self._upcoming_count = 0
+
+    @property
+    def position(self):
+        return self.frame_client.position
+
+    def at_end_of_pass(self):
+        return False
+
+    def add_new_images(self):
+        pass
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        Raises OSError if the server cannot be reached.
+        """
+        self._upcoming = None
+        return self.frame_client.next_slide(self.screen_size)
+
+    def peek(self, count):
+        if self._upcoming is None or self._upcoming_count < count:
+            try:
+                self._upcoming = self.frame_client.upcoming_slides(
+                    self.screen_size, count)
+                self._upcoming_count = count
+            except OSError as error:
+                logger.warning(f"Could not get the upcoming slides: {error}")
+                self._upcoming = []
+                self._upcoming_count = count
+        return self._upcoming[:count]
+
+
+def run_client(server_url, name, slides, screen_size, frame_cache, results):
+    frame_client = FrameClient(server_url, name)
+    remote_slides = RemoteSlides(frame_client, screen_size)
+    seconds = []
+    failed = 0
+    try:
+        for _ in range(slides):
+            start = time.perf_counter()
+            try:
+                image_path = next(remote_slides)
+                remote_slides.peek(globals.PREFETCH_DEPTH)
+                frame = frame_client.prepare_frame(
+                    image_path, screen_size, frame_cache)
+            except OSError as error:
+                logger.warning(f"{name}: {error}")
+                failed += 1
+                continue
+            frame.close()
+            seconds.append(time.perf_counter() - start)
+    finally:
+        frame_client.close()
+    results[name] = (seconds, failed)
+
+
+def main(args):
+    screen_size = (args.width, args.height)
+    frame_cache = FrameCache() if args.frame_cache else None
+    results = {}
+    threads = [
+        threading.Thread(
+            target=run_client,
+            args=(args.server_url, f"test_client_{number}", args.slides,
+                  screen_size, frame_cache, results))
+        for number in range(args.clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total_seconds = time.perf_counter() - start
+
+    for name, (seconds, failed) in sorted(results.items()):
+        seconds.sort()
+        if seconds:
+            print(f"{name}: {len(seconds)} slides, "
+                  f"p50 {seconds[len(seconds) // 2] * 1000:.0f}ms, "
+                  f"max {seconds[-1] * 1000:.0f}ms, {failed} failed")
+        else:
+            print(f"{name}: no slides, {failed} failed")
+    print(f"{args.clients} clients in {total_seconds:.1f}s")
+
+
+if __name__ == '__main__':
+    parsed_args = parser.parse_args()
+    globals.LOG_LEVEL = parsed_args.LOG_LEVEL
+
+    setup_logger()
+    main(parsed_args)
@@ -0,0 +1,368 @@
+import time
+import logging
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from image_modification import ImageModification, get_static_layer_key
+from frame_cache import FrameCache
+import globals
+from globals import PREFETCH_DEPTH, PREFETCH_WORKERS
+from instrumentation import stats, timed
+from process_stats import current_rss, format_bytes
+
+logger = logging.getLogger(__name__)
+insane_logger = logging.getLogger("insane_logger")
+
+
+DecodeStats = namedtuple(
+    "DecodeStats",
+    [
+        "original_size",
+        "decoded_size",
+        "decoded_bytes",
+        "seconds",
+        "rss",
+        "rss_delta",
+    ],
+)
+
+
+FIT_MODES = ("stretch", "fit", "fill")
+
+
+def get_fit_size(image_size, size):
+    """
+    The largest size with the aspect ratio of image_size that fits in
+    "size".
+    """
+    scale = min(size[0] / image_size[0], size[1] / image_size[1])
+    return (max(1, round(image_size[0] * scale)),
+            max(1, round(image_size[1] * scale)))
+
+
+def get_crop_box(image_size, size, subject_box=None):
+    """
+    The largest box of image_size with the aspect ratio of "size", as
+    close to centred on the subject (fractions of image_size, see
+    subject_detection) as the edges of the image allow.  Without a
+    subject it is centred on the image.
+    """
+    width, height = image_size
+    scale = max(size[0] / width, size[1] / height)
+    crop_width = min(width, size[0] / scale)
+    crop_height = min(height, size[1] / scale)
+
+    if subject_box is None:
+        centre_x, centre_y = width / 2, height / 2
+    else:
+        left, top, right, bottom = subject_box
+        centre_x = (left + right) / 2 * width
+        centre_y = (top + bottom) / 2 * height
+
+    left = min(max(centre_x - crop_width / 2, 0), width - crop_width)
+    top = min(max(centre_y - crop_height / 2, 0), height - crop_height)
+    return (left, top, left + crop_width, top + crop_height)
+
+
+@timed("decode_resized")
+def decode_resized(image_path, size, fit_mode="stretch", subject_box=None):
+    """
+    Open an image and resize it to "size".  JPEGs are decoded in draft
+    mode, which lets libjpeg scale the image down by 1/2, 1/4 or 1/8
+    during decoding to the smallest scale that still covers "size".  The
+    final resize is then done with a high quality filter.
+
+    "fit_mode" is one of FIT_MODES (see globals.FIT_MODE), for "fill" the
+    crop is centred on subject_box if there is one.
+
+    Returns the resized image and the DecodeStats for it.  The RSS values
+    are for the whole process so they also include any other images
+    being decoded at the same time.  The peak RSS is not reset here, that
+    is process wide too (see StageTimer in benchmark.py and render_frames
+    for where decodes cannot overlap).
+    """
+    if fit_mode not in FIT_MODES:
+        raise ValueError(f"Unknown fit mode: {fit_mode}, choose from: "
+                         f"{', '.join(FIT_MODES)}")
+    rss_before = current_rss()
+    start = time.perf_counter()
+
+    # closing the original straight away frees the decoded pixels (and
+    # the file handle) now, rather than whenever it is garbage collected
+    with Image.open(image_path) as original_image:
+        original_size = original_image.size
+        if fit_mode == "fit":
+            resized_size = get_fit_size(original_size, size)
+            # the size the whole image has to be decoded at
+            draft_size = resized_size
+        elif fit_mode == "fill":
+            resized_size = size
+            crop_box = get_crop_box(original_size, size, subject_box)
+            crop_scale = size[0] / (crop_box[2] - crop_box[0])
+            draft_size = (round(original_size[0] * crop_scale),
+                          round(original_size[1] * crop_scale))
+        else:
+            resized_size = size
+            draft_size = size
+        original_image.draft("RGB", draft_size)
+        original_image.load()
+        decoded_size = original_image.size
+        decoded_bytes = (decoded_size[0] * decoded_size[1] *
+                         len(original_image.getbands()))
+
+        box = None
+        if fit_mode == "fill":
+            # the crop box in the (possibly scaled down) decoded image
+            draft_scale = decoded_size[0] / original_size[0]
+            box = tuple(value * draft_scale for value in crop_box)
+        resized = original_image.resize(resized_size, Image.ANTIALIAS,
+                                        box=box)
+    if resized.mode != "RGB":
+        # e.g. palette or transparent PNGs, the frame is always shown
+        # (and cached) as a plain RGB image
+        converted = resized.convert("RGB")
+        resized.close()
+        resized = converted
+    if resized.size != size:
+        # black bars around the photo, the frame is always screen sized
+        frame = Image.new("RGB", size)
+        frame.paste(resized, ((size[0] - resized.width) // 2,
+                              (size[1] - resized.height) // 2))
+        resized.close()
+        resized = frame
+
+    rss = current_rss()
+    stats = DecodeStats(
+        original_size=original_size,
+        decoded_size=decoded_size,
+        decoded_bytes=decoded_bytes,
+        seconds=time.perf_counter() - start,
+        rss=rss,
+        rss_delta=(None if rss is None or rss_before is None
+                   else rss - rss_before),
+    )
+    logger.info(
+        f"Decoded {image_path} {original_size} -> {decoded_size} "
+        f"({format_bytes(decoded_bytes)}) in {stats.seconds:.3f}s, "
+        f"rss: {format_bytes(stats.rss)}, "
+        f"rss delta: {format_bytes(stats.rss_delta)}"
+    )
+
+    return resized, stats
+
+
+def get_subject_box(image_path, image_index=None):
+    """
+    The subject to crop around, for the "fill" fit mode.
+    """
+    if image_index is None or globals.FIT_MODE != "fill":
+        return None
+    return image_index.get_subject(image_path)
+
+
+def get_frame_key(image_path, screen_size, subject_box=None):
+    """
+    The frame cache key of the prepared frame of an image (also the ETag
+    of the frame on a frame server).  Raises OSError if the image no
+    longer exists.
+    """
+    # a frame cropped before the subject was found is not reused once it
+    # has been
+    return FrameCache.key(
+        image_path, screen_size,
+        f"{globals.FIT_MODE}|{subject_box}|{get_static_layer_key()}")
+
+
+@timed("prepare_frame")
+def prepare_frame(image_path, screen_size, frame_cache=None,
+                  image_index=None):
+    """
+    Decode and resize an image to the screen size and draw the
+    information that does not change while the slideshow is running.
+    This is the expensive part of showing a slide, so it is run on a
+    worker thread ahead of time.
+
+    If a frame_cache is given, the finished static frame is read from /
+    stored in it.  Details already stored in the image_index are used
+    instead of working them out again.
+    """
+    logger.debug(f"Preparing frame: {image_path}")
+    subject_box = get_subject_box(image_path, image_index)
+    if frame_cache is not None:
+        cache_key = get_frame_key(image_path, screen_size, subject_box)
+        cached = frame_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    resized, _ = decode_resized(image_path, screen_size, globals.FIT_MODE,
+                                subject_box)
+
+    location, metadata = None, None
+    if image_index is not None:
+        record = image_index.get(image_path)
+        if record is not None:
+            location = record.location
+            metadata = image_index.get_metadata(image_path)
+
+    modified_img = ImageModification(resized, image_path, None, None,
+                                     location=location, metadata=metadata)
+    modified_img.add_static_info()
+
+    if frame_cache is not None:
+        frame_cache.put(cache_key, resized)
+
+    return resized
+
+
+class LayeredFrame:
+    """
+    A prepared frame (the photo with its static layer) with the dynamic
+    layer drawn on top of it.  Redrawing the dynamic layer only touches
+    its dirty rectangle: the static pixels under the previous dynamic
+    layer are put back before the new one is drawn.
+    """
+
+    def __init__(self, image_path, static_frame):
+        self.image_path = image_path
+        self.image = static_frame
+        self.dynamic_box = None
+        self._static_region = None
+
+    def close(self):
+        """
+        Release the frame's pixels.  The frame cannot be drawn on or
+        shown after this.
+        """
+        self.image.close()
+        self._static_region = None
+
+    def restore_static_layer(self):
+        if self._static_region is not None:
+            self.image.paste(self._static_region, self.dynamic_box[:2])
+            self._static_region = None
+            self.dynamic_box = None
+
+    def copy_static_layer(self):
+        """
+        A copy of the frame without the dynamic layer.
+        """
+        static_frame = self.image.copy()
+        if self._static_region is not None:
+            static_frame.paste(self._static_region, self.dynamic_box[:2])
+        return static_frame
+
+    def render_dynamic_layer(self, weather_icon, temp):
+        """
+        Returns the dynamic layer and the box it belongs in, without
+        drawing it onto self.image.
+        """
+        self.restore_static_layer()
+
+        modified_img = ImageModification(self.image, self.image_path,
+                                         weather_icon, temp)
+        return modified_img.render_dynamic_layer()
+
+    def draw_dynamic_layer(self, weather_icon, temp):
+        """
+        Returns the new dynamic layer and the box it was drawn in.
+        """
+        region, box = self.render_dynamic_layer(weather_icon, temp)
+
+        self._static_region = self.image.crop(box)
+        self.image.paste(region, box[:2])
+        self.dynamic_box = box
+        return region, box
+
+
+def close_prepared_frame(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+class FramePrefetcher:
+    """
+    Prepares the upcoming frames on worker threads.  "prepare" is called
+    as prepare(image_path, screen_size, frame_cache, image_index), e.g.
+    FrameClient.prepare_frame() to download them from a frame server.
+    """
+
+    def __init__(self, screen_size, depth=PREFETCH_DEPTH,
+                 workers=PREFETCH_WORKERS, frame_cache=None,
+                 image_index=None, prepare=prepare_frame):
+        self.screen_size = screen_size
+        self.prepare = prepare
+        self.depth = depth
+        self.frame_cache = frame_cache
+        self.image_index = image_index
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="prefetch")
+        # image path -> Future, in the order they will be shown
+        self._pending = OrderedDict()
+
+    def fill(self, upcoming_paths):
+        """
+        Make sure the next "depth" images are being prepared.  Anything
+        that is no longer upcoming (e.g. after a reshuffle) is dropped.
+        """
+        upcoming_paths = list(upcoming_paths)[:self.depth]
+
+        for image_path in list(self._pending):
+            if image_path not in upcoming_paths:
+                insane_logger.debug(f"dropping prefetch: {image_path}")
+                self._drop(self._pending.pop(image_path))
+
+        for image_path in upcoming_paths:
+            if image_path not in self._pending:
+                insane_logger.debug(f"prefetching: {image_path}")
+                self._pending[image_path] = self._executor.submit(
+                    self.prepare, image_path, self.screen_size,
+                    self.frame_cache, self.image_index)
+
+    def get(self, image_path):
+        """
+        Return the prepared frame for image_path, waiting for the worker
+        if it is still busy.  Images that were never prefetched are
+        prepared on the calling thread.
+        """
+        future = self._pending.pop(image_path, None)
+        if future is None:
+            logger.debug(f"Prefetch miss: {image_path}")
+            stats.increment("prefetch.miss")
+            return self.prepare(image_path, self.screen_size,
+                                self.frame_cache, self.image_index)
+
+        if future.done():
+            stats.increment("prefetch.hit")
+        else:
+            logger.debug(f"Waiting for prefetch: {image_path}")
+            stats.increment("prefetch.wait")
+        with stats.timer("prefetch_wait"):
+            return future.result()
+
+    def get_if_ready(self, image_path):
+        """
+        The prepared frame for image_path if its worker has finished,
+        otherwise None.  Unlike get(), this does not wait and the frame
+        stays prefetched.
+        """
+        future = self._pending.get(image_path)
+        if (future is None or not future.done() or future.cancelled() or
+                future.exception() is not None):
+            return None
+        return future.result()
+
+    @staticmethod
+    def _drop(future):
+        # close frames that were already prepared rather than leaving
+        # them for the garbage collector
+        if future.cancel():
+            return
+        future.add_done_callback(close_prepared_frame)
+
+    def shutdown(self):
+        for future in self._pending.values():
+            self._drop(future)
+        self._pending.clear()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,450 @@
+import io
+import re
+import gzip
+import json
+import logging
+import threading
+from http import HTTPStatus
+from argparse import ArgumentParser
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from logging_config import setup_logger
+from frame_cache import FrameCache
+from frame_pipeline import prepare_frame, get_frame_key, get_subject_box
+from image_index import ImageIndex
+from scheduler import create_scheduler
+from duplicates import DuplicateClusters
+from file_watcher import create_watcher
+from instrumentation import stats
+import globals
+
+parser = ArgumentParser(
+    description="Index and render the library once and serve the frames to "
+                "the slideshows around the house (start_slideshow.py "
+                "--SERVER http://host:port)."
+)
+parser.add_argument(
+    "image_directory",
+    type=str,
+    help="relative or absolute path to the image directory",
+    nargs="?",
+    default=globals.IMG_DIR
+)
+parser.add_argument(
+    "--host",
+    type=str,
+    default=globals.FRAME_SERVER_HOST
+)
+parser.add_argument(
+    "--port",
+    type=int,
+    default=globals.FRAME_SERVER_PORT
+)
+parser.add_argument(
+    "--FIT_MODE",
+    dest="FIT_MODE",
+    help="stretch the photos to the screen, fit them in with black bars or "
+         "fill the screen, cropping around the subject",
+    choices=["stretch", "fit", "fill"],
+    default=globals.FIT_MODE
+)
+parser.add_argument(
+    "--TEXT_STYLE",
+    dest="TEXT_STYLE",
+    help="outline all text, or only where the photo behind it is busy",
+    choices=["stroke", "adaptive"],
+    default=globals.TEXT_STYLE
+)
+parser.add_argument(
+    "--SCHEDULER",
+    dest="SCHEDULER",
+    help="how the next slide is chosen",
+    choices=["shuffle", "weighted"],
+    default=globals.SCHEDULER
+)
+parser.add_argument(
+    "--DUPLICATES",
+    dest="DUPLICATES",
+    help="keep near duplicate photos (e.g. burst shots) apart, only show "
+         "one of them per pass or show them all",
+    choices=["space", "collapse", "show"],
+    default=globals.DUPLICATES
+)
+parser.add_argument(
+    "--NO_WATCH",
+    dest="WATCH_FILES",
+    help="only look for new or removed photos after every pass",
+    action="store_false",
+    default=globals.WATCH_FILES
+)
+parser.add_argument(
+    "-l",
+    "--LOG_LEVEL",
+    dest="LOG_LEVEL",
+    type=str,
+    default=globals.LOG_LEVEL
+)
+
+logger = logging.getLogger("frame_server")
+insane_logger = logging.getLogger("insane_logger")
+
+# client names end up in file names (their shuffle state)
+CLIENT_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+MAX_SCREEN_SIZE = (7680, 4320)
+MAX_UPCOMING = 10
+# slides skipped in a row (e.g. deleted images) before giving up
+MAX_SKIPPED = 10
+
+
+def get_screen_size(query):
+    try:
+        size = (int(query["width"][0]), int(query["height"][0]))
+    except (KeyError, ValueError):
+        raise ValueError("width and height are required")
+    if not (0 < size[0] <= MAX_SCREEN_SIZE[0] and
+            0 < size[1] <= MAX_SCREEN_SIZE[1]):
+        raise ValueError(f"Screen size out of range: {size}")
+    return size
+
+
+def check_client_name(name):
+    if not CLIENT_NAME_PATTERN.match(name):
+        raise ValueError(f"Invalid client name: {name!r}")
+    return name
+
+
+class FrameServer:
+    """
+    Owns the image index, the slide order of every client and the frame
+    cache, and serves display ready frames (the photo with its static
+    layer) at the screen size of each client over HTTP.  The clients only
+    draw the clock and weather on top.
+
+        POST /clients/<name>/next?width=&height=      the next slide
+        GET  /clients/<name>/upcoming?width=&height=&count=
+        GET  /frames/<id>?width=&height=              the frame as a JPEG
+        GET  /status
+
+    Slides are described as {"id", "path", "etag"}, the etag being the
+    frame cache key of the frame at that size.  A client that already has
+    the frame in its own cache does not have to ask for it at all, so
+    there are no conditional requests.  Upcoming frames are rendered on the
+    worker threads before they are asked for, and a frame that several
+    clients ask for at the same time is only rendered once.
+    """
+
+    def __init__(self, img_dir, address=None,
+                 workers=globals.PREFETCH_WORKERS):
+        if address is None:
+            address = (globals.FRAME_SERVER_HOST, globals.FRAME_SERVER_PORT)
+
+        self.image_index = ImageIndex(img_dir)
+        logger.info(f"Found: {self.image_index.update()} images")
+        self.frame_cache = FrameCache()
+        self.duplicate_clusters = None
+        if globals.DUPLICATES != "show":
+            self.duplicate_clusters = DuplicateClusters(self.image_index)
+        self.watcher = None
+        if globals.WATCH_FILES:
+            self.watcher = create_watcher(self.image_index.directories())
+
+        self._lock = threading.Lock()
+        # client name -> its slides, see create_scheduler()
+        self._clients = {}
+        # frame cache key -> Future of its JPEG data, while it is rendered
+        self._rendering = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="render")
+        self._stop = threading.Event()
+        # set when next_slide() has updated the index at the end of a
+        # pass, the new images' details are read on the maintenance thread
+        self._index_updated = threading.Event()
+        self._maintenance_thread = threading.Thread(
+            target=self._maintain, name="maintenance", daemon=True)
+
+        self.httpd = ThreadingHTTPServer(address, FrameRequestHandler)
+        self.httpd.frame_server = self
+
+    def serve_forever(self):
+        logger.info(f"Serving frames on {self.httpd.server_address}")
+        self._maintenance_thread.start()
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+
+    def close(self):
+        self._stop.set()
+        self.httpd.server_close()
+        self._executor.shutdown(wait=False)
+        if self.watcher is not None:
+            self.watcher.close()
+        self.image_index.close()
+
+    def _extract_missing_details(self):
+        self.image_index.extract_missing_details(
+            self.duplicate_clusters, globals.FIT_MODE == "fill")
+
+    def _maintain(self):
+        """
+        Keep the index (and the slides of every client) up to date with
+        the image directory, on a background thread.  The details of the
+        new images are read after every update of the index.
+        """
+        self._extract_missing_details()
+        while not self._stop.wait(globals.WATCH_CHECK_DELAY):
+            updated = self._index_updated.is_set()
+            self._index_updated.clear()
+            if (self.watcher is not None and
+                    self.watcher.apply(self.image_index)):
+                with self._lock:
+                    for slides in self._clients.values():
+                        slides.add_new_images()
+                updated = True
+            if updated:
+                self._extract_missing_details()
+
+    def _slides(self, client):
+        # the caller holds the lock
+        slides = self._clients.get(client)
+        if slides is None:
+            logger.info(f"New client: {client}")
+            slides = create_scheduler(
+                globals.SCHEDULER, self.image_index, client,
+                self.duplicate_clusters)
+            self._clients[client] = slides
+        return slides
+
+    def _slide(self, image_path, screen_size):
+        """
+        Raises OSError if the image no longer exists.
+        """
+        record = self.image_index.get(image_path)
+        if record is None:
+            raise FileNotFoundError(f"No longer indexed: {image_path}")
+        subject_box = get_subject_box(image_path, self.image_index)
+        return {
+            "id": record.id,
+            "path": image_path,
+            "etag": get_frame_key(image_path, screen_size, subject_box),
+        }
+
+    def next_slide(self, client, screen_size):
+        """
+        Moves the client on to its next slide.  Returns None if there are
+        no images.
+        """
+        for _ in range(MAX_SKIPPED):
+            with self._lock:
+                slides = self._slides(client)
+                if self.watcher is None and slides.at_end_of_pass():
+                    self.image_index.update()
+                    slides.add_new_images()
+                    self._index_updated.set()
+                try:
+                    image_path = next(slides)
+                except StopIteration:
+                    return None
+                position = slides.position
+
+            try:
+                slide = self._slide(image_path, screen_size)
+            except OSError as error:
+                logger.warning(f"Skipping {image_path}: {error}")
+                continue
+            slide["position"] = position
+            return slide
+        return None
+
+    def upcoming_slides(self, client, screen_size, count):
+        """
+        The client's next "count" slides, without moving on.  Their frames
+        are rendered in the background.
+        """
+        with self._lock:
+            image_paths = self._slides(client).peek(count)
+
+        slides = []
+        for image_path in image_paths:
+            try:
+                slide = self._slide(image_path, screen_size)
+            except OSError:
+                continue
+            if slide["etag"] not in self.frame_cache:
+                self.render(image_path, screen_size, slide["etag"])
+            slides.append(slide)
+        return slides
+
+    def frame_etag(self, image_id, screen_size):
+        """
+        The path and ETag of a frame, or None if there is no such image.
+        """
+        image_path = self.image_index.get_path(image_id)
+        if image_path is None:
+            return None
+        try:
+            subject_box = get_subject_box(image_path, self.image_index)
+            return image_path, get_frame_key(
+                image_path, screen_size, subject_box)
+        except OSError:
+            return None
+
+    def frame_data(self, image_path, screen_size, etag):
+        """
+        The frame as a JPEG file, from the frame cache or rendered (and
+        cached) on a worker thread.
+        """
+        data = self.frame_cache.get_bytes(etag)
+        if data is None:
+            data = self.render(image_path, screen_size, etag).result()
+        return data
+
+    def render(self, image_path, screen_size, etag):
+        """
+        Returns a Future of the frame's JPEG data.
+        """
+        with self._lock:
+            future = self._rendering.get(etag)
+            if future is not None:
+                stats.increment("frame_server.render_shared")
+                return future
+            future = self._executor.submit(
+                self._render_frame, image_path, screen_size, etag)
+            self._rendering[etag] = future
+        future.add_done_callback(
+            lambda done: self._rendered(etag, done))
+        return future
+
+    def _rendered(self, etag, future):
+        with self._lock:
+            if self._rendering.get(etag) is future:
+                del self._rendering[etag]
+
+    def _render_frame(self, image_path, screen_size, etag):
+        with stats.timer("frame_server.render"):
+            frame = prepare_frame(image_path, screen_size, None,
+                                  self.image_index)
+            buffer = io.BytesIO()
+            frame.save(buffer, "JPEG", quality=self.frame_cache.quality)
+            frame.close()
+        data = buffer.getvalue()
+        self.frame_cache.put_bytes(etag, data)
+        return data
+
+
+class FrameRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive, so each client reuses one connection
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def frame_server(self):
+        return self.server.frame_server
+
+    def log_message(self, format, *args):
+        insane_logger.debug(
+            f"{self.address_string()} {format % args}")
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/json")
+        if (len(body) > globals.FRAME_SERVER_GZIP_MIN_BYTES and
+                "gzip" in self.headers.get("Accept-Encoding", "")):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self, method):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip("/").split("/")
+
+        if method == "GET" and parts == ["status"]:
+            self._send_json({"images": self.frame_server.image_index.count()})
+        elif (method == "GET" and len(parts) == 2 and
+                parts[0] == "frames" and parts[1].isdigit()):
+            self._send_frame(int(parts[1]), get_screen_size(query))
+        elif (len(parts) == 3 and parts[0] == "clients" and
+                (method, parts[2]) == ("POST", "next")):
+            slide = self.frame_server.next_slide(
+                check_client_name(parts[1]), get_screen_size(query))
+            if slide is None:
+                self.send_error(HTTPStatus.NOT_FOUND, "No images")
+            else:
+                self._send_json(slide)
+        elif (len(parts) == 3 and parts[0] == "clients" and
+                (method, parts[2]) == ("GET", "upcoming")):
+            count = min(int(query.get("count", ["1"])[0]), MAX_UPCOMING)
+            self._send_json(self.frame_server.upcoming_slides(
+                check_client_name(parts[1]), get_screen_size(query), count))
+        else:
+            self.send_error(HTTPStatus.NOT_FOUND)
+
+    def _send_frame(self, image_id, screen_size):
+        found = self.frame_server.frame_etag(image_id, screen_size)
+        if found is None:
+            self.send_error(HTTPStatus.NOT_FOUND, "No such image")
+            return
+        image_path, etag = found
+
+        data = self.frame_server.frame_data(image_path, screen_size, etag)
+        stats.increment("frame_server.sent")
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("ETag", f'"{etag}"')
+        # the same URL gets a new frame if the photo or layout changes
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        if length:
+            # not used, but read so the connection can be kept alive
+            self.rfile.read(length)
+        try:
+            self._route(method)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client went away
+            pass
+        except ValueError as error:
+            self.send_error(HTTPStatus.BAD_REQUEST, str(error))
+        except OSError as error:
+            logger.warning(f"Could not serve {self.path}: {error}")
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, str(error))
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+
+def main(args):
+    frame_server = FrameServer(args.image_directory, (args.host, args.port))
+    try:
+        frame_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        frame_server.close()
+
+
+if __name__ == '__main__':
+    parsed_args = parser.parse_args()
+    globals.IMG_DIR = parsed_args.image_directory
+    globals.LOG_LEVEL = parsed_args.LOG_LEVEL
+    globals.FIT_MODE = parsed_args.FIT_MODE
+    globals.TEXT_STYLE = parsed_args.TEXT_STYLE
+    globals.SCHEDULER = parsed_args.SCHEDULER
+    globals.DUPLICATES = parsed_args.DUPLICATES
+    globals.WATCH_FILES = parsed_args.WATCH_FILES
+
+    setup_logger()
+    main(parsed_args)
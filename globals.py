@@ -1,4 +1,8 @@
 import os
+import socket
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(PROJECT_DIR, "temp", "cache")
 
 # import logging
 
@@ -12,8 +16,129 @@ SLIDESHOW_DELAY = 30
 LOG_LEVEL = "WARNING"
 INSANE_LOGGER = False
 
+# write timing / memory / cache stats of the running slideshow to STATS_DIR
+# every STATS_INTERVAL seconds
+STATS_ENABLED = False
+STATS_INTERVAL = 60
+STATS_DIR = os.path.join(PROJECT_DIR, "temp", "stats")
+# percentiles are worked out over the last STATS_WINDOW values
+STATS_WINDOW = 500
+# one file per hour
+STATS_FILE_COUNT = 48
+
+# number of upcoming slides to decode and resize ahead of time
+PREFETCH_DEPTH = 2
+PREFETCH_WORKERS = 2
+
+# screen sized copies of the images, so each original only has to be
+# decoded once
+FRAME_CACHE_ENABLED = True
+FRAME_CACHE_DIR = os.path.join(CACHE_DIR, "frames")
+FRAME_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 1GB
+FRAME_CACHE_QUALITY = 90
+# bump when the static layer (title, creation date, location) is drawn
+# differently, so frames cached with the old layout are not used
+STATIC_LAYER_VERSION = 1
+
+# render_frames.py (headless) defaults, the pi is connected to a 4k TV
+RENDER_OUTPUT_DIR = os.path.join(PROJECT_DIR, "display_photo")
+RENDER_SCREEN_SIZE = (3840, 2160)
+
+# how the photos are fitted to the screen: "stretch" them to exactly the
+# screen size (distorting them), "fit" the whole photo in with black bars,
+# or "fill" the screen, cropping the photo around its subject.  The
+# subject (faces if OpenCV is installed, otherwise the busiest part of the
+# photo) is found once per image in the background and stored in the
+# image index, until then the crop is centred.
+FIT_MODE = "fit"
+# the photo is scaled down to about this width to find its subject
+SALIENCY_SAMPLE_WIDTH = 96
+# the subject is the part of the photo with at least this fraction of its
+# strongest edges
+SALIENCY_THRESHOLD = 0.5
+
+# draw the clock, date and weather separately from the photo and update
+# them every minute, instead of only when the slide changes
+LIVE_CLOCK = True
+
+# crossfade between slides over this many seconds (0 for a hard cut), at
+# up to TRANSITION_FPS frames per second.  The fade is blended at
+# 1/TRANSITION_DOWNSCALE of the screen size, with up to
+# TRANSITION_QUEUE_SIZE frames rendered ahead.  Only on the tk display.
+TRANSITION_DURATION = 1.0
+TRANSITION_FPS = 15
+TRANSITION_DOWNSCALE = 2
+TRANSITION_QUEUE_SIZE = 3
+
+# how the frames are shown: "tk" in a full screen window, "file" written
+# to DISPLAY_OUTPUT_PATH for an external viewer such as feh, or
+# "framebuffer" copied straight into FRAMEBUFFER_DEVICE
+DISPLAY_BACKEND = "tk"
+DISPLAY_OUTPUT_PATH = os.path.join(PROJECT_DIR, "display_photo", "output.jpg")
+DISPLAY_OUTPUT_QUALITY = 95
+FRAMEBUFFER_DEVICE = "/dev/fb0"
+
+# show the last frame of the previous run as soon as the window is up and
+# index the library (or connect to the frame server), start watching it
+# and load the fonts in the background, instead of waiting for all of that
+# before anything is shown.  The frame on screen (without the clock) is
+# saved to LAST_FRAME_PATH at most every LAST_FRAME_INTERVAL seconds, only
+# for the tk display.
+FAST_START = False
+LAST_FRAME_PATH = os.path.join(CACHE_DIR, "last_frame.png")
+LAST_FRAME_INTERVAL = 600
+
+# quiet hours (e.g. overnight, when nobody is watching), e.g.
+# ((23, 0), (7, 0)) for 23:00 to 07:00, or None.  During them the slides
+# change every QUIET_SLIDESHOW_DELAY seconds, or not at all if it is 0, and
+# the next WARM_CACHE_SLIDES slides are rendered into the frame cache by
+# render_frames.py at the lowest CPU and I/O priority (IDLE_NICE and the
+# idle ionice class), so the first slides of the day are quick.
+QUIET_HOURS = None
+QUIET_SLIDESHOW_DELAY = 0
+WARM_CACHE_SLIDES = 100
+WARM_CACHE_LIST_PATH = os.path.join(CACHE_DIR, "warm_cache.txt")
+IDLE_NICE = 19
+
+# the temperature of the hottest thermal zone is read before every slide.
+# Above THERMAL_SOFT_LIMIT (degrees C) slides stay up longer, up to
+# THERMAL_MAX_SLOWDOWN times as long at THERMAL_HARD_LIMIT (the pi 4
+# throttles itself at 80), and they are not crossfaded.
+THERMAL_ZONE_PATTERN = "/sys/class/thermal/thermal_zone*/temp"
+THERMAL_SOFT_LIMIT = 70
+THERMAL_HARD_LIMIT = 80
+THERMAL_MAX_SLOWDOWN = 4
+
+# frame_server.py indexes and renders the library on one machine and
+# serves the frames at the screen size of each frame (client) in the
+# house, so the clients only download and show them.  Set
+# FRAME_SERVER_URL on a client, e.g. "http://photos.local:8765".  If the
+# server cannot be reached at start up, or cannot choose the next slide
+# FRAME_SERVER_MAX_FAILURES times in a row, the client shows its own
+# IMG_DIR.
+FRAME_SERVER_HOST = "0.0.0.0"
+FRAME_SERVER_PORT = 8765
+FRAME_SERVER_URL = None
+FRAME_SERVER_MAX_FAILURES = 3
+# every client has its own slide order, kept under its name
+FRAME_CLIENT_NAME = socket.gethostname()
+# (connect, read) timeouts in seconds, the server may have to render the
+# frame first
+FRAME_CLIENT_TIMEOUT = (5, 30)
+# JSON responses larger than this are gzipped for clients that accept it
+FRAME_SERVER_GZIP_MIN_BYTES = 1024
+
 # delay in seconds
 GET_WEATHER_DELAY = 1 * 3600  # 1 hours
+# first retry after a failure, doubles for every failure in a row
+WEATHER_RETRY_DELAY = 30
+WEATHER_RETRIES = 3
+# (connect, read) timeouts in seconds
+WEATHER_TIMEOUT = (5, 15)
+# the last good forecast is shown after a restart, or while the API
+# cannot be reached, until it is this old (in seconds)
+WEATHER_CACHE_PATH = os.path.join(CACHE_DIR, "weather.json")
+WEATHER_CACHE_MAX_AGE = 3 * 3600
 
 os_name = os.name
 ON_LINUX = os_name == "posix"
@@ -28,6 +153,51 @@ EXCLUDE_DIRS = [
     "Videos_2020"
 ]
 
+# directory modification times and per image details, so only changed
+# directories have to be listed again
+IMAGE_INDEX_PATH = os.path.join(CACHE_DIR, "image_index.sqlite3")
+
+# where the slideshow is up to in its shuffled pass through the images,
+# so it carries on from there after a restart
+SHUFFLE_STATE_PATH = os.path.join(CACHE_DIR, "shuffle_state.json")
+
+# pick up photos added to or removed from IMG_DIR while the slideshow is
+# running, with inotify where possible.  Without inotify the index is
+# refreshed every WATCH_POLL_INTERVAL seconds instead.
+WATCH_FILES = True
+WATCH_POLL_INTERVAL = 600
+# how often to apply the changes seen, in seconds
+WATCH_CHECK_DELAY = 5
+
+# photos whose perceptual hashes (dHash) differ in at most
+# DUPLICATE_DISTANCE of their 64 bits are near duplicates, e.g. burst shots
+# or copies of the same photo.  DUPLICATES "space" keeps near duplicates
+# DUPLICATE_SPACING slides apart, by looking up to DUPLICATE_LOOKAHEAD
+# slides ahead for another one, "collapse" only shows one of them per pass
+# and "show" shows them all as they come.  The hashes are worked out in the
+# background by HASH_PROCESSES processes (None for one per core), one
+# leaves the other cores to the slideshow.
+DUPLICATES = "space"
+DUPLICATE_DISTANCE = 6
+DUPLICATE_SPACING = 20
+DUPLICATE_LOOKAHEAD = 10
+HASH_PROCESSES = 1
+
+# how the next slide is chosen: "shuffle" shows every image once per pass
+# in random order, "weighted" favours the images below and avoids showing
+# two images from the same directory in a row
+SCHEDULER = "shuffle"
+# photos taken on this day (give or take THIS_DAY_WINDOW days) in an
+# earlier year are this many times as likely to be shown
+THIS_DAY_WEIGHT = 8
+THIS_DAY_WINDOW = 3
+# as are images added to the library in the last RECENT_DAYS days
+RECENT_WEIGHT = 4
+RECENT_DAYS = 30
+# how often to choose again when the next slide is from the same
+# directory as the last one
+SAME_DIRECTORY_RETRIES = 5
+
 CURRENT_TIME_FORMAT = "%H:%M"  # e.g. 18:32
 CURRENT_DATE_FORMAT = "%a %#d %b"  # e.g Sun 16 Aug
 CREATION_DATE_FORMAT = "%#d %b %Y"  # 6 Nov 2018
@@ -37,9 +207,31 @@ if ON_LINUX:
 else:
     FONT_PATH = "arial.ttf"
 
+# number of loaded fonts and measured strings kept in memory
+FONT_CACHE_SIZE = 16
+TEXT_SIZE_CACHE_SIZE = 1024
+
 # rgba
 TEXT_COLOR = (255, 255, 255, 255)  # white
 
+# "stroke" outlines all text in black.  "adaptive" looks at the photo
+# behind each group of text (bottom left, centre and right) and only
+# strokes it where the background is busy: on a calm dark background the
+# text is drawn plain, on a calm light one over a dark scrim.
+TEXT_STYLE = "stroke"
+# the photo behind the text is scaled down to about this width to work
+# out its luminance (0-255) mean and standard deviation
+CONTRAST_SAMPLE_WIDTH = 64
+# backgrounds with a larger standard deviation than this are busy
+TEXT_BUSY_STDDEV = 48
+# backgrounds darker than this are dark enough for plain white text, the
+# scrim darkens the others to about this
+TEXT_PLAIN_MAX_LUMINANCE = 100
+SCRIM_MIN_OPACITY = 0.3
+SCRIM_MAX_OPACITY = 0.75
+# pixels the scrim extends past the text
+SCRIM_PADDING = 8
+
 SHOW_GRID = False
 GRID_SIZE = 60
 
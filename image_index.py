@@ -0,0 +1,666 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+import multiprocessing
+from array import array
+from datetime import date
+from concurrent.futures import ProcessPoolExecutor
+from collections import namedtuple
+
+from image_modification import get_img_location
+from image_metadata import ImageMetadata, read_metadata
+from subject_detection import find_subject
+from perceptual_hash import hash_image
+from globals import IMAGE_INDEX_PATH, EXCLUDE_DIRS, HASH_PROCESSES
+
+logger = logging.getLogger(__name__)
+insane_logger = logging.getLogger("insane_logger")
+
+# bump whenever the tables below change, the index is then rebuilt
+INDEX_SCHEMA_VERSION = 5
+
+IMAGE_EXTENSIONS = (".jpg", ".png")
+
+ImageRecord = namedtuple(
+    "ImageRecord",
+    ["id", "path", "directory", "mtime_ns", "size", "location"],
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    directory TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    location TEXT NOT NULL,
+    metadata_read INTEGER NOT NULL DEFAULT 0,
+    title TEXT,
+    creation_date TEXT,
+    added_at INTEGER NOT NULL,
+    subject_read INTEGER NOT NULL DEFAULT 0,
+    subject_left REAL,
+    subject_top REAL,
+    subject_right REAL,
+    subject_bottom REAL,
+    hash_read INTEGER NOT NULL DEFAULT 0,
+    dhash INTEGER
+);
+CREATE INDEX IF NOT EXISTS images_directory ON images (directory);
+CREATE INDEX IF NOT EXISTS images_metadata_read ON images (metadata_read);
+CREATE INDEX IF NOT EXISTS images_subject_read ON images (subject_read);
+CREATE INDEX IF NOT EXISTS images_hash_read ON images (hash_read);
+"""
+
+
+class ImageIndex:
+    """
+    Persistent index of the images in "img_dir".
+
+    The modification time of every directory is stored with its contents,
+    so refresh() only has to list the directories that have changed since
+    the last time (a new, removed or renamed file or sub directory).  All
+    other directories are read back from the index.
+
+    The title and creation date of each image are read from its header
+    the first time they are needed (or by extract_missing_metadata() in
+    the background) and stored, so they are only parsed once per file.
+    The same goes for the box around the subject of each image (see
+    extract_missing_subjects()) and its perceptual hash (see
+    extract_missing_hashes()), which are only worked out in the
+    background as they need the image to be decoded.
+
+    The connection is shared with the prefetch threads, so every query
+    holds the lock.
+    """
+
+    def __init__(self, img_dir, index_path=IMAGE_INDEX_PATH):
+        self.img_dir = img_dir
+        self.index_path = index_path
+
+        index_dir = os.path.dirname(self.index_path)
+        if index_dir and not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+
+        # ids of the images extract_missing_metadata() has read, in order,
+        # so the schedulers only have to weight those again
+        self.metadata_read_ids = array("q")
+
+        # started the first time there is something to hash, and kept
+        self._hash_executor = None
+        # ids of the images extract_missing_hashes() has hashed, in order,
+        # so DuplicateClusters only has to add those
+        self.hashed_ids = array("q")
+
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(
+            self.index_path, check_same_thread=False)
+        self._create_schema()
+
+    def _create_schema(self):
+        with self._lock, self._connection:
+            version, = self._connection.execute(
+                "PRAGMA user_version").fetchone()
+            if version not in (0, INDEX_SCHEMA_VERSION):
+                logger.info(f"Rebuilding image index (schema version "
+                            f"{version} -> {INDEX_SCHEMA_VERSION})")
+                self._connection.execute("DROP TABLE IF EXISTS images")
+                self._connection.execute("DROP TABLE IF EXISTS directories")
+            self._connection.executescript(SCHEMA)
+            self._connection.execute(
+                f"PRAGMA user_version = {INDEX_SCHEMA_VERSION}")
+
+    def close(self):
+        if self._hash_executor is not None:
+            self._hash_executor.shutdown(wait=False)
+        with self._lock:
+            self._connection.close()
+
+    def refresh(self):
+        """
+        Bring the index up to date with the files on disk and return the
+        paths of all images.
+        """
+        self.update()
+        with self._lock:
+            return [path for path, in self._connection.execute(
+                "SELECT path FROM images ORDER BY id")]
+
+    def update(self):
+        """
+        Bring the index up to date with the files on disk and return the
+        number of images, without loading all of their paths.
+        """
+        logger.info(f"Refreshing image index: {self.img_dir}")
+        start = time.perf_counter()
+        seen_dirs = set()
+
+        with self._lock, self._connection:
+            scanned = self._walk([(self.img_dir, None)], seen_dirs)
+            self._remove_missing_directories(seen_dirs)
+
+        logger.info(
+            f"Image index refreshed in {time.perf_counter() - start:.2f}s, "
+            f"rescanned {scanned} of {len(seen_dirs)} directories"
+        )
+        return self.count()
+
+    def update_directories(self, dir_paths):
+        """
+        Bring only the given directories up to date (e.g. the ones a file
+        watcher saw change) and return the number of images.  Directories
+        that no longer exist are removed with everything below them, new
+        sub directories are walked.
+        """
+        start = time.perf_counter()
+        scanned = 0
+
+        with self._lock, self._connection:
+            # parents first, so new sub directories are only walked once
+            for dir_path in sorted(set(dir_paths), key=len):
+                try:
+                    mtime_ns = os.stat(dir_path).st_mtime_ns
+                except FileNotFoundError:
+                    self._remove_directory_tree(dir_path)
+                    continue
+                except OSError as error:
+                    logger.warning(f"Could not read directory: {error}")
+                    continue
+
+                # rescanned even if its modification time is the same, as
+                # that does not change when a file is written to
+                row = self._connection.execute(
+                    "SELECT parent FROM directories WHERE path = ?",
+                    (dir_path,)
+                ).fetchone()
+                if row is not None:
+                    parent = row[0]
+                elif dir_path == self.img_dir:
+                    parent = None
+                else:
+                    parent = os.path.dirname(dir_path)
+
+                known_dirs = {path for path, in self._connection.execute(
+                    "SELECT path FROM directories WHERE parent = ?",
+                    (dir_path,)
+                )}
+                sub_dirs = self._scan_directory(dir_path, parent, mtime_ns)
+                scanned += 1
+
+                for sub_dir in known_dirs.difference(sub_dirs):
+                    self._remove_directory_tree(sub_dir)
+                scanned += self._walk(
+                    [(sub_dir, dir_path) for sub_dir in sub_dirs
+                     if sub_dir not in known_dirs],
+                    set()
+                )
+
+        logger.info(
+            f"Image index updated in {time.perf_counter() - start:.2f}s, "
+            f"rescanned {scanned} directories"
+        )
+        return self.count()
+
+    def _walk(self, stack, seen_dirs):
+        """
+        Walk the directories on the stack and everything below them,
+        rescanning the ones that have changed.  Returns how many were
+        rescanned.
+        """
+        scanned = 0
+        # a stack instead of recursion
+        while stack:
+            dir_path, parent = stack.pop()
+            try:
+                mtime_ns = os.stat(dir_path).st_mtime_ns
+            except OSError as error:
+                logger.warning(f"Could not read directory: {error}")
+                continue
+            seen_dirs.add(dir_path)
+
+            row = self._connection.execute(
+                "SELECT mtime_ns FROM directories WHERE path = ?",
+                (dir_path,)
+            ).fetchone()
+            if row is not None and row[0] == mtime_ns:
+                sub_dirs = [path for path, in self._connection.execute(
+                    "SELECT path FROM directories WHERE parent = ?",
+                    (dir_path,)
+                )]
+            else:
+                sub_dirs = self._scan_directory(dir_path, parent, mtime_ns)
+                scanned += 1
+
+            stack.extend((sub_dir, dir_path) for sub_dir in sub_dirs)
+        return scanned
+
+    def directories(self):
+        with self._lock:
+            return [path for path, in self._connection.execute(
+                "SELECT path FROM directories")]
+
+    def count(self):
+        with self._lock:
+            count, = self._connection.execute(
+                "SELECT COUNT(*) FROM images").fetchone()
+        return count
+
+    def max_id(self):
+        """
+        The highest image id, or 0 if there are no images.  New images
+        always get a higher id than any image in the index.
+        """
+        with self._lock:
+            max_id, = self._connection.execute(
+                "SELECT MAX(id) FROM images").fetchone()
+        return max_id or 0
+
+    def get_path(self, image_id):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT path FROM images WHERE id = ?", (image_id,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def _scan_directory(self, dir_path, parent, mtime_ns):
+        insane_logger.debug(f"scanning directory: {dir_path}")
+        sub_dirs = []
+        found = {}
+
+        try:
+            files = list(os.scandir(dir_path))
+        except OSError as error:
+            logger.warning(f"Could not read directory: {error}")
+            files = []
+
+        for file in files:
+            if file.is_dir():
+                if file.name not in EXCLUDE_DIRS:
+                    sub_dirs.append(f"{dir_path}/{file.name}")
+            elif file.name.endswith(IMAGE_EXTENSIONS):
+                try:
+                    stat = file.stat()
+                except OSError as error:
+                    logger.warning(f"Could not read file: {error}")
+                    continue
+                found[f"{dir_path}/{file.name}"] = (
+                    stat.st_mtime_ns, stat.st_size)
+            else:
+                logger.warning(f"Not supported file format: {file.path}")
+
+        known = {
+            path: (mtime, size)
+            for path, mtime, size in self._connection.execute(
+                "SELECT path, mtime_ns, size FROM images WHERE directory = ?",
+                (dir_path,)
+            )
+        }
+
+        removed = [(path,) for path in known if path not in found]
+        self._connection.executemany(
+            "DELETE FROM images WHERE path = ?", removed)
+
+        for path, (file_mtime, size) in found.items():
+            if path not in known:
+                self._connection.execute(
+                    "INSERT INTO images "
+                    "(path, directory, mtime_ns, size, location, added_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (path, dir_path, file_mtime, size,
+                     get_img_location(path), int(time.time()))
+                )
+            elif known[path] != (file_mtime, size):
+                # UPDATE rather than REPLACE so the image keeps its id
+                self._connection.execute(
+                    "UPDATE images SET mtime_ns = ?, size = ?, "
+                    "metadata_read = 0, subject_read = 0, hash_read = 0 "
+                    "WHERE path = ?",
+                    (file_mtime, size, path)
+                )
+
+        self._connection.execute(
+            "INSERT OR REPLACE INTO directories (path, parent, mtime_ns) "
+            "VALUES (?, ?, ?)",
+            (dir_path, parent, mtime_ns)
+        )
+        return sub_dirs
+
+    def _remove_missing_directories(self, seen_dirs):
+        known_dirs = [path for path, in self._connection.execute(
+            "SELECT path FROM directories")]
+        missing = [(path,) for path in known_dirs if path not in seen_dirs]
+        if missing:
+            logger.info(f"Removing {len(missing)} directories from index")
+            self._connection.executemany(
+                "DELETE FROM images WHERE directory = ?", missing)
+            self._connection.executemany(
+                "DELETE FROM directories WHERE path = ?", missing)
+
+    def _remove_directory_tree(self, dir_path):
+        logger.info(f"Removing directory from index: {dir_path}")
+        prefix = f"{dir_path}/"
+        self._connection.execute(
+            "DELETE FROM images WHERE directory = ? "
+            "OR substr(directory, 1, ?) = ?",
+            (dir_path, len(prefix), prefix)
+        )
+        self._connection.execute(
+            "DELETE FROM directories WHERE path = ? "
+            "OR substr(path, 1, ?) = ?",
+            (dir_path, len(prefix), prefix)
+        )
+
+    def get(self, image_path):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT id, path, directory, mtime_ns, size, location "
+                "FROM images WHERE path = ?",
+                (image_path,)
+            ).fetchone()
+        if row is None:
+            return None
+        return ImageRecord(*row)
+
+    def get_by_id(self, image_id):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT id, path, directory, mtime_ns, size, location "
+                "FROM images WHERE id = ?",
+                (image_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return ImageRecord(*row)
+
+    def iter_schedule_info(self, after_id=-1, month_days=None,
+                           added_between=None, ids=None, batch_size=1000):
+        """
+        Yields (id, creation_date, added_at) of every image with an id
+        above "after_id", in batches so the lock is not held for the whole
+        library.  The creation date is None until the metadata has been
+        read.
+
+        If "month_days" ("MM-DD") are given, only the images created on
+        one of those days (of any year) are yielded, and if
+        "added_between" (two times) is given, only the images added to the
+        index in between.  With "ids" only those images are looked up.
+        """
+        if ids is not None:
+            for rows in self._select_ids(
+                    "SELECT id, creation_date, added_at FROM images "
+                    "WHERE id IN ({})", ids):
+                for image_id, creation_date, added_at in rows:
+                    if creation_date is not None:
+                        creation_date = date.fromisoformat(creation_date)
+                    yield image_id, creation_date, added_at
+            return
+
+        conditions = []
+        params = []
+        if month_days is not None:
+            month_days = sorted(month_days)
+            conditions.append(f"substr(creation_date, 6) IN "
+                              f"({', '.join('?' * len(month_days))})")
+            params.extend(month_days)
+        if added_between is not None:
+            conditions.append("added_at BETWEEN ? AND ?")
+            params.extend(added_between)
+        where = "".join(f" AND ({condition})" for condition in conditions)
+
+        last_id = after_id
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    f"SELECT id, creation_date, added_at FROM images "
+                    f"WHERE id > ?{where} ORDER BY id LIMIT ?",
+                    [last_id] + params + [batch_size]
+                ).fetchall()
+            if not rows:
+                return
+            for image_id, creation_date, added_at in rows:
+                if creation_date is not None:
+                    creation_date = date.fromisoformat(creation_date)
+                yield image_id, creation_date, added_at
+            last_id = rows[-1][0]
+
+    def get_metadata(self, image_path):
+        """
+        Return the ImageMetadata of an image, reading it from the file
+        (and storing it) if that has not been done yet.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT metadata_read, title, creation_date "
+                "FROM images WHERE path = ?",
+                (image_path,)
+            ).fetchone()
+
+        if row is not None and row[0]:
+            _, title, creation_date = row
+            if creation_date is not None:
+                creation_date = date.fromisoformat(creation_date)
+            return ImageMetadata(title=title, creation_date=creation_date)
+
+        metadata = read_metadata(image_path)
+        self.store_metadata(image_path, metadata)
+        return metadata
+
+    def store_metadata(self, image_path, metadata):
+        creation_date = None
+        if metadata.creation_date is not None:
+            creation_date = metadata.creation_date.isoformat()
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE images SET metadata_read = 1, title = ?, "
+                "creation_date = ? WHERE path = ?",
+                (metadata.title, creation_date, image_path)
+            )
+
+    def extract_missing_metadata(self, batch_size=100):
+        """
+        Read the metadata of every image that does not have it yet.  This
+        is meant to be run on a background thread, the lock is only held
+        while reading from or writing to the index.
+        """
+        extracted = 0
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT id, path FROM images WHERE metadata_read = 0 "
+                    "LIMIT ?",
+                    (batch_size,)
+                ).fetchall()
+            if not rows:
+                break
+
+            for _, image_path in rows:
+                try:
+                    metadata = read_metadata(image_path)
+                except OSError as error:
+                    logger.warning(f"Could not read metadata: {error}")
+                    metadata = ImageMetadata(title="", creation_date=None)
+                self.store_metadata(image_path, metadata)
+                extracted += 1
+            self.metadata_read_ids.extend(image_id for image_id, _ in rows)
+
+        if extracted:
+            logger.info(f"Read metadata of {extracted} images")
+        return extracted
+
+    def get_subject(self, image_path):
+        """
+        The box around the subject of an image stored by
+        extract_missing_subjects(), as fractions of its size, or None if
+        it has not been found (yet).
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT subject_left, subject_top, subject_right, "
+                "subject_bottom FROM images "
+                "WHERE path = ? AND subject_read = 1",
+                (image_path,)
+            ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return tuple(row)
+
+    def store_subject(self, image_path, box):
+        if box is None:
+            box = (None, None, None, None)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE images SET subject_read = 1, subject_left = ?, "
+                "subject_top = ?, subject_right = ?, subject_bottom = ? "
+                "WHERE path = ?",
+                tuple(box) + (image_path,)
+            )
+
+    def extract_missing_subjects(self, batch_size=100):
+        """
+        Find the subject of every image that does not have one stored yet,
+        on a background thread like extract_missing_metadata().
+        """
+        start = time.perf_counter()
+        extracted = 0
+        while True:
+            with self._lock:
+                image_paths = [path for path, in self._connection.execute(
+                    "SELECT path FROM images WHERE subject_read = 0 "
+                    "LIMIT ?",
+                    (batch_size,)
+                )]
+            if not image_paths:
+                break
+
+            for image_path in image_paths:
+                try:
+                    box = find_subject(image_path)
+                except OSError as error:
+                    logger.warning(f"Could not find subject: {error}")
+                    box = None
+                self.store_subject(image_path, box)
+                extracted += 1
+
+        if extracted:
+            logger.info(f"Found the subject of {extracted} images in "
+                        f"{time.perf_counter() - start:.2f}s")
+        return extracted
+
+    def iter_hashes(self, ids=None, batch_size=1000):
+        """
+        Yields (path, dhash) of every image with a perceptual hash (or
+        only of the images with the given ids), in batches like
+        iter_schedule_info().
+        """
+        if ids is not None:
+            for rows in self._select_ids(
+                    "SELECT path, dhash FROM images "
+                    "WHERE dhash IS NOT NULL AND id IN ({})", ids):
+                for image_path, dhash in rows:
+                    yield image_path, dhash & 0xFFFFFFFFFFFFFFFF
+            return
+
+        last_id = -1
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT id, path, dhash FROM images "
+                    "WHERE id > ? AND dhash IS NOT NULL ORDER BY id LIMIT ?",
+                    (last_id, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            for _, image_path, dhash in rows:
+                # stored signed, SQLite integers are 64 bit
+                yield image_path, dhash & 0xFFFFFFFFFFFFFFFF
+            last_id = rows[-1][0]
+
+    def _select_ids(self, query, ids, batch_size=500):
+        """
+        Yields the rows of "query" (with "{}" for the list of ids) in
+        batches of "batch_size" ids, SQLite limits the number of
+        parameters.
+        """
+        ids = list(ids)
+        for offset in range(0, len(ids), batch_size):
+            batch = ids[offset:offset + batch_size]
+            with self._lock:
+                yield self._connection.execute(
+                    query.format(", ".join("?" * len(batch))), batch
+                ).fetchall()
+
+    def extract_missing_hashes(self, processes=HASH_PROCESSES,
+                               batch_size=1000):
+        """
+        Work out the perceptual hash of every image that does not have one
+        yet, on "processes" worker processes.  Like
+        extract_missing_metadata() this is meant to be run on a background
+        thread.  Returns how many were worked out.
+
+        The workers are spawned rather than forked: this is called from a
+        thread of the slideshow (or frame server), a forked child would
+        inherit whatever locks the other threads hold at that moment.
+        """
+        start = time.perf_counter()
+        extracted = 0
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT id, path FROM images WHERE hash_read = 0 LIMIT ?",
+                    (batch_size,)
+                ).fetchall()
+            if not rows:
+                break
+            image_ids = [image_id for image_id, _ in rows]
+            image_paths = [image_path for _, image_path in rows]
+            if self._hash_executor is None:
+                self._hash_executor = ProcessPoolExecutor(
+                    max_workers=processes,
+                    mp_context=multiprocessing.get_context("spawn"))
+
+            hashes = self._hash_executor.map(hash_image, image_paths,
+                                             chunksize=16)
+            rows = []
+            for image_path, dhash in zip(image_paths, hashes):
+                if dhash is not None and dhash >= 1 << 63:
+                    dhash -= 1 << 64
+                rows.append((dhash, image_path))
+            with self._lock, self._connection:
+                self._connection.executemany(
+                    "UPDATE images SET hash_read = 1, dhash = ? "
+                    "WHERE path = ?",
+                    rows
+                )
+            self.hashed_ids.extend(image_ids)
+            extracted += len(rows)
+
+        if extracted:
+            logger.info(f"Hashed {extracted} images in "
+                        f"{time.perf_counter() - start:.2f}s")
+        return extracted
+
+    def extract_missing_details(self, duplicate_clusters=None,
+                                find_subjects=False):
+        """
+        Read the metadata of the new images, hash them and add them to
+        the duplicate_clusters (if there are any) and, with find_subjects,
+        find their subjects.  Like the extract_missing_*() methods this
+        is meant to be run on a background thread.
+        """
+        self.extract_missing_metadata()
+        if duplicate_clusters is not None:
+            if (self.extract_missing_hashes() or
+                    not duplicate_clusters.loaded):
+                duplicate_clusters.load()
+        if find_subjects:
+            self.extract_missing_subjects()
@@ -0,0 +1,73 @@
+import logging
+from collections import namedtuple
+from datetime import datetime
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+EXIF_IMAGE_DESCRIPTION = 270
+EXIF_DATE_TIME_ORIGINAL = 36867
+EXIF_IFD = 0x8769
+PNG_CREATION_TIME = "Creation Time"
+
+ImageMetadata = namedtuple("ImageMetadata", ["title", "creation_date"])
+
+
+def parse_creation_time(creation_time):
+    """
+    Creation times come either as RFC 2822 (PNG "Creation Time") or as
+    "YYYY:MM:DD HH:MM:SS" (EXIF).  Returns a date, or None if it cannot be
+    parsed.
+    """
+    try:
+        return datetime.strptime(
+            creation_time,
+            "%a %d %b %Y %H:%M:%S %z"
+        ).date()
+    except ValueError:
+        pass
+
+    try:
+        creation_date = creation_time.split(" ")[0]
+        creation_date = creation_date.split(":")
+        creation_date.reverse()
+        cre_date = "/".join(creation_date)
+        return datetime.strptime(cre_date, "%d/%m/%Y").date()
+    except ValueError:
+        return None
+
+
+def read_metadata(image_path):
+    """
+    Read the title and creation date of an image.  Only the header of the
+    file is read, the image itself is not decoded.
+    """
+    with Image.open(image_path) as img:
+        exif = img.getexif()
+        info = img.info
+
+        title = exif.get(EXIF_IMAGE_DESCRIPTION, "")
+        creation_time = exif.get(EXIF_DATE_TIME_ORIGINAL)
+        if creation_time is None and hasattr(exif, "get_ifd"):
+            # newer versions of Pillow no longer merge the EXIF sub IFD
+            # into the main one
+            creation_time = exif.get_ifd(EXIF_IFD).get(
+                EXIF_DATE_TIME_ORIGINAL)
+        if creation_time is None:
+            creation_time = info.get(PNG_CREATION_TIME)
+
+    if isinstance(title, bytes):
+        title = title.decode("utf-8", "replace")
+    title = title.strip("\x00").strip()
+
+    creation_date = None
+    if creation_time is None:
+        logger.info(f"img has no creation time: {image_path}")
+    else:
+        creation_date = parse_creation_time(str(creation_time).strip("\x00"))
+        if creation_date is None:
+            logger.warning(f"Could not parse creation date "
+                           f"'{creation_time}' for: {image_path}")
+
+    return ImageMetadata(title=title, creation_date=creation_date)
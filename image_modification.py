@@ -1,36 +1,140 @@
 import os
-import time
+import math
 import logging
-from datetime import date, datetime
+from datetime import datetime
 
-from PIL import ImageDraw, ImageFont, Image
+from PIL import Image, ImageDraw, ImageStat
 
+import font_cache
+from image_metadata import read_metadata
+from instrumentation import stats, timed
+from weather_icons import get_weather_icon
+import globals
 from globals import (
     GRID_SIZE,
     TEXT_COLOR,
     FONT_PATH,
+    STATIC_LAYER_VERSION,
     CURRENT_DATE_FORMAT,
     CURRENT_TIME_FORMAT,
     SHOW_GRID,
     CREATION_DATE_FORMAT,
-    WEATHER_ICONS,
+    CONTRAST_SAMPLE_WIDTH,
+    TEXT_BUSY_STDDEV,
+    TEXT_PLAIN_MAX_LUMINANCE,
+    SCRIM_MIN_OPACITY,
+    SCRIM_MAX_OPACITY,
+    SCRIM_PADDING,
 )
 
 logger = logging.getLogger(__name__)
 insane_logger = logging.getLogger("insane_logger")
 
 
+def get_img_location(image_path):
+    """
+    The location is the name of the directory the image is in, without
+    any numbers e.g. "2019_05_Brisbane_Trip" -> "Brisbane Trip".
+    """
+    path = os.path.dirname(image_path)
+    location = os.path.basename(path)
+
+    split_location = location.split("_")
+    clean_words = []
+    for word in split_location:
+        try:
+            int(word)
+        except ValueError:
+            clean_words.append(word)
+
+    return " ".join(clean_words)
+
+
+def get_static_layer_key():
+    """
+    Everything (apart from the image itself) that changes how the static
+    layer looks, so cached static layers are redrawn when it changes.
+    """
+    return (f"{STATIC_LAYER_VERSION}|{FONT_PATH}|{TEXT_COLOR}|"
+            f"{SHOW_GRID}|{GRID_SIZE}|{CREATION_DATE_FORMAT}|"
+            f"{globals.TEXT_STYLE}")
+
+
+def warm_font_cache(screen_size):
+    """
+    Size and load the fonts used on frames of "screen_size" (as
+    ImageModification does), so the first slide does not have to.
+    """
+    general_text_height = int(screen_size[1] / GRID_SIZE) * 3
+    base_font_size = font_cache.get_base_font_size(
+        FONT_PATH, general_text_height)
+    for font_size in (base_font_size, base_font_size * 2,
+                      int(base_font_size * 1.5)):
+        font_cache.get_font(FONT_PATH, font_size)
+
+
+def get_background_stats(img, box):
+    """
+    The mean and standard deviation of the luminance of the part of img
+    in box, worked out on a sample of about CONTRAST_SAMPLE_WIDTH pixels
+    wide.  The pixels are sampled rather than averaged, which would
+    smooth away the fine detail that makes text hard to read.
+    """
+    left, top, right, bottom = box
+    factor = max(1, (right - left) // CONTRAST_SAMPLE_WIDTH)
+    size = (max(1, (right - left) // factor), max(1, (bottom - top) // factor))
+    region = img.resize(size, Image.NEAREST, box=box)
+    luminance = region.convert("L")
+    region.close()
+    stat = ImageStat.Stat(luminance)
+    luminance.close()
+    return stat.mean[0], stat.stddev[0]
+
+
+def choose_text_style(mean, stddev):
+    """
+    Returns the style and, for a scrim, its opacity.
+    """
+    if stddev > TEXT_BUSY_STDDEV:
+        return "stroke", 0
+    if mean <= TEXT_PLAIN_MAX_LUMINANCE:
+        return "plain", 0
+    opacity = 1 - TEXT_PLAIN_MAX_LUMINANCE / mean
+    return "scrim", min(SCRIM_MAX_OPACITY, max(SCRIM_MIN_OPACITY, opacity))
+
+
+def union_box(box, other):
+    if box is None:
+        return other
+    return (min(box[0], other[0]), min(box[1], other[1]),
+            max(box[2], other[2]), max(box[3], other[3]))
+
+
 class ImageModification:
     def __init__(
             self, img, image_path, weather_icon,
-            temp
+            temp, location=None, metadata=None
     ):
         logger.debug("Initializing ImageModification")
         self.img = img
         self.img_path = image_path
+        self.location = location
+        self.metadata = metadata
         self.img_width, self.img_height = img.size
         self.draw = ImageDraw.Draw(img)
 
+        # where the information is drawn, see render_dynamic_layer()
+        self.canvas = img
+        self.origin = (0, 0)
+        self.measuring = False
+        self.dirty_box = None
+        self.now = None
+        # anchor ("left", "center" or "right") -> box of the text there,
+        # and the style it is drawn in, see choose_text_styles()
+        self.text_style = globals.TEXT_STYLE
+        self.anchor_boxes = {}
+        self.anchor_styles = {}
+
         self.weather_icon = weather_icon
         self.temp = temp
 
@@ -59,6 +163,8 @@ class ImageModification:
         self.text_color = TEXT_COLOR
         self.stroke_color = "black"
         self.stroke_width = 3
+        # extra pixels around the dynamic layer for anti-aliasing
+        self.dirty_margin = 2
 
         insane_logger.debug(f"image path: {self.img_path}")
         insane_logger.debug(f"image (width, height): ({self.img_width}, "
@@ -70,37 +176,202 @@ class ImageModification:
             f"{self.grid_cell_height})")
 
     def add_info_to_image(self):
+        self.add_static_info()
+        self.add_dynamic_info()
+
+    @timed("ImageModification.add_static_info")
+    def add_static_info(self):
+        """
+        Information that only depends on the image itself.  This can be
+        drawn ahead of time, away from the Tk main loop.
+        """
         if self.show_grid:
             self.add_grid()
 
-        current_date_x = self.add_current_date()
-        self.add_current_time()
+        if self.text_style == "adaptive":
+            # measure first, to know what is behind the text
+            self.measuring = True
+            self.anchor_boxes = {}
+            self.add_static_text()
+            self.measuring = False
+            self.choose_text_styles()
+            self.draw_scrims()
+        self.add_static_text()
+
+    def add_static_text(self):
         self.add_img_title()
         self.add_img_creation_date()
         self.add_img_location()
+
+    @timed("ImageModification.add_dynamic_info")
+    def add_dynamic_info(self):
+        """
+        Information that changes while the slideshow is running (clock,
+        date and weather).  This is drawn just before the image is shown.
+        """
+        current_date_x = self.add_current_date()
+        self.add_current_time()
         weather_x = self.add_weather(current_date_x)
         self.add_temperature(weather_x)
 
-    def calculate_base_font_size(self):
-        logger.debug("calculating base font size")
-        sample_text = "Hello World 0158"
-        font_size = 1
-        font = self.get_font(font_size=font_size)
-        _, sample_height = self.get_text_size(sample_text, font)
+    @timed("ImageModification.render_dynamic_layer")
+    def render_dynamic_layer(self):
+        """
+        Draw the dynamic information onto a copy of the (small) part of
+        self.img that it covers, so the rest of the frame does not have to
+        be touched when the clock changes.  self.img is not modified.
+
+        Returns the drawn region and the (left, top, right, bottom) box it
+        belongs in.
+        """
+        self.now = datetime.now()
+
+        # measure first, nothing is drawn while measuring
+        self.measuring = True
+        self.dirty_box = None
+        self.anchor_boxes = {}
+        self.add_dynamic_info()
+        self.measuring = False
+        if self.text_style == "adaptive":
+            self.choose_text_styles()
+
+        left, top, right, bottom = self.dirty_box
+        box = (
+            max(0, math.floor(left) - self.dirty_margin),
+            max(0, math.floor(top) - self.dirty_margin),
+            min(self.img_width, math.ceil(right) + self.dirty_margin),
+            min(self.img_height, math.ceil(bottom) + self.dirty_margin),
+        )
+        region = self.img.crop(box)
+
+        draw, canvas = self.draw, self.canvas
+        self.draw = ImageDraw.Draw(region)
+        self.canvas = region
+        self.origin = box[:2]
+        try:
+            self.draw_scrims()
+            self.add_dynamic_info()
+        finally:
+            self.draw, self.canvas = draw, canvas
+            self.origin = (0, 0)
+
+        return region, box
+
+    def get_now(self):
+        if self.now is None:
+            return datetime.now()
+        return self.now
+
+    def mark_dirty(self, box, anchor=None):
+        self.dirty_box = union_box(self.dirty_box, box)
+        if anchor is not None:
+            self.anchor_boxes[anchor] = union_box(
+                self.anchor_boxes.get(anchor), box)
+
+    @timed("ImageModification.choose_text_styles")
+    def choose_text_styles(self):
+        """
+        Work out how to draw the text at each anchor from the photo
+        behind it.  Must be called after measuring, before drawing.
+        """
+        self.anchor_styles = {}
+        for anchor, box in self.anchor_boxes.items():
+            box = self.clip_box(box)
+            if box is None:
+                continue
+            mean, stddev = get_background_stats(self.img, box)
+            style, opacity = choose_text_style(mean, stddev)
+            stats.increment(f"text_style.{style}")
+            insane_logger.debug(
+                f"{anchor} text: luminance {mean:.0f} +- {stddev:.0f}, "
+                f"{style} {opacity:.2f}")
+
+            if style == "scrim":
+                box = self.clip_box((
+                    box[0] - SCRIM_PADDING, box[1] - SCRIM_PADDING,
+                    box[2] + SCRIM_PADDING, box[3] + SCRIM_PADDING,
+                ))
+                self.mark_dirty(box)
+            self.anchor_styles[anchor] = (style, opacity, box)
+
+    @timed("ImageModification.draw_scrims")
+    def draw_scrims(self):
+        scrims = [(opacity, box) for style, opacity, box
+                  in self.anchor_styles.values() if style == "scrim"]
+        if not scrims:
+            return
 
-        while sample_height < self.general_text_height:
-            font_size += 1
-            font = self.get_font(font_size=font_size)
-            _, sample_height = self.get_text_size(sample_text, font)
+        origin_x, origin_y = self.origin
+        draw = ImageDraw.Draw(self.canvas, "RGBA")
+        for opacity, (left, top, right, bottom) in scrims:
+            draw.rectangle(
+                (left - origin_x, top - origin_y,
+                 right - origin_x - 1, bottom - origin_y - 1),
+                fill=(0, 0, 0, int(opacity * 255)),
+            )
 
-        return font, font_size
+    def clip_box(self, box):
+        left, top, right, bottom = box
+        box = (max(0, math.floor(left)), max(0, math.floor(top)),
+               min(self.img_width, math.ceil(right)),
+               min(self.img_height, math.ceil(bottom)))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            return None
+        return box
+
+    def draw_text(self, xy, text, font, anchor=None):
+        x, y = xy
+        width, height = self.get_text_size(text, font)
+        self.mark_dirty((
+            x - self.stroke_width,
+            y - self.stroke_width,
+            x + width + self.stroke_width,
+            y + height + self.stroke_width,
+        ), anchor)
+        if self.measuring:
+            return
 
-    def get_text_size(self, ink, font):
-        return self.draw.textsize(ink, font)
+        stroke_width = self.stroke_width
+        if anchor in self.anchor_styles:
+            style, _, _ = self.anchor_styles[anchor]
+            if style != "stroke":
+                stroke_width = 0
+
+        origin_x, origin_y = self.origin
+        self.draw.text(
+            (x - origin_x, y - origin_y),
+            text,
+            fill=self.text_color,
+            font=font,
+            stroke_width=stroke_width,
+            stroke_fill=self.stroke_color,
+        )
+
+    def get_metadata(self):
+        """
+        The metadata is normally read once per file by the image index.
+        It is read from the original file here (not from self.img, which
+        has lost it when it was resized) when it was not passed in.
+        """
+        if self.metadata is None:
+            self.metadata = read_metadata(self.img_path)
+        return self.metadata
+
+    @timed("ImageModification.calculate_base_font_size")
+    def calculate_base_font_size(self):
+        logger.debug("calculating base font size")
+        font_size = font_cache.get_base_font_size(
+            self.font_path, self.general_text_height)
+        return self.get_font(font_size=font_size), font_size
+
+    @staticmethod
+    def get_text_size(ink, font):
+        return font_cache.get_text_size(ink, font)
 
     def get_font(self, font_size):
-        return ImageFont.truetype(self.font_path, font_size)
+        return font_cache.get_font(self.font_path, font_size)
 
+    @timed("ImageModification.add_grid")
     def add_grid(self):
         logger.debug("Creating grid")
         for i in range(1, self.grid_size + 1):
@@ -121,45 +392,33 @@ class ImageModification:
                 width=5,
             )
 
+    @timed("ImageModification.add_current_date")
     def add_current_date(self):
         logger.debug("adding current date")
-        current_date = date.today().strftime(self.current_date_format)
+        current_date = self.get_now().strftime(self.current_date_format)
         width, height = self.get_text_size(current_date, self.base_font)
         x = self.right_border - width
         y = self.bottom_border - height
 
-        self.draw.text(
-            (x, y),
-            current_date,
-            fill=self.text_color,
-            font=self.base_font,
-            stroke_width=self.stroke_width,
-            stroke_fill=self.stroke_color,
-        )
+        self.draw_text((x, y), current_date, self.base_font, "right")
 
         return x
 
+    @timed("ImageModification.add_current_time")
     def add_current_time(self):
         logger.debug("adding current time")
-        current_time = time.strftime(self.current_time_format)
+        current_time = self.get_now().strftime(self.current_time_format)
 
         font = self.get_font(self.base_font_size * 2)
         width, height = self.get_text_size(current_time, font)
         x = self.right_border - width
         y = self.bottom_border - self.general_text_height - height
-        self.draw.text(
-            (x, y),
-            current_time,
-            fill=self.text_color,
-            font=font,
-            stroke_width=self.stroke_width,
-            stroke_fill=self.stroke_color,
-        )
+        self.draw_text((x, y), current_time, font, "right")
 
+    @timed("ImageModification.add_img_title")
     def add_img_title(self):
         logger.debug("adding img title")
-        exif = self.img.getexif()
-        img_title = (exif.get(270, "").strip())
+        img_title = self.get_metadata().title
 
         font = self.get_font(int(self.base_font_size * 1.5))
         width, height = self.get_text_size(img_title, font)
@@ -167,115 +426,60 @@ class ImageModification:
         x = self.img_width / 2 - width / 2
         y = self.bottom_border - height
 
-        self.draw.text(
-            (x, y),
-            img_title,
-            fill=self.text_color,
-            font=font,
-            stroke_width=self.stroke_width,
-            stroke_fill=self.stroke_color,
-        )
+        self.draw_text((x, y), img_title, font, "center")
 
+    @timed("ImageModification.add_img_creation_date")
     def add_img_creation_date(self):
         logger.debug("adding image creation date")
-        exif = self.img.getexif()
-        creation_time = exif.get(36867)
-
-        # noinspection PyBroadException
-        try:
-            if creation_time is None:
-                creation_time = self.img.info["Creation Time"]
-            try:
-                date_obj = datetime.strptime(
-                    creation_time,
-                    "%a %d %b %Y %H:%M:%S %z"
-                )
-            except ValueError:
-                logger.info(
-                    f"creation date is not in expect place: {self.img_path}")
-                creation_date = creation_time.split(" ")[0]
-                creation_date = creation_date.split(":")
-                creation_date.reverse()
-                cre_date = "/".join(creation_date)
-                date_obj = datetime.strptime(cre_date, "%d/%m/%Y")
-            except KeyError:
-                logger.warning(f"img has not creation time: {self.img_path}")
-                return
-
-            formatted_date = date_obj.strftime(self.creation_date_format)
-        except BaseException as e:
-            logger.warning(f"Could not get creation date for: {self.img_path}")
-            logger.exception(e)
+        creation_date = self.get_metadata().creation_date
+        if creation_date is None:
             return
 
+        formatted_date = creation_date.strftime(self.creation_date_format)
+
         x = self.left_border
         y = self.bottom_border - self.general_text_height
 
-        self.draw.text(
-            (x, y),
-            formatted_date,
-            fill=self.text_color,
-            font=self.base_font,
-            stroke_width=self.stroke_width,
-            stroke_fill=self.stroke_color,
-        )
+        self.draw_text((x, y), formatted_date, self.base_font, "left")
 
+    @timed("ImageModification.add_img_location")
     def add_img_location(self):
         logger.debug("adding img location")
-        path = os.path.dirname(self.img_path)
-        location = os.path.basename(path)
-
-        split_location = location.split("_")
-        clean_words = []
-        for word in split_location:
-            try:
-                int(word)
-            except ValueError:
-                clean_words.append(word)
-
-        clean_location = " ".join(clean_words)
+        if self.location is None:
+            clean_location = get_img_location(self.img_path)
+        else:
+            clean_location = self.location
         _, height = self.get_text_size(clean_location, self.base_font)
         x = self.left_border
         y = self.bottom_border - self.general_text_height - height
 
-        self.draw.text(
-            (x, y),
-            clean_location,
-            fill=self.text_color,
-            font=self.base_font,
-            stroke_width=self.stroke_width,
-            stroke_fill=self.stroke_color,
-        )
+        self.draw_text((x, y), clean_location, self.base_font, "left")
 
+    @timed("ImageModification.add_weather")
     def add_weather(self, current_date_x):
         logger.debug("adding weather")
         if self.weather_icon is None:
             return
 
         # Add weather icon to image
-        weather_icon = WEATHER_ICONS.get(self.weather_icon, None)
-        minimum_icon_height = self.general_text_height * 2
-
-        if minimum_icon_height < 32:
-            icon_path = f"./icons/32px/{weather_icon}.png"
-        elif minimum_icon_height < 64:
-            icon_path = f"./icons/64px/{weather_icon}.png"
-        elif minimum_icon_height < 128:
-            icon_path = f"./icons/128px/{weather_icon}.png"
-        elif minimum_icon_height < 256:
-            icon_path = f"./icons/256px/{weather_icon}.png"
-        else:
-            icon_path = f"./icons/512px/{weather_icon}.png"
-        icon_img = Image.open(icon_path)
+        icon_img = get_weather_icon(
+            self.weather_icon, self.general_text_height * 2)
+        if icon_img is None:
+            return
         icon_width, icon_height = icon_img.size
 
         x = current_date_x - self.grid_cell_width - icon_width
         y = self.bottom_border - icon_height
 
-        self.img.paste(icon_img, box=(x, y), mask=icon_img)
+        self.mark_dirty((x, y, x + icon_width, y + icon_height), "right")
+        if not self.measuring:
+            origin_x, origin_y = self.origin
+            self.canvas.paste(icon_img, box=(x - origin_x, y - origin_y),
+                              mask=icon_img)
 
         return x
 
+    @timed("ImageModification.add_temperature")
     def add_temperature(self, weather_x):
         logger.debug("adding temperature")
         if self.temp is None or weather_x is None:
@@ -286,11 +490,4 @@ class ImageModification:
         x = weather_x - self.grid_cell_width - width
         y = self.bottom_border - height
 
-        self.draw.text(
-            (x, y),
-            self.temp,
-            fill=TEXT_COLOR,
-            font=self.base_font,
-            stroke_width=self.stroke_width,
-            stroke_fill=self.stroke_color,
-        )
+        self.draw_text((x, y), self.temp, self.base_font, "right")
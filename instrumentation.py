@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import logging
+import threading
+import functools
+from bisect import bisect_left
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+
+from process_stats import current_rss, peak_rss, process_age
+from globals import STATS_DIR, STATS_WINDOW, STATS_FILE_COUNT
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets, in ms
+BUCKET_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                    10000)
+
+
+class RollingHistogram:
+    """
+    Counts of every value ever added in fixed buckets (if bucket bounds
+    are given), plus the last "window" values to work out recent
+    percentiles from.
+    """
+
+    def __init__(self, bounds=None, window=STATS_WINDOW):
+        self.bounds = bounds
+        self.recent = deque(maxlen=window)
+        self.buckets = [0] * (len(bounds) + 1) if bounds else []
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        self.recent.append(value)
+        if self.bounds:
+            self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def summary(self):
+        recent = sorted(self.recent)
+        summary = {
+            "count": self.count,
+            "mean": round(self.total / self.count, 3) if self.count else 0,
+        }
+        for percent in (50, 90, 99):
+            if recent:
+                rank = max(1, int(round(percent / 100 * len(recent))))
+                summary[f"p{percent}"] = round(recent[rank - 1], 3)
+        if recent:
+            summary["min"] = round(recent[0], 3)
+            summary["max"] = round(recent[-1], 3)
+
+        if self.bounds:
+            bounds = [f"<={bound}" for bound in self.bounds] + [
+                f">{self.bounds[-1]}"]
+            summary["buckets"] = OrderedDict(
+                (bound, count) for bound, count in zip(bounds, self.buckets)
+                if count
+            )
+        return summary
+
+
+class Stats:
+    """
+    Process wide timings (in ms), counters and values of the running
+    slideshow.  Recording is cheap enough to leave on all the time, the
+    numbers are only written out by a StatsWriter.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.timings = OrderedDict()
+        self.values = OrderedDict()
+        self.counters = OrderedDict()
+        # name -> function returning extra stats, e.g. lru_cache info
+        self.sources = OrderedDict()
+
+    def record(self, name, seconds):
+        with self._lock:
+            histogram = self.timings.get(name)
+            if histogram is None:
+                histogram = self.timings[name] = RollingHistogram(
+                    BUCKET_BOUNDS_MS)
+            histogram.add(seconds * 1000)
+
+    def record_value(self, name, value):
+        with self._lock:
+            histogram = self.values.get(name)
+            if histogram is None:
+                histogram = self.values[name] = RollingHistogram()
+            histogram.add(value)
+
+    def increment(self, name, count=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def add_source(self, name, source):
+        self.sources[name] = source
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "uptime": round(time.time() - self.started),
+                "rss": current_rss(),
+                "peak_rss": peak_rss(),
+                "timings_ms": OrderedDict(
+                    (name, histogram.summary())
+                    for name, histogram in self.timings.items()
+                ),
+                "values": OrderedDict(
+                    (name, histogram.summary())
+                    for name, histogram in self.values.items()
+                ),
+                "counters": OrderedDict(self.counters),
+            }
+
+        counters = snapshot["counters"]
+        hit_rates = OrderedDict()
+        for counter, hits in counters.items():
+            if counter.endswith(".hit"):
+                name = counter[:-len(".hit")]
+                misses = counters.get(f"{name}.miss", 0)
+                hit_rates[name] = round(hits / (hits + misses), 4)
+        snapshot["hit_rates"] = hit_rates
+
+        for name, source in self.sources.items():
+            snapshot[name] = source()
+        return snapshot
+
+
+stats = Stats()
+
+
+def timed(name):
+    """
+    Decorator recording how long every call of the function takes.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats.record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class StartupTimer:
+    """
+    When each phase of starting up finished, in seconds since the process
+    was started (or, where that cannot be read, since this was created).
+    Phases can finish on any thread, in any order.
+    """
+
+    def __init__(self):
+        now = time.perf_counter()
+        age = process_age()
+        self.started = now - age if age is not None else now
+        self.phases = OrderedDict()
+
+    def mark(self, phase):
+        seconds = time.perf_counter() - self.started
+        self.phases[phase] = seconds
+        stats.record_value(f"startup.{phase}_s", seconds)
+        logger.debug(f"startup: {phase} after {seconds:.3f}s")
+
+    def summary(self):
+        return ", ".join(f"{phase} {seconds:.2f}s"
+                         for phase, seconds in self.phases.items())
+
+
+class StatsWriter:
+    """
+    Writes stats snapshots as json to "stats_dir".  There is one file per
+    hour (overwritten with the latest snapshot during that hour) and only
+    the newest "file_count" files are kept.
+    """
+
+    def __init__(self, stats_dir=STATS_DIR, file_count=STATS_FILE_COUNT):
+        self.stats_dir = stats_dir
+        self.file_count = file_count
+        if not os.path.exists(self.stats_dir):
+            os.makedirs(self.stats_dir)
+
+    def write(self):
+        file_name = f"stats_{time.strftime('%Y-%m-%d_%H')}.json"
+        path = os.path.join(self.stats_dir, file_name)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w") as stats_file:
+                json.dump(stats.snapshot(), stats_file, indent=2)
+            os.replace(tmp_path, path)
+        except OSError as error:
+            logger.warning(f"Could not write stats: {error}")
+            return
+        self.rotate()
+
+    def rotate(self):
+        stats_files = sorted(
+            file_name for file_name in os.listdir(self.stats_dir)
+            if file_name.startswith("stats_") and file_name.endswith(".json")
+        )
+        for file_name in stats_files[:-self.file_count]:
+            logger.debug(f"removing old stats: {file_name}")
+            os.remove(os.path.join(self.stats_dir, file_name))
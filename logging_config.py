@@ -51,6 +51,14 @@ def setup_logger():
                 "handlers": ["console"],
                 "level": globals.LOG_LEVEL,
             },
+            "render_frames": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL,
+            },
+            "soak_test": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL,
+            },
             "slideshow": {
                 "handlers": ["console"],
                 "level": globals.LOG_LEVEL,
@@ -59,6 +67,78 @@ def setup_logger():
                 "handlers": ["console"],
                 "level": globals.LOG_LEVEL
             },
+            "frame_pipeline": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
+            "frame_cache": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
+            "image_index": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
+            "image_metadata": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
+            "frame_server": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
+            "frame_client": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
+            "subject_detection": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
+            "font_cache": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
+            "weather_icons": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
+            "weather": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
+            "shuffle": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
+            "scheduler": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
+            "duplicates": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
+            "file_watcher": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
+            "transitions": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
+            "throttle": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
+            "display": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
+            "instrumentation": {
+                "handlers": ["console"],
+                "level": globals.LOG_LEVEL
+            },
         },
         "root": {"handlers": ["file"], "level": "WARNING"},
     }
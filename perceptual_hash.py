@@ -0,0 +1,164 @@
+from PIL import Image
+
+# the hash has HASH_SIZE * HASH_SIZE bits
+HASH_SIZE = 8
+
+
+def dhash(image_path):
+    """
+    The difference hash of an image: it is shrunk to 9x8 grey pixels and
+    every bit says whether a pixel is brighter than the one to its right.
+    Resized, recompressed or slightly edited copies of a photo (and burst
+    shots) get the same or a very similar hash.  JPEGs are only decoded
+    at 1/8 of their size.
+    """
+    with Image.open(image_path) as image:
+        image.draft("L", ((HASH_SIZE + 1) * 8, HASH_SIZE * 8))
+        gray = image.convert("L")
+    small = gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BOX)
+    gray.close()
+    pixels = list(small.getdata())
+    small.close()
+
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for column in range(HASH_SIZE):
+            value = (value << 1) | (
+                pixels[offset + column] > pixels[offset + column + 1])
+    return value
+
+
+def hash_image(image_path):
+    """
+    dhash() for a worker process, None if the image cannot be read.
+    """
+    try:
+        return dhash(image_path)
+    except OSError:
+        return None
+
+
+def hamming_distance(first, second):
+    return bin(first ^ second).count("1")
+
+
+class BKTree:
+    """
+    Hashes in a Burkhard-Keller tree, to find all hashes within a
+    Hamming distance of another one without comparing it with every
+    hash.  The children of a node are keyed by their distance to it, and
+    by the triangle inequality only the children at a distance of
+    d - max_distance to d + max_distance from the node can have matches.
+    """
+
+    def __init__(self):
+        # (hash, key, {distance: child node})
+        self.root = None
+
+    def add(self, value, key):
+        """
+        Returns False if the hash is already in the tree, under another
+        key.
+        """
+        if self.root is None:
+            self.root = (value, key, {})
+            return True
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                return False
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, key, {})
+                return True
+            node = child
+
+    def search(self, value, max_distance):
+        """
+        The keys of the hashes within max_distance of "value".  Only the
+        first key added for each hash is returned.
+        """
+        keys = []
+        # a stack instead of recursion
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_value, key, children = stack.pop()
+            distance = hamming_distance(value, node_value)
+            if distance <= max_distance:
+                keys.append(key)
+            for child_distance, child in children.items():
+                if abs(child_distance - distance) <= max_distance:
+                    stack.append(child)
+        return keys
+
+
+class NearDuplicates:
+    """
+    Clusters of near duplicates that hashes can be added to one at a
+    time: keys whose hashes are within max_distance of each other,
+    directly or through other keys in the cluster.  The hashes are kept in
+    a BKTree and the clusters in a union-find, so adding a hash only
+    searches the tree for it.  Keys are never taken out again.
+    """
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        self.tree = BKTree()
+        self.parents = {}
+        # root key -> number of keys in its cluster
+        self.sizes = {}
+
+    def find(self, key):
+        parents = self.parents
+        while parents[key] != key:
+            # path halving keeps the trees flat
+            parents[key] = parents[parents[key]]
+            key = parents[key]
+        return key
+
+    def add(self, key, value):
+        """
+        Add a key's hash.  A key added again (e.g. its file changed) keeps
+        its old near duplicates as well.
+        """
+        if key not in self.parents:
+            self.parents[key] = key
+            self.sizes[key] = 1
+        for other in self.tree.search(value, self.max_distance):
+            root, other_root = self.find(key), self.find(other)
+            if root != other_root:
+                self.parents[root] = other_root
+                self.sizes[other_root] += self.sizes.pop(root)
+        self.tree.add(value, key)
+
+    def cluster(self, key):
+        """
+        The cluster of a key (one of its keys), or None if the key has no
+        near duplicates.
+        """
+        if key not in self.parents:
+            return None
+        root = self.find(key)
+        return root if self.sizes[root] > 1 else None
+
+    def clusters(self):
+        """
+        {key: cluster} for the keys that have at least one near duplicate.
+        """
+        roots = {key: self.find(key) for key in self.parents}
+        return {key: root for key, root in roots.items()
+                if self.sizes[root] > 1}
+
+
+def find_clusters(hashes, max_distance):
+    """
+    Groups the (key, hash) pairs into clusters of near duplicates, see
+    NearDuplicates.  Returns {key: cluster} for the keys that have at
+    least one near duplicate, the cluster being one of its keys.
+    """
+    duplicates = NearDuplicates(max_distance)
+    for key, value in hashes:
+        duplicates.add(key, value)
+    return duplicates.clusters()
@@ -0,0 +1,93 @@
+import os
+
+from globals import ON_LINUX
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROC_STATUS = "/proc/self/status"
+PROC_CLEAR_REFS = "/proc/self/clear_refs"
+PROC_STAT = "/proc/self/stat"
+PROC_UPTIME = "/proc/uptime"
+
+
+def _read_proc_status(field):
+    # values in /proc/self/status are reported in kB
+    with open(PROC_STATUS) as status:
+        for line in status:
+            if line.startswith(field):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def current_rss():
+    """
+    Resident set size of this process in bytes, or None if it cannot be
+    read on this platform.
+    """
+    if ON_LINUX:
+        try:
+            return _read_proc_status("VmRSS:")
+        except OSError:
+            pass
+    return None
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes since it started, or
+    since the last successful call to reset_peak_rss().
+    """
+    if ON_LINUX:
+        try:
+            return _read_proc_status("VmHWM:")
+        except OSError:
+            pass
+    if resource is not None:
+        # ru_maxrss is in kB on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return None
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS high water mark so the next peak_rss() call only
+    covers the work done in between.  Returns False when the kernel does
+    not support it, in which case peak_rss() keeps the lifetime peak.
+    """
+    if not ON_LINUX:
+        return False
+    try:
+        with open(PROC_CLEAR_REFS, "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def process_age():
+    """
+    Seconds since this process was started (to within a clock tick), or
+    None if it cannot be read on this platform.
+    """
+    if ON_LINUX:
+        try:
+            with open(PROC_STAT) as stat:
+                # the command name in brackets may contain spaces, the
+                # start time is the 22nd field
+                fields = stat.read().rsplit(")", 1)[1].split()
+            with open(PROC_UPTIME) as uptime:
+                seconds_since_boot = float(uptime.read().split()[0])
+            return (seconds_since_boot -
+                    int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+        except (OSError, ValueError, IndexError):
+            pass
+    return None
+
+
+def format_bytes(num_bytes):
+    if num_bytes is None:
+        return "n/a"
+    return f"{num_bytes / (1024 * 1024):.1f}MB"
@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import random
+import logging
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+from logging_config import setup_logger
+from frame_cache import FrameCache
+from frame_pipeline import prepare_frame, LayeredFrame
+from image_index import ImageIndex
+from process_stats import peak_rss, reset_peak_rss, format_bytes
+from throttle import lower_priority
+import globals
+
+parser = ArgumentParser(
+    description="Render display ready frames without a display, e.g. to "
+                "fill the frame cache overnight."
+)
+parser.add_argument(
+    "image_directory",
+    type=str,
+    help="relative or absolute path to the image directory",
+    nargs="?",
+    default=globals.IMG_DIR
+)
+parser.add_argument(
+    "output_directory",
+    type=str,
+    help="where the frames and manifest.json are written",
+    nargs="?",
+    default=globals.RENDER_OUTPUT_DIR
+)
+parser.add_argument(
+    "--width",
+    type=int,
+    default=globals.RENDER_SCREEN_SIZE[0]
+)
+parser.add_argument(
+    "--height",
+    type=int,
+    default=globals.RENDER_SCREEN_SIZE[1]
+)
+parser.add_argument(
+    "--sample",
+    type=int,
+    help="only render this many randomly chosen images",
+    default=None
+)
+parser.add_argument(
+    "--seed",
+    type=int,
+    help="seed for choosing the --sample images",
+    default=None
+)
+parser.add_argument(
+    "--processes",
+    type=int,
+    help="number of worker processes (default: one per core)",
+    default=os.cpu_count()
+)
+parser.add_argument(
+    "--clock",
+    action="store_true",
+    help="also draw the current time and date, as the slideshow would"
+)
+parser.add_argument(
+    "--warm_cache",
+    action="store_true",
+    help="store the frames in the frame cache instead of writing them to "
+         "the output directory"
+)
+parser.add_argument(
+    "--paths",
+    type=str,
+    help="only render the images listed in this file, one path per line",
+    default=None
+)
+parser.add_argument(
+    "--idle",
+    action="store_true",
+    help="run at the lowest CPU and I/O priority, e.g. next to the "
+         "slideshow"
+)
+parser.add_argument(
+    "--FIT_MODE",
+    dest="FIT_MODE",
+    help="stretch the photos to the screen, fit them in with black bars or "
+         "fill the screen, cropping around the subject",
+    choices=["stretch", "fit", "fill"],
+    default=globals.FIT_MODE
+)
+parser.add_argument(
+    "--TEXT_STYLE",
+    dest="TEXT_STYLE",
+    help="outline all text, or only where the photo behind it is busy",
+    choices=["stroke", "adaptive"],
+    default=globals.TEXT_STYLE
+)
+parser.add_argument(
+    "-l",
+    "--LOG_LEVEL",
+    dest="LOG_LEVEL",
+    type=str,
+    default=globals.LOG_LEVEL
+)
+
+logger = logging.getLogger("render_frames")
+
+# set up once in every worker process by init_worker()
+worker = {}
+
+
+def init_worker(img_dir, output_dir, screen_size, clock, warm_cache):
+    worker["img_dir"] = img_dir
+    worker["output_dir"] = output_dir
+    worker["screen_size"] = screen_size
+    worker["clock"] = clock
+    worker["frame_cache"] = FrameCache() if warm_cache else None
+    worker["image_index"] = ImageIndex(img_dir)
+
+
+def get_output_path(image_path):
+    relative_path = os.path.relpath(image_path, worker["img_dir"])
+    output_path = os.path.join(worker["output_dir"], relative_path)
+    return os.path.splitext(output_path)[0] + ".jpg"
+
+
+def render_image(image_path):
+    """
+    Runs in a worker process.  Returns the manifest entry of the image.
+    """
+    start = time.perf_counter()
+    entry = {"source": image_path}
+    # a worker renders one image at a time, so the peak is this image's
+    reset_peak_rss()
+    # noinspection PyBroadException
+    try:
+        frame = prepare_frame(image_path, worker["screen_size"],
+                              worker["frame_cache"], worker["image_index"])
+        if worker["clock"]:
+            LayeredFrame(image_path, frame).draw_dynamic_layer(None, None)
+
+        if worker["frame_cache"] is None:
+            output_path = get_output_path(image_path)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            frame.save(output_path, "JPEG",
+                       quality=globals.FRAME_CACHE_QUALITY)
+            entry["output"] = output_path
+    except Exception as e:
+        logger.warning(f"Could not render: {image_path}")
+        logger.exception(e)
+        entry["error"] = repr(e)
+
+    entry["seconds"] = round(time.perf_counter() - start, 4)
+    entry["worker_peak_rss"] = peak_rss()
+    return entry
+
+
+def get_image_paths(img_dir, sample=None, seed=None):
+    image_index = ImageIndex(img_dir)
+    image_paths = image_index.refresh()
+    if globals.FIT_MODE == "fill":
+        # so the frames are cropped around the subject, not the centre
+        image_index.extract_missing_subjects()
+    image_index.close()
+
+    if sample is not None and sample < len(image_paths):
+        image_paths = random.Random(seed).sample(image_paths, sample)
+    return image_paths
+
+
+def read_image_paths(list_path):
+    with open(list_path) as list_file:
+        return [line.rstrip("\n") for line in list_file if line.strip()]
+
+
+def main(args):
+    if args.idle:
+        # the worker processes inherit it
+        lower_priority()
+    screen_size = (args.width, args.height)
+    if args.paths is not None:
+        image_paths = read_image_paths(args.paths)
+    else:
+        image_paths = get_image_paths(args.image_directory, args.sample,
+                                      args.seed)
+    logger.info(f"Rendering {len(image_paths)} images at {screen_size} "
+                f"with {args.processes} processes")
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+            max_workers=args.processes,
+            initializer=init_worker,
+            initargs=(args.image_directory, args.output_directory,
+                      screen_size, args.clock, args.warm_cache)
+    ) as executor:
+        entries = list(executor.map(render_image, image_paths, chunksize=4))
+    seconds = time.perf_counter() - start
+    if args.warm_cache:
+        # the workers only rescan the cache every so often, evict down to
+        # FRAME_CACHE_MAX_BYTES with all of their frames counted
+        FrameCache()
+
+    rendered = sum(1 for entry in entries if "error" not in entry)
+    worker_peaks = [entry["worker_peak_rss"] for entry in entries
+                    if entry["worker_peak_rss"] is not None]
+    worker_peak_rss = max(worker_peaks) if worker_peaks else None
+    images_per_second = rendered / seconds if seconds else 0.0
+
+    manifest = {
+        "image_directory": args.image_directory,
+        "screen_size": screen_size,
+        "processes": args.processes,
+        "clock": args.clock,
+        "warm_cache": args.warm_cache,
+        "rendered": rendered,
+        "failed": len(entries) - rendered,
+        "seconds": round(seconds, 3),
+        "images_per_second": round(images_per_second, 3),
+        "peak_rss": peak_rss(),
+        "worker_peak_rss": worker_peak_rss,
+        "images": entries,
+    }
+    os.makedirs(args.output_directory, exist_ok=True)
+    manifest_path = os.path.join(args.output_directory, "manifest.json")
+    with open(manifest_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    print(f"Rendered {rendered} of {len(entries)} images in "
+          f"{seconds:.1f}s ({images_per_second:.2f} images/s), "
+          f"peak rss: {format_bytes(manifest['peak_rss'])}, "
+          f"worker peak rss: {format_bytes(worker_peak_rss)}")
+    print(f"Manifest: {manifest_path}")
+
+
+if __name__ == '__main__':
+    parsed_args = parser.parse_args()
+    globals.IMG_DIR = parsed_args.image_directory
+    globals.LOG_LEVEL = parsed_args.LOG_LEVEL
+    globals.FIT_MODE = parsed_args.FIT_MODE
+    globals.TEXT_STYLE = parsed_args.TEXT_STYLE
+
+    setup_logger()
+    main(parsed_args)
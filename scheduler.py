@@ -0,0 +1,357 @@
+import time
+import random
+import logging
+from array import array
+from datetime import date, timedelta
+
+from shuffle import ShuffledSlides, get_shuffle_state_path
+from duplicates import DuplicateSpacing
+import globals
+from globals import (
+    THIS_DAY_WEIGHT,
+    THIS_DAY_WINDOW,
+    RECENT_WEIGHT,
+    RECENT_DAYS,
+    SAME_DIRECTORY_RETRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class FenwickTree:
+    """
+    Integer weights with O(log n) updates and weighted sampling: find()
+    returns the index where a running total of the weights passes a
+    value.
+    """
+
+    def __init__(self, weights):
+        self.size = len(weights)
+        # 1-based, built in O(n) by pushing each node into its parent
+        self.tree = array("q", [0])
+        self.tree.extend(weights)
+        for index in range(1, self.size + 1):
+            parent = index + (index & -index)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[index]
+        self.total = sum(weights)
+        self.top_bit = 1 << self.size.bit_length() if self.size else 0
+
+    def prefix_sum(self, count):
+        """
+        The sum of the first "count" weights.
+        """
+        total = 0
+        while count > 0:
+            total += self.tree[count]
+            count -= count & -count
+        return total
+
+    def extend(self, weights):
+        """
+        Append weights, in O(log n) each.
+        """
+        for weight in weights:
+            self.size += 1
+            index = self.size
+            # node "index" holds the sum of the last (index & -index)
+            # weights up to and including this one
+            self.tree.append(weight + self.prefix_sum(index - 1) -
+                             self.prefix_sum(index - (index & -index)))
+            self.total += weight
+        self.top_bit = 1 << self.size.bit_length() if self.size else 0
+
+    def add(self, index, delta):
+        self.total += delta
+        index += 1
+        while index <= self.size:
+            self.tree[index] += delta
+            index += index & -index
+
+    def find(self, value):
+        """
+        The index i where weights[0:i] sums to at most "value" and
+        weights[0:i + 1] to more than it, for 0 <= value < total.
+        """
+        position = 0
+        bit = self.top_bit
+        while bit:
+            next_position = position + bit
+            if (next_position <= self.size and
+                    self.tree[next_position] <= value):
+                position = next_position
+                value -= self.tree[next_position]
+            bit >>= 1
+        return position
+
+
+def is_this_day(creation_date, today, window=THIS_DAY_WINDOW):
+    if creation_date is None or creation_date.year >= today.year:
+        return False
+    try:
+        same_day = creation_date.replace(year=today.year)
+    except ValueError:
+        # 29 February
+        same_day = date(today.year, 3, 1)
+    days = abs((same_day - today).days)
+    # e.g. 30 December is close to 2 January
+    return min(days, 365 - days) <= window
+
+
+def get_this_day_month_days(today, window=THIS_DAY_WINDOW):
+    """
+    The days of the year ("MM-DD") an image has to be created on for
+    is_this_day() to be true, give or take 29 February.
+    """
+    month_days = {(today + timedelta(days=days)).strftime("%m-%d")
+                  for days in range(-window, window + 1)}
+    if "02-28" in month_days or "03-01" in month_days:
+        month_days.add("02-29")
+    return month_days
+
+
+def get_weight(creation_date, added_at, today, now):
+    weight = 1
+    if is_this_day(creation_date, today):
+        weight *= THIS_DAY_WEIGHT
+    if added_at is not None and now - added_at < RECENT_DAYS * 24 * 3600:
+        weight *= RECENT_WEIGHT
+    return weight
+
+
+class WeightedSlides:
+    """
+    Endless iterator over the paths of the images in an ImageIndex, where
+    each image is chosen with a probability proportional to its weight
+    (see get_weight()).  Each image is shown once per pass: its weight is
+    set to 0 once it has been shown, and the pass ends when there is no
+    weight left.  The next slide is not from the same directory as the
+    last one, unless that is all there is left.
+
+    The weights are worked out from the index at the start of every pass.
+    After that only the weights that change are updated: those of new
+    images, of the images whose creation dates have just been read (see
+    ImageIndex.metadata_read_ids), of the "this day" images at midnight
+    and of the images that stop being recent.  Choosing a slide is
+    O(log n) with a Fenwick tree over the weights, indexed by image id.
+    Where a pass is up to is not kept between restarts.
+    """
+
+    def __init__(self, image_index, seed=None):
+        self.image_index = image_index
+        self.random = random.Random(seed)
+        self.position = 0
+        self.last_directory = None
+        # 1 for every image id shown this pass
+        self.shown = bytearray()
+        self.weights = None
+        self.tree = None
+        self.weights_date = None
+        # time.time() the recent images were last worked out
+        self.weights_time = None
+        # how many of image_index.metadata_read_ids have been weighted
+        self.metadata_read_count = 0
+        self.load_weights()
+
+    def load_weights(self):
+        start = time.perf_counter()
+        today = date.today()
+        now = time.time()
+        self.metadata_read_count = len(self.image_index.metadata_read_ids)
+        size = self.image_index.max_id() + 1
+        self.shown.extend(bytes(max(0, size - len(self.shown))))
+
+        weights = array("q", bytes(8 * size))
+        boosted = 0
+        for image_id, creation_date, added_at in (
+                self.image_index.iter_schedule_info()):
+            if not self.shown[image_id]:
+                weight = get_weight(creation_date, added_at, today, now)
+                weights[image_id] = weight
+                boosted += weight > 1
+
+        self.weights = weights
+        self.tree = FenwickTree(weights)
+        self.weights_date = today
+        self.weights_time = now
+        logger.info(
+            f"Slide weights worked out in "
+            f"{time.perf_counter() - start:.2f}s, {boosted} images boosted")
+
+    def _update_weights(self, rows, today, now):
+        """
+        Work out the weights of the (id, creation_date, added_at) "rows"
+        again, for the images that have not been shown this pass.
+        """
+        updated = 0
+        for image_id, creation_date, added_at in rows:
+            if image_id >= self.tree.size or self.shown[image_id]:
+                continue
+            weight = get_weight(creation_date, added_at, today, now)
+            if weight != self.weights[image_id]:
+                self.tree.add(image_id, weight - self.weights[image_id])
+                self.weights[image_id] = weight
+                updated += 1
+        return updated
+
+    def _update_changed_weights(self):
+        """
+        Called before choosing slides, catches up with the creation dates
+        read since and with the day changing.
+        """
+        today = date.today()
+        now = time.time()
+        read_ids = self.image_index.metadata_read_ids
+        read_count = len(read_ids)
+        if (today == self.weights_date and
+                read_count == self.metadata_read_count):
+            return
+
+        updated = 0
+        if read_count != self.metadata_read_count:
+            updated += self._update_weights(
+                self.image_index.iter_schedule_info(
+                    ids=read_ids[self.metadata_read_count:read_count]),
+                today, now)
+            self.metadata_read_count = read_count
+        if today != self.weights_date:
+            # the images of the last day are not "this day" any more
+            month_days = (get_this_day_month_days(today) |
+                          get_this_day_month_days(self.weights_date))
+            updated += self._update_weights(
+                self.image_index.iter_schedule_info(month_days=month_days),
+                today, now)
+            recent_seconds = RECENT_DAYS * 24 * 3600
+            updated += self._update_weights(
+                self.image_index.iter_schedule_info(added_between=(
+                    self.weights_time - recent_seconds,
+                    now - recent_seconds)),
+                today, now)
+            self.weights_date = today
+            self.weights_time = now
+        logger.debug(f"Updated the weights of {updated} slides")
+
+    def add_new_images(self):
+        """
+        Add the images added to the index since, in O(log n) each: new
+        images always have a higher id than the images in the index.
+        Removed images are skipped when they come up.
+        """
+        size = self.image_index.max_id() + 1
+        if size <= self.tree.size:
+            return
+        now = time.time()
+        new_weights = array("q", bytes(8 * (size - self.tree.size)))
+        for image_id, creation_date, added_at in (
+                self.image_index.iter_schedule_info(
+                    after_id=self.tree.size - 1)):
+            new_weights[image_id - self.tree.size] = get_weight(
+                creation_date, added_at, self.weights_date, now)
+
+        self.shown.extend(bytes(max(0, size - len(self.shown))))
+        self.weights.extend(new_weights)
+        self.tree.extend(new_weights)
+
+    def at_end_of_pass(self):
+        return self.tree.total == 0
+
+    def _new_pass(self):
+        logger.info("Starting a new pass through the images")
+        self.position = 0
+        self.shown = bytearray()
+        self.load_weights()
+
+    def _choose(self):
+        """
+        Choose the next image and take it out of this pass.  Returns its
+        id, ImageRecord (None if it is no longer in the index) and the
+        weight it had.
+        """
+        retries = SAME_DIRECTORY_RETRIES
+        while True:
+            image_id = self.tree.find(self.random.randrange(self.tree.total))
+            record = self.image_index.get_by_id(image_id)
+            if (record is not None and retries > 0 and
+                    record.directory == self.last_directory):
+                retries -= 1
+                continue
+
+            weight = self.weights[image_id]
+            self.tree.add(image_id, -weight)
+            self.weights[image_id] = 0
+            self.shown[image_id] = 1
+            return image_id, record, weight
+
+    def _next_record(self):
+        while True:
+            if self.tree.total == 0:
+                if self.image_index.max_id() == 0:
+                    raise StopIteration
+                self._new_pass()
+                if self.tree.total == 0:
+                    raise StopIteration
+
+            _, record, _ = self._choose()
+            if record is not None:
+                self.position += 1
+                self.last_directory = record.directory
+                return record
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._update_changed_weights()
+        return self._next_record().path
+
+    def peek(self, count):
+        """
+        The next "count" paths, without moving on.  Choosing with the
+        same random state and weights again gives the same slides.
+        """
+        self._update_changed_weights()
+        random_state = self.random.getstate()
+        last_directory = self.last_directory
+        taken = []
+        image_paths = []
+        try:
+            # the next pass is only worked out when it starts
+            while len(image_paths) < count and self.tree.total:
+                image_id, record, weight = self._choose()
+                taken.append((image_id, weight))
+                if record is not None:
+                    self.last_directory = record.directory
+                    image_paths.append(record.path)
+        finally:
+            for image_id, weight in taken:
+                self.tree.add(image_id, weight)
+                self.weights[image_id] = weight
+                self.shown[image_id] = 0
+            self.random.setstate(random_state)
+            self.last_directory = last_directory
+        return image_paths
+
+
+SCHEDULERS = {
+    "shuffle": ShuffledSlides,
+    "weighted": WeightedSlides,
+}
+
+
+def create_scheduler(name, image_index, client=None, clusters=None):
+    """
+    "client" is the name of the frame server client the slides are for,
+    each one has its own order.  With the DuplicateClusters of the index
+    the slides are spaced out or collapsed, see globals.DUPLICATES.
+    """
+    if name not in SCHEDULERS:
+        raise ValueError(f"Unknown scheduler: {name}, choose from: "
+                         f"{', '.join(SCHEDULERS)}")
+    if name == "shuffle":
+        slides = ShuffledSlides(image_index, get_shuffle_state_path(client))
+    else:
+        slides = SCHEDULERS[name](image_index)
+
+    if clusters is not None and globals.DUPLICATES != "show":
+        slides = DuplicateSpacing(slides, clusters, globals.DUPLICATES)
+    return slides
@@ -0,0 +1,236 @@
+import os
+import json
+import random
+import hashlib
+import logging
+
+from globals import SHUFFLE_STATE_PATH
+
+logger = logging.getLogger(__name__)
+
+FEISTEL_ROUNDS = 6
+
+
+def get_shuffle_state_path(client=None):
+    """
+    Every client of a frame server has its own shuffle state.
+    """
+    if client is None:
+        return SHUFFLE_STATE_PATH
+    root, extension = os.path.splitext(SHUFFLE_STATE_PATH)
+    return f"{root}_{client}{extension}"
+
+
+class FeistelPermutation:
+    """
+    A seeded random permutation of range(size) that is worked out one
+    position at a time, so shuffling a million images does not need a
+    list of a million entries.
+
+    A Feistel network shuffles the bits of numbers up to the next even
+    power of two (at most 4 times "size"), and numbers outside of
+    range(size) are put through it again ("cycle walking") until they
+    land inside it.
+    """
+
+    def __init__(self, size, seed):
+        self.size = size
+        self.seed = seed
+        self.half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+        self.half_mask = (1 << self.half_bits) - 1
+
+    def _round(self, round_number, value):
+        digest = hashlib.blake2b(
+            f"{self.seed}:{round_number}:{value}".encode("ascii"),
+            digest_size=8,
+        ).digest()
+        return int.from_bytes(digest, "little") & self.half_mask
+
+    def _encrypt(self, value):
+        left = value >> self.half_bits
+        right = value & self.half_mask
+        for round_number in range(FEISTEL_ROUNDS):
+            left, right = right, left ^ self._round(round_number, right)
+        return (left << self.half_bits) | right
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.size:
+            raise IndexError(position)
+        value = self._encrypt(position)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+    def __len__(self):
+        return self.size
+
+
+class ShuffleState:
+    """
+    Where a pass through the images is up to.  A pass shows the ids
+    0 to "bound" - 1 in the order of the permutation seeded by "seed",
+    skipping ids that no longer exist.  Images added during the pass
+    ("new_ids") are mixed into the rest of it at random.
+    """
+
+    def __init__(self, seed, bound, position=0, new_ids=(), max_id=None):
+        self.seed = seed
+        self.bound = bound
+        self.position = position
+        self.new_ids = list(new_ids)
+        self.max_id = bound - 1 if max_id is None else max_id
+        self.permutation = FeistelPermutation(bound, seed)
+
+    def copy(self):
+        return ShuffleState(self.seed, self.bound, self.position,
+                            self.new_ids, self.max_id)
+
+    def at_end(self):
+        return self.position >= self.bound and not self.new_ids
+
+    def next_pass(self, max_id):
+        # the seed of the next pass follows from this one, so peeking
+        # past the end of the pass gives the same slides as showing them
+        seed = random.Random(self.seed).getrandbits(63)
+        return ShuffleState(seed, max_id + 1)
+
+    def next_id(self):
+        """
+        Returns the next id and moves on to the one after it.
+        """
+        remaining = self.bound - self.position
+        if self.new_ids:
+            # each new id has the same chance as each remaining position
+            # of being next, so they end up spread over the rest of the
+            # pass
+            choice = random.Random(
+                f"{self.seed}:{self.position}:{len(self.new_ids)}"
+            ).randrange(remaining + len(self.new_ids))
+            if choice < len(self.new_ids):
+                return self.new_ids.pop(choice)
+
+        image_id = self.permutation[self.position]
+        self.position += 1
+        return image_id
+
+    def add_new_ids(self, max_id):
+        if max_id > self.max_id:
+            self.new_ids.extend(range(self.max_id + 1, max_id + 1))
+            self.max_id = max_id
+
+    def to_json(self):
+        return {"seed": self.seed, "bound": self.bound,
+                "position": self.position, "new_ids": self.new_ids,
+                "max_id": self.max_id}
+
+    @classmethod
+    def from_json(cls, state):
+        return cls(state["seed"], state["bound"], state["position"],
+                   state["new_ids"], state["max_id"])
+
+
+class ShuffledSlides:
+    """
+    Endless shuffled iterator over the paths of the images in an
+    ImageIndex.  Only the current position is kept in memory (and saved
+    to "state_path" after every slide), the paths are looked up by id in
+    the index as they are needed.
+
+    Every image is shown once per pass, a new pass is shuffled
+    differently.  Images added to the index during a pass (see
+    add_new_images()) are mixed into the rest of the pass without
+    reshuffling, images removed from it are skipped.
+    """
+
+    def __init__(self, image_index, state_path=SHUFFLE_STATE_PATH,
+                 seed=None):
+        self.image_index = image_index
+        self.state_path = state_path
+
+        self.state = self.load_state()
+        if self.state is None:
+            if seed is None:
+                seed = random.SystemRandom().getrandbits(63)
+            self.state = ShuffleState(seed, image_index.max_id() + 1)
+        self.add_new_images()
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as state_file:
+                state = ShuffleState.from_json(json.load(state_file))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            logger.warning(f"Could not read shuffle state: {error!r}")
+            return None
+
+        logger.info(f"Carrying on from slide {state.position} of "
+                    f"{state.bound}")
+        return state
+
+    def save_state(self):
+        state_dir = os.path.dirname(self.state_path)
+        if state_dir and not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+
+        tmp_path = f"{self.state_path}.tmp"
+        try:
+            with open(tmp_path, "w") as state_file:
+                json.dump(self.state.to_json(), state_file)
+            os.replace(tmp_path, self.state_path)
+        except OSError as error:
+            logger.warning(f"Could not save shuffle state: {error}")
+
+    def add_new_images(self):
+        """
+        Mix any images added to the index since the last call into the
+        rest of this pass.
+        """
+        self.state.add_new_ids(self.image_index.max_id())
+
+    def at_end_of_pass(self):
+        return self.state.at_end()
+
+    @property
+    def position(self):
+        return self.state.position
+
+    def _next_path(self, state):
+        """
+        Returns the next path and the state after it.  Ids without an
+        image are skipped, an empty index raises StopIteration.
+        """
+        while True:
+            if state.at_end():
+                max_id = self.image_index.max_id()
+                if max_id == 0:
+                    raise StopIteration
+                state = state.next_pass(max_id)
+
+            image_path = self.image_index.get_path(state.next_id())
+            if image_path is not None:
+                return image_path, state
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.state.at_end():
+            logger.info("Starting a new pass through the images")
+        image_path, self.state = self._next_path(self.state)
+        self.save_state()
+        return image_path
+
+    def peek(self, count):
+        """
+        The next "count" paths, without moving on.
+        """
+        state = self.state.copy()
+        image_paths = []
+        for _ in range(count):
+            try:
+                image_path, state = self._next_path(state)
+            except StopIteration:
+                break
+            image_paths.append(image_path)
+        return image_paths
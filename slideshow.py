@@ -1,160 +1,679 @@
 import os
-import requests
-import json
-import random
 import logging
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import tkinter as tk
-from PIL import Image, ImageTk
-from requests.adapters import HTTPAdapter
-
-from image_modification import ImageModification
-from globals import (
-    GET_WEATHER_DELAY,
-    API_URL_BASE, API_URL, EXCLUDE_DIRS,
-)
+
+from frame_pipeline import FramePrefetcher, LayeredFrame, prepare_frame
+from frame_cache import FrameCache
+from image_index import ImageIndex
+from scheduler import create_scheduler
+from duplicates import DuplicateClusters
+from file_watcher import create_watcher
+from weather import WeatherService
+from display import create_display
+from transitions import Crossfade
+from image_modification import warm_font_cache
+from throttle import RenderThrottle, CacheWarmer
+from instrumentation import stats, timed, StatsWriter, StartupTimer
+from process_stats import current_rss
 import globals
 
 logger = logging.getLogger(__name__)
 
+# how often to check if the weather has been fetched, in ms
+WEATHER_POLL_DELAY = 500
+# how often to check if the next slide is ready to be converted for the
+# display, in ms
+PREPARE_POLL_DELAY = 200
+# how often to check if the library has been loaded in the background
+# (with FAST_START), in ms
+LIBRARY_POLL_DELAY = 100
+# how often to check if the frame server has chosen the next slide, in ms
+REMOTE_SLIDE_POLL_DELAY = 100
 
-def get_weather_from_online():
-    try:
-        session = requests.Session()
-        session.mount(API_URL_BASE, HTTPAdapter(
-            max_retries=3))
-        response = session.get(API_URL)
-
-        if response.status_code == 200:
-            json_res = json.loads(response.content)
-            weather = json_res["hourly"][1]["weather"][0]
-            temp = json_res["hourly"][0]["temp"] - 273
-            temp = "{:2.0f}".format(temp)
-            temp = temp + u"\N{DEGREE SIGN}"
-        else:
-            logger.warning(f"Weather API response did not return 200 "
-                           f"instead: {response.status_code}")
-            weather, temp = None, None
-    except requests.exceptions.ConnectionError as error:
-        logger.error(error)
-        weather, temp = None, None
-
-    return weather, temp
-
-
-def get_path_of_original_images(img_dir=globals.IMG_DIR):
-    files = os.scandir(img_dir)
-    images = []
-    for file in files:
-        if file.is_dir():
-            if file.name in EXCLUDE_DIRS:
-                pass
-            else:
-                output = get_path_of_original_images(file.path)
-                images += output
-        elif file.name.endswith((".jpg", ".png")):
-            images.append(f"{img_dir}/{file.name}")
-        else:
-            logger.warning(f"Not supported file format: {file.path}")
 
-    return images
+def milliseconds_to_next_minute():
+    # a little late rather than early, so the new minute has started
+    return int((60 - time.time() % 60) * 1000) + 50
+
+
+def write_last_frame(image, path=globals.LAST_FRAME_PATH):
+    """
+    Save the frame shown at the next start (see FAST_START), meant for a
+    background thread.  As a PNG because Tk can load that without PIL,
+    compressed as little as possible as it is written over and over.
+    """
+    cache_dir = os.path.dirname(path)
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    tmp_path = f"{path}.tmp"
+    try:
+        with stats.timer("last_frame.write"):
+            image.save(tmp_path, "PNG", compress_level=1)
+        os.replace(tmp_path, path)
+    except OSError as error:
+        logger.warning(f"Could not save the last frame: {error}")
+    finally:
+        image.close()
 
 
 class Slideshow(tk.Tk):
-    def __init__(self):
+    def __init__(self, startup=None):
         # Setup main window
         super().__init__()
-        self.screen_width = self.winfo_screenwidth()
-        self.screen_height = self.winfo_screenheight()
-        self.overrideredirect(True)
-        self.geometry(f"{self.screen_width}x{self.screen_height}+0+0")
         self.bind('<Escape>', self.close)
+        self.startup = startup if startup is not None else StartupTimer()
 
-        # Setup Label widget (for displaying images)
-        self.picture_display = tk.Label(self)
-        self.picture_display.configure(bg="black")
-        self.picture_display.pack(expand=True, fill="both")
+        # Setup the display (for showing images).  With the tk display the
+        # photo and the clock / weather overlay are separate canvas items,
+        # so the overlay can be updated without converting the whole photo
+        # again.
+        self.display = create_display(globals.DISPLAY_BACKEND, self)
+        self.screen_width, self.screen_height = self.display.size
+        self.live_clock = globals.LIVE_CLOCK
+        self.current_frame = None
+        self.clock_job = None
+        self.prepare_job = None
+        self.last_frame_saved = None
 
-        # Extras
-        self.pictures = None
-        self.picture_index = 0
+        # Extras, set up by load_library()
+        self.frame_client = None
+        # the frame server is only talked to on this thread, the upcoming
+        # slides are asked for with the next one
+        self.remote_executor = None
+        self.remote_slide = None
+        self.remote_upcoming = []
+        self.remote_failures = 0
+        self.image_index = None
+        self.metadata_thread = None
         self.number_of_images = None
-        self.fetch_slideshow_files()
+        self.slides = None
+        self.watcher = None
+        self.duplicate_clusters = None
+        self.prefetcher = None
+        self.library_load = None
 
         self.weather = None
         self.weather_icon = None
         self.temp = None
+        self.weather_service = WeatherService()
+        self.weather_fetch = None
+        self.update_weather()
 
         self.delay = (globals.SLIDESHOW_DELAY * 1000)
+        # time.monotonic() the current slide was due, the next one is due
+        # "slide_delay" seconds after it however long showing this one
+        # took.  That is "delay", unless the throttle says otherwise.
+        self.slide_due = None
+        self.slide_delay = None
+        self.slide_job = None
+        self.throttle = RenderThrottle(globals.QUIET_HOURS,
+                                       globals.QUIET_SLIDESHOW_DELAY)
+        self.cache_warmer = None
+        self.cache_warmed = False
+
+        self.transition = None
+        self.transition_job = None
+        self.transition_executor = None
+        if (globals.TRANSITION_DURATION > 0 and
+                self.display.transitions):
+            self.transition_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="transition")
+
+        self.last_rss = None
+        self.stats_writer = None
+        if globals.STATS_ENABLED:
+            self.stats_writer = StatsWriter()
+
+        self.frame_cache = None
+        if globals.FRAME_CACHE_ENABLED:
+            self.frame_cache = FrameCache()
+
+        self.startup.mark("window")
+        if globals.FAST_START and self.display.startup_frame:
+            self.show_last_frame()
+
+    def show_last_frame(self):
+        """
+        Show the last frame of the previous run until the first slide is
+        ready.  It is on screen once Tk is idle for the first time.
+        """
+        if not os.path.exists(globals.LAST_FRAME_PATH):
+            return
+        try:
+            self.display.show_file(globals.LAST_FRAME_PATH)
+        except tk.TclError as error:
+            logger.warning(f"Could not show the last frame: {error}")
+            return
+        self.after_idle(self.startup.mark, "last_frame")
+
+    def save_last_frame(self):
+        now = time.monotonic()
+        if (self.last_frame_saved is not None and
+                now - self.last_frame_saved < globals.LAST_FRAME_INTERVAL):
+            return
+        self.last_frame_saved = now
+        threading.Thread(
+            target=write_last_frame,
+            args=(self.current_frame.copy_static_layer(),),
+            name="last_frame",
+            daemon=True,
+        ).start()
+
+    def load_library(self):
+        """
+        Connect to the frame server, or index the image directory and
+        start watching it.  This is the slow part of starting up with a
+        large library, with FAST_START it runs on a background thread
+        (it does not touch Tk) while the last frame is on screen.
+        """
+        # With a frame server the slides are chosen and rendered by the
+        # server, this is only a thin client.
+        if globals.FRAME_SERVER_URL is not None:
+            # only imported when it is needed, requests is slow to import
+            from frame_client import FrameClient, RemoteSlides
+
+            frame_client = FrameClient(globals.FRAME_SERVER_URL,
+                                       globals.FRAME_CLIENT_NAME)
+            if frame_client.is_available():
+                self.frame_client = frame_client
+            else:
+                logger.warning(f"Showing {globals.IMG_DIR} instead")
+                frame_client.close()
+
+        if self.frame_client is not None:
+            self.slides = RemoteSlides(
+                self.frame_client, (self.screen_width, self.screen_height))
+            self.remote_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="frame_server")
+            self.prefetcher = self.create_prefetcher(
+                self.frame_client.prepare_frame)
+            self.remote_upcoming = self.slides.peek(self.prefetcher.depth)
+        else:
+            self.load_local_library()
+        self.startup.mark("library")
+
+    def load_local_library(self):
+        self.image_index = ImageIndex(globals.IMG_DIR)
+        if globals.DUPLICATES != "show":
+            self.duplicate_clusters = DuplicateClusters(self.image_index)
+        self.fetch_slideshow_files()
+        if globals.WATCH_FILES:
+            self.watcher = create_watcher(self.image_index.directories())
+
+        self.prefetcher = self.create_prefetcher(prepare_frame)
+        # the frame server renders the frames of its clients
+        if globals.QUIET_HOURS is not None and self.frame_cache is not None:
+            self.cache_warmer = CacheWarmer(
+                (self.screen_width, self.screen_height))
+
+    def create_prefetcher(self, prepare):
+        return FramePrefetcher(
+            (self.screen_width, self.screen_height),
+            depth=globals.PREFETCH_DEPTH,
+            frame_cache=self.frame_cache,
+            image_index=self.image_index,
+            prepare=prepare,
+        )
+
+    def fall_back_to_local_library(self):
+        """
+        Stop asking the frame server, which has not answered
+        FRAME_SERVER_MAX_FAILURES times in a row, and show IMG_DIR instead.
+        The current slide stays up while the library is loaded in the
+        background.
+        """
+        logger.warning(f"Frame server {globals.FRAME_SERVER_URL} is not "
+                       f"answering, showing {globals.IMG_DIR} instead")
+        stats.increment("slides.local_fallback")
+        for job in (self.slide_job, self.prepare_job):
+            if job is not None:
+                self.after_cancel(job)
+        self.slide_job = None
+        self.prepare_job = None
+        self.remote_executor.shutdown(wait=False)
+        self.remote_executor = None
+        self.prefetcher.shutdown()
+        self.prefetcher = None
+        self.frame_client.close()
+        self.frame_client = None
+        self.slides = None
+
+        executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="startup")
+        self.library_load = executor.submit(self.load_local_library)
+        executor.shutdown(wait=False)
+        self.after(LIBRARY_POLL_DELAY, self.check_library)
 
     def get_weather(self):
         """
-        This method is set to run every "GET_WEATHER_DELAY" seconds.  It
-        will run in the background and should not affect the image
-        slideshow.  If the weather cannot be fetched, then it will retry
-        after 30 seconds.
+        This method is set to run every "GET_WEATHER_DELAY" seconds.  The
+        weather is fetched on a background thread so it does not affect
+        the image slideshow; check_weather() picks up the result.  If the
+        weather cannot be fetched, then it will retry after 30 seconds,
+        backing off for every failure in a row.
         """
         logger.info("fetching weather")
-        self.weather, self.temp = get_weather_from_online()
+        self.weather_fetch = self.weather_service.fetch_async()
+        self.after(WEATHER_POLL_DELAY, self.check_weather)
+
+    def check_weather(self):
+        if not self.weather_fetch.done():
+            self.after(WEATHER_POLL_DELAY, self.check_weather)
+            return
+
+        delay = self.weather_service.next_delay()
+        if self.weather_fetch.result():
+            stats.increment("weather.ok")
+        else:
+            stats.increment("weather.failed")
+            logger.warning(
+                f"Failed to get weather, retrying in {delay} seconds")
+        self.after(delay * 1000, self.get_weather)
+        self.weather_fetch = None
+        self.update_weather()
+
+    def update_weather(self):
+        """
+        Show the last good weather, as long as it has not expired.
+        """
+        self.weather, self.temp = self.weather_service.current()
         if self.weather is None:
-            logger.warning("Failed to get weather, retrying in 30 seconds")
-            self.after((30 * 1000), self.get_weather)
+            self.weather_icon = None
         else:
             self.weather_icon = self.weather["icon"]
-            self.after(GET_WEATHER_DELAY * 1000, self.get_weather)
         if self.temp is None:
             self.temp = ""
 
+        if self.live_clock and self.current_frame is not None:
+            self.show_overlay()
+
     def fetch_slideshow_files(self):
         logger.info("Building file list")
-        image_paths = get_path_of_original_images(globals.IMG_DIR)
-        self.number_of_images = len(image_paths)
+        self.number_of_images = self.image_index.update()
         logger.info(f"Found: {self.number_of_images} images")
-        random.shuffle(image_paths)
-        self.pictures = image_paths
+        if self.slides is None:
+            self.slides = create_scheduler(
+                globals.SCHEDULER, self.image_index,
+                clusters=self.duplicate_clusters)
+        else:
+            self.slides.add_new_images()
+        self.start_metadata_extraction()
+
+    def start_metadata_extraction(self):
+        """
+        Read the title and creation date (and for the "fill" fit mode find
+        the subject) of any new images in the background, so the prefetch
+        workers find them in the index.  New images are hashed to find
+        their near duplicates.
+        """
+        if (self.metadata_thread is not None and
+                self.metadata_thread.is_alive()):
+            return
+        self.metadata_thread = threading.Thread(
+            target=self.image_index.extract_missing_details,
+            args=(self.duplicate_clusters, globals.FIT_MODE == "fill"),
+            name="metadata",
+            daemon=True,
+        )
+        self.metadata_thread.start()
+
+    def check_files(self):
+        """
+        Apply the files added to or removed from the image directory
+        since the last check, so new photos are mixed into the current
+        pass straight away.
+        """
+        if self.watcher.apply(self.image_index):
+            self.number_of_images = self.image_index.count()
+            self.slides.add_new_images()
+            self.start_metadata_extraction()
+            self.prefetcher.fill(self.upcoming_slides())
+        self.after(globals.WATCH_CHECK_DELAY * 1000, self.check_files)
+
+    def write_stats(self):
+        self.stats_writer.write()
+        self.after(globals.STATS_INTERVAL * 1000, self.write_stats)
 
     def start_slideshow(self):
         logger.info("Starting Slideshow")
+        if self.stats_writer is not None:
+            self.after(globals.STATS_INTERVAL * 1000, self.write_stats)
         self.get_weather()
+        if not globals.FAST_START:
+            self.load_library()
+            self.show_first_slides()
+            return
+
+        # the fonts are loaded at the same time, for the first slide
+        startup_executor = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="startup")
+        startup_executor.submit(
+            warm_font_cache, (self.screen_width, self.screen_height))
+        self.library_load = startup_executor.submit(self.load_library)
+        startup_executor.shutdown(wait=False)
+        self.after(LIBRARY_POLL_DELAY, self.check_library)
+
+    def check_library(self):
+        if not self.library_load.done():
+            self.after(LIBRARY_POLL_DELAY, self.check_library)
+            return
+
+        error = self.library_load.exception()
+        self.library_load = None
+        if error is not None:
+            logger.error(f"Could not load the library: {error!r}")
+            self.close()
+            return
+        self.show_first_slides()
+
+    def show_first_slides(self):
+        self.prefetcher.fill(self.upcoming_slides())
+        if self.watcher is not None:
+            self.after(globals.WATCH_CHECK_DELAY * 1000, self.check_files)
         self.show_slides()
 
     def show_slides(self):
-        if self.number_of_images is not None:
-            if self.picture_index < self.number_of_images:
-                image_path = self.pictures[self.picture_index]
-                logger.info(
-                    f"fetching image {self.picture_index + 1}: {image_path}"
-                )
-                self.picture_index += 1
-            else:
-                logger.info("End of image path array")
-                self.fetch_slideshow_files()
-                image_path = self.pictures[0]
-                logger.info(f"fetching image 1: {image_path}")
-                self.picture_index = 1
+        self.schedule_next_slide()
+        self.show_next_slide()
+
+    def schedule_next_slide(self):
+        now = time.monotonic()
+        if self.slide_due is None:
+            self.slide_due = now
         else:
+            self.slide_due += self.slide_delay
+            if self.slide_due < now:
+                # far behind (e.g. the system was suspended), do not try to
+                # catch up
+                self.slide_due = now
+        self.throttle.check_temperature()
+        self.slide_delay = self.throttle.slide_delay(self.delay / 1000)
+        next_due = self.slide_due + self.slide_delay
+        self.slide_job = self.after(
+            max(0, int((next_due - now) * 1000)), self.show_slides)
+        if self.cache_warmer is not None:
+            self.warm_cache()
+
+    def warm_cache(self):
+        """
+        Once per quiet hours, render the next WARM_CACHE_SLIDES slides into
+        the frame cache in a separate low priority process, while the
+        slides change slowly (or not at all) anyway.  It is stopped if it
+        is still going when the quiet hours are over.
+        """
+        if not self.throttle.is_quiet():
+            self.cache_warmed = False
+            self.cache_warmer.stop()
+            return
+        if self.cache_warmed:
+            return
+        self.cache_warmed = True
+        try:
+            self.cache_warmer.start(
+                self.slides.peek(globals.WARM_CACHE_SLIDES))
+        except OSError as error:
+            logger.warning(f"Could not warm the frame cache: {error}")
+
+    @timed("show_slides")
+    def show_next_slide(self):
+        if self.slides is None:
             raise NotImplementedError("number of images is still None")
 
+        if self.frame_client is not None:
+            self.choose_remote_slide()
+            return
+
+        if self.slides.at_end_of_pass():
+            logger.info("End of this pass through the images")
+            # the watcher keeps the index up to date already
+            if self.watcher is None:
+                self.fetch_slideshow_files()
+        try:
+            image_path = next(self.slides)
+        except OSError as error:
+            # the frame server cannot be reached, try again next time
+            logger.warning(f"Could not get the next slide: {error}")
+            stats.increment("slides.failed")
+            return
+        logger.info(f"fetching image {self.slides.position}: {image_path}")
+
         self.show_image(image_path)
 
+    def choose_remote_slide(self):
+        """
+        Ask the frame server for the next slide on a background thread
+        (the timeouts are long, the server may be rendering it first) and
+        show it once it has answered.
+        """
+        if self.remote_slide is not None:
+            logger.warning("Still waiting for the frame server")
+            return
+        self.remote_slide = self.remote_executor.submit(
+            self.get_remote_slide, self.prefetcher.depth)
+        self.after(REMOTE_SLIDE_POLL_DELAY, self.check_remote_slide)
+
+    def get_remote_slide(self, count):
+        image_path = next(self.slides)
+        return image_path, self.slides.peek(count)
+
+    def check_remote_slide(self):
+        if self.remote_slide is None:
+            # fallen back to the local library
+            return
+        if not self.remote_slide.done():
+            self.after(REMOTE_SLIDE_POLL_DELAY, self.check_remote_slide)
+            return
+
+        error = self.remote_slide.exception()
+        if error is None:
+            image_path, self.remote_upcoming = self.remote_slide.result()
+        self.remote_slide = None
+        if error is not None:
+            # the frame server cannot be reached, try again next time
+            logger.warning(f"Could not get the next slide: {error}")
+            stats.increment("slides.failed")
+            self.remote_failures += 1
+            if self.remote_failures >= globals.FRAME_SERVER_MAX_FAILURES:
+                self.fall_back_to_local_library()
+            return
+        self.remote_failures = 0
+        logger.info(f"fetching image {self.slides.position}: {image_path}")
+        self.show_image(image_path)
+
+    def upcoming_slides(self):
+        if self.frame_client is not None:
+            # never asked for on the Tk thread, see choose_remote_slide()
+            return self.remote_upcoming
+        return self.slides.peek(self.prefetcher.depth)
+
+    @timed("show_image")
     def show_image(self, image_path):
-        logger.debug("Opening image")
-        original_image = Image.open(image_path)
-        resized = original_image.resize(
-            (self.screen_width, self.screen_height), Image.ANTIALIAS)
+        logger.debug("Fetching prepared image")
+        try:
+            frame = self.prefetcher.get(image_path)
+        except OSError as error:
+            # e.g. deleted since it was chosen
+            logger.warning(f"Skipping {image_path}: {error}")
+            stats.increment("slides.skipped")
+            self.after_idle(self.show_next_slide)
+            return
+        self.prefetcher.fill(self.upcoming_slides())
 
         logger.debug("Getting ready to modify image with data")
-        modified_img = ImageModification(resized, image_path,
-                                         self.weather_icon, self.temp)
-        modified_img.add_info_to_image()
+        previous_frame = self.current_frame
+        self.current_frame = LayeredFrame(image_path, frame)
+        if not self.separate_overlay():
+            self.current_frame.draw_dynamic_layer(
+                self.weather_icon, self.temp)
 
-        new_img = ImageTk.PhotoImage(resized)
+        if self.transition is not None:
+            # still fading into the last slide, e.g. after a skipped one
+            self.finish_transition()
+        # fading is the most work the CPU does, not when it is hot
+        if (self.transition_executor is not None and
+                previous_frame is not None and not self.throttle.hot):
+            self.start_transition(previous_frame)
+        else:
+            self.show_current_frame()
+            if previous_frame is not None:
+                previous_frame.close()
+        self.record_memory()
 
+    def show_current_frame(self):
         logger.debug("Pushing image to display")
-        self.picture_display.config(image=new_img)
-        self.picture_display.image = new_img
-        self.after(self.delay, self.show_slides)
+        with stats.timer("show_frame"):
+            self.display.show_frame(self.current_frame.image_path,
+                                    self.current_frame.image)
+        if "first_slide" not in self.startup.phases:
+            self.startup.mark("first_slide")
+            logger.info(f"Started up (seconds since launch): "
+                        f"{self.startup.summary()}")
+        if self.separate_overlay():
+            self.show_overlay()
+        elif self.live_clock:
+            self.schedule_clock()
+        self.prepare_upcoming()
+        if globals.FAST_START and self.display.startup_frame:
+            self.save_last_frame()
+
+    def start_transition(self, previous_frame):
+        self.transition = Crossfade(
+            previous_frame.image, self.current_frame.image,
+            self.transition_executor,
+            duration=globals.TRANSITION_DURATION)
+        # the worker may still be reading it
+        self.transition.future.add_done_callback(
+            lambda future: previous_frame.close())
+        self.transition_tick()
+
+    def transition_tick(self):
+        self.transition_job = None
+        if self.transition.done():
+            self.finish_transition()
+            return
+
+        frame = self.transition.next_frame()
+        if frame is not None:
+            with stats.timer("show_transition_frame"):
+                self.display.show_transition_frame(
+                    frame, self.transition.downscale)
+            frame.close()
+        self.transition_job = self.after(
+            self.transition.tick_delay(), self.transition_tick)
+
+    def finish_transition(self):
+        if self.transition_job is not None:
+            self.after_cancel(self.transition_job)
+            self.transition_job = None
+        self.transition.cancel()
+        self.transition = None
+        self.show_current_frame()
+
+    def separate_overlay(self):
+        return self.live_clock and self.display.separate_overlay
+
+    def prepare_upcoming(self):
+        """
+        Convert the upcoming slides for the display as soon as their
+        workers have finished, so showing them takes no time.  Only
+        possible when the clock is not drawn onto the photo itself.
+        """
+        if self.prepare_job is not None:
+            self.after_cancel(self.prepare_job)
+            self.prepare_job = None
+        if not self.separate_overlay():
+            return
+
+        for image_path in self.upcoming_slides():
+            if self.display.is_prepared(image_path):
+                continue
+            frame = self.prefetcher.get_if_ready(image_path)
+            if frame is None:
+                self.prepare_job = self.after(
+                    PREPARE_POLL_DELAY, self.prepare_upcoming)
+                return
+            self.display.prepare(image_path, frame)
+
+    def record_memory(self):
+        rss = current_rss()
+        if rss is None:
+            return
+        if self.last_rss is not None:
+            stats.record_value("rss_growth_per_slide_kb",
+                               (rss - self.last_rss) / 1024)
+        stats.record_value("rss_mb", rss / (1024 * 1024))
+        self.last_rss = rss
+
+    @timed("show_overlay")
+    def show_overlay(self):
+        """
+        Draw the clock, date and weather of the current slide.  This is
+        redrawn at the start of every minute (and whenever the weather
+        changes).  On the tk display it is a small separate image on top
+        of the photo, the other displays are only sent the part of the
+        frame that changed.
+        """
+        if self.separate_overlay():
+            region, box = self.current_frame.render_dynamic_layer(
+                self.weather_icon, self.temp)
+            self.display.show_overlay(region, box)
+        else:
+            # drawn onto the frame, the display is sent everything that
+            # changed: the old and the new clock
+            old_box = self.current_frame.dynamic_box
+            region, box = self.current_frame.draw_dynamic_layer(
+                self.weather_icon, self.temp)
+            if old_box is not None:
+                box = (min(box[0], old_box[0]), min(box[1], old_box[1]),
+                       max(box[2], old_box[2]), max(box[3], old_box[3]))
+            self.display.update_region(self.current_frame.image, box)
+        region.close()
+        self.schedule_clock()
+
+    def schedule_clock(self):
+        if self.clock_job is not None:
+            self.after_cancel(self.clock_job)
+        self.clock_job = self.after(
+            milliseconds_to_next_minute(), self.refresh_clock)
+
+    def refresh_clock(self):
+        self.clock_job = None
+        logger.debug("Refreshing clock")
+        self.show_overlay()
 
     # noinspection PyUnusedLocal
     def close(self, event=None):
+        if self.clock_job is not None:
+            self.after_cancel(self.clock_job)
+        if self.prepare_job is not None:
+            self.after_cancel(self.prepare_job)
+        if self.slide_job is not None:
+            self.after_cancel(self.slide_job)
+        if self.transition is not None:
+            if self.transition_job is not None:
+                self.after_cancel(self.transition_job)
+            self.transition.cancel()
+        if self.transition_executor is not None:
+            self.transition_executor.shutdown(wait=False)
+        if self.remote_executor is not None:
+            self.remote_executor.shutdown(wait=False)
+        if self.stats_writer is not None:
+            self.stats_writer.write()
+        self.display.close()
+        if self.watcher is not None:
+            self.watcher.close()
+        if self.cache_warmer is not None:
+            self.cache_warmer.stop()
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown()
+        self.weather_service.shutdown()
+        if self.frame_client is not None:
+            self.frame_client.close()
+        if self.image_index is not None:
+            self.image_index.close()
         self.destroy()
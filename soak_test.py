@@ -0,0 +1,198 @@
+import sys
+import time
+import random
+import logging
+from argparse import ArgumentParser
+
+from logging_config import setup_logger
+from frame_cache import FrameCache
+from frame_pipeline import FramePrefetcher, LayeredFrame
+from image_index import ImageIndex
+from process_stats import current_rss, peak_rss, format_bytes
+import globals
+
+parser = ArgumentParser(
+    description="Show thousands of slides as fast as possible and check "
+                "that the memory of the process stays flat."
+)
+parser.add_argument(
+    "image_directory",
+    type=str,
+    help="relative or absolute path to the image directory",
+    nargs="?",
+    default=globals.IMG_DIR
+)
+parser.add_argument(
+    "--slides",
+    type=int,
+    default=5000
+)
+parser.add_argument(
+    "--warmup",
+    type=int,
+    help="slides shown before the baseline RSS is taken, while the caches "
+         "fill up",
+    default=200
+)
+parser.add_argument(
+    "--sample_every",
+    type=int,
+    help="read the RSS every this many slides",
+    default=25
+)
+parser.add_argument(
+    "--max_growth",
+    type=float,
+    help="fail if the RSS grows more than this many MB after the warmup",
+    default=16
+)
+parser.add_argument(
+    "--width",
+    type=int,
+    default=globals.RENDER_SCREEN_SIZE[0]
+)
+parser.add_argument(
+    "--height",
+    type=int,
+    default=globals.RENDER_SCREEN_SIZE[1]
+)
+parser.add_argument(
+    "--frame_cache",
+    action="store_true",
+    help="read and store the frames in the frame cache"
+)
+parser.add_argument(
+    "--seed",
+    type=int,
+    default=None
+)
+parser.add_argument(
+    "-l",
+    "--LOG_LEVEL",
+    dest="LOG_LEVEL",
+    type=str,
+    default="WARNING"
+)
+
+logger = logging.getLogger("soak_test")
+
+
+def get_display(screen_size):
+    """
+    The tk display needs a Tk root (and so a display), returns None when
+    there is none.
+    """
+    try:
+        import tkinter as tk
+        from display import TkDisplay
+        root = tk.Tk()
+        root.withdraw()
+        display = TkDisplay(root)
+    except Exception as e:
+        print(f"Not converting to PhotoImages: {e!r}")
+        return None
+    if display.size != screen_size:
+        print(f"Not converting to PhotoImages, the screen is {display.size}")
+        return None
+    return display
+
+
+def slide_paths(image_paths, seed):
+    # reshuffled every pass, like the slideshow
+    shuffle = random.Random(seed)
+    while True:
+        shuffle.shuffle(image_paths)
+        yield from image_paths
+
+
+def median(values):
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2]
+
+
+def run(args):
+    screen_size = (args.width, args.height)
+    image_index = ImageIndex(args.image_directory)
+    image_paths = image_index.refresh()
+    if not image_paths:
+        raise SystemExit(f"No images found in {args.image_directory}")
+
+    frame_cache = FrameCache() if args.frame_cache else None
+    prefetcher = FramePrefetcher(screen_size, frame_cache=frame_cache,
+                                 image_index=image_index)
+    display = get_display(screen_size)
+
+    paths = slide_paths(image_paths, args.seed)
+    upcoming = [next(paths) for _ in range(prefetcher.depth + 1)]
+    prefetcher.fill(upcoming)
+
+    samples = []
+    current_frame = None
+    start = time.perf_counter()
+    for slide in range(1, args.slides + 1):
+        image_path = upcoming.pop(0)
+        upcoming.append(next(paths))
+        frame = prefetcher.get(image_path)
+        prefetcher.fill(upcoming)
+
+        previous_frame = current_frame
+        current_frame = LayeredFrame(image_path, frame)
+        # once for the slide and once more for a clock refresh
+        current_frame.draw_dynamic_layer("01d", "21\N{DEGREE SIGN}")
+        region, box = current_frame.render_dynamic_layer(
+            "01d", "21\N{DEGREE SIGN}")
+        if display is not None:
+            display.show_frame(image_path, current_frame.image)
+            display.show_overlay(region, box)
+            next_frame = prefetcher.get_if_ready(upcoming[0])
+            if next_frame is not None:
+                display.prepare(upcoming[0], next_frame)
+        region.close()
+        if previous_frame is not None:
+            previous_frame.close()
+
+        if slide % args.sample_every == 0:
+            rss = current_rss()
+            samples.append((slide, rss))
+            logger.info(f"slide {slide}: rss {format_bytes(rss)}")
+    seconds = time.perf_counter() - start
+
+    prefetcher.shutdown()
+    image_index.close()
+    return samples, seconds
+
+
+def main(args):
+    samples, seconds = run(args)
+    print(f"Showed {args.slides} slides in {seconds:.1f}s "
+          f"({args.slides / seconds:.1f} slides/s), "
+          f"peak rss: {format_bytes(peak_rss())}")
+
+    samples = [(slide, rss) for slide, rss in samples
+               if slide > args.warmup and rss is not None]
+    if len(samples) < 4:
+        print("Not enough RSS samples after the warmup to compare")
+        return 1
+
+    # the median of the first and last quarter, so a single spike (e.g. a
+    # huge panorama being decoded) does not fail the test
+    quarter = len(samples) // 4
+    baseline = median([rss for _, rss in samples[:quarter]])
+    final = median([rss for _, rss in samples[-quarter:]])
+    growth = final - baseline
+    print(f"RSS after the warmup: {format_bytes(baseline)}, at the end: "
+          f"{format_bytes(final)}, growth: {format_bytes(growth)}")
+
+    if growth > args.max_growth * 1024 * 1024:
+        print(f"FAILED: the RSS grew more than {args.max_growth:g}MB")
+        return 1
+    print("OK: the RSS stayed flat")
+    return 0
+
+
+if __name__ == '__main__':
+    parsed_args = parser.parse_args()
+    globals.LOG_LEVEL = parsed_args.LOG_LEVEL
+
+    setup_logger()
+    sys.exit(main(parsed_args))
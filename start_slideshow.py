@@ -2,7 +2,8 @@ import os
 import logging
 from logging_config import setup_logger
 
-from slideshow import Slideshow
+from instrumentation import StartupTimer
+from throttle import parse_quiet_hours
 import globals
 
 from argparse import ArgumentParser
@@ -31,6 +32,122 @@ parser.add_argument(
     type=str,
     default=globals.LOG_LEVEL
 )
+parser.add_argument(
+    "--PREFETCH_DEPTH",
+    dest="PREFETCH_DEPTH",
+    type=int,
+    help="number of upcoming slides to prepare in the background",
+    default=globals.PREFETCH_DEPTH
+)
+parser.add_argument(
+    "--NO_FRAME_CACHE",
+    dest="FRAME_CACHE_ENABLED",
+    help="always decode images from the originals",
+    action="store_false",
+    default=globals.FRAME_CACHE_ENABLED
+)
+parser.add_argument(
+    "--DISPLAY",
+    dest="DISPLAY_BACKEND",
+    help="show the slides in a tk window, write them to a file for feh "
+         "or copy them into the framebuffer",
+    choices=["tk", "file", "framebuffer"],
+    default=globals.DISPLAY_BACKEND
+)
+parser.add_argument(
+    "--TRANSITION_DURATION",
+    dest="TRANSITION_DURATION",
+    type=float,
+    help="seconds to crossfade between slides, 0 for a hard cut",
+    default=globals.TRANSITION_DURATION
+)
+parser.add_argument(
+    "--FIT_MODE",
+    dest="FIT_MODE",
+    help="stretch the photos to the screen, fit them in with black bars or "
+         "fill the screen, cropping around the subject",
+    choices=["stretch", "fit", "fill"],
+    default=globals.FIT_MODE
+)
+parser.add_argument(
+    "--TEXT_STYLE",
+    dest="TEXT_STYLE",
+    help="outline all text, or only where the photo behind it is busy",
+    choices=["stroke", "adaptive"],
+    default=globals.TEXT_STYLE
+)
+parser.add_argument(
+    "--NO_WATCH",
+    dest="WATCH_FILES",
+    help="only look for new or removed photos after every pass",
+    action="store_false",
+    default=globals.WATCH_FILES
+)
+parser.add_argument(
+    "--SCHEDULER",
+    dest="SCHEDULER",
+    help="how the next slide is chosen",
+    choices=["shuffle", "weighted"],
+    default=globals.SCHEDULER
+)
+parser.add_argument(
+    "--DUPLICATES",
+    dest="DUPLICATES",
+    help="keep near duplicate photos (e.g. burst shots) apart, only show "
+         "one of them per pass or show them all",
+    choices=["space", "collapse", "show"],
+    default=globals.DUPLICATES
+)
+parser.add_argument(
+    "--SERVER",
+    dest="FRAME_SERVER_URL",
+    help="show the frames of a frame_server.py, e.g. http://photos:8765",
+    default=globals.FRAME_SERVER_URL
+)
+parser.add_argument(
+    "--CLIENT_NAME",
+    dest="FRAME_CLIENT_NAME",
+    help="name of this frame on the frame server, each has its own order",
+    default=globals.FRAME_CLIENT_NAME
+)
+parser.add_argument(
+    "--FAST_START",
+    dest="FAST_START",
+    help="show the last frame straight away and load the library in the "
+         "background",
+    action="store_true",
+    default=globals.FAST_START
+)
+parser.add_argument(
+    "--QUIET_HOURS",
+    dest="QUIET_HOURS",
+    type=parse_quiet_hours,
+    help="e.g. 23:00-07:00, slow the slides down (see --QUIET_DELAY) and "
+         "render the next ones into the frame cache at a low priority",
+    default=globals.QUIET_HOURS
+)
+parser.add_argument(
+    "--QUIET_DELAY",
+    dest="QUIET_SLIDESHOW_DELAY",
+    type=int,
+    help="slideshow delay in seconds during the quiet hours, 0 to pause "
+         "the slides until they are over",
+    default=globals.QUIET_SLIDESHOW_DELAY
+)
+parser.add_argument(
+    "--NO_LIVE_CLOCK",
+    dest="LIVE_CLOCK",
+    help="only update the clock when the slide changes",
+    action="store_false",
+    default=globals.LIVE_CLOCK
+)
+parser.add_argument(
+    "--STATS",
+    dest="STATS_ENABLED",
+    help="write timing, memory and cache stats to temp/stats",
+    action="store_true",
+    default=globals.STATS_ENABLED
+)
 parser.add_argument(
     "--INSANE_LOGGING",
     dest="INSANE_LOGGER",
@@ -40,6 +157,9 @@ parser.add_argument(
 
 
 def main():
+    startup = StartupTimer()
+    startup.mark("launch")
+
     if globals.ON_LINUX:
         if os.environ.get("DISPLAY", None) is None:
             os.environ["DISPLAY"] = ":0"
@@ -48,8 +168,13 @@ def main():
             logger.debug("DISPLAY already set")
 
     try:
+        # imported here, so how long Tk, PIL and the rest take to import
+        # is part of the startup times
+        from slideshow import Slideshow
+        startup.mark("imports")
+
         logger.info("Initializing Slideshow")
-        slideshow = Slideshow()
+        slideshow = Slideshow(startup)
         slideshow.start_slideshow()
         slideshow.mainloop()
     except BaseException as e:
@@ -62,6 +187,22 @@ if __name__ == '__main__':
     globals.IMG_DIR = args.image_directory
     globals.LOG_LEVEL = args.LOG_LEVEL
     globals.INSANE_LOGGER = args.INSANE_LOGGER
+    globals.PREFETCH_DEPTH = args.PREFETCH_DEPTH
+    globals.FRAME_CACHE_ENABLED = args.FRAME_CACHE_ENABLED
+    globals.LIVE_CLOCK = args.LIVE_CLOCK
+    globals.SCHEDULER = args.SCHEDULER
+    globals.DUPLICATES = args.DUPLICATES
+    globals.WATCH_FILES = args.WATCH_FILES
+    globals.FRAME_SERVER_URL = args.FRAME_SERVER_URL
+    globals.FRAME_CLIENT_NAME = args.FRAME_CLIENT_NAME
+    globals.DISPLAY_BACKEND = args.DISPLAY_BACKEND
+    globals.TRANSITION_DURATION = args.TRANSITION_DURATION
+    globals.FIT_MODE = args.FIT_MODE
+    globals.TEXT_STYLE = args.TEXT_STYLE
+    globals.STATS_ENABLED = args.STATS_ENABLED
+    globals.FAST_START = args.FAST_START
+    globals.QUIET_HOURS = args.QUIET_HOURS
+    globals.QUIET_SLIDESHOW_DELAY = args.QUIET_SLIDESHOW_DELAY
 
     setup_logger()
     logger = logging.getLogger("start_slideshow")
@@ -0,0 +1,144 @@
+import logging
+
+from PIL import Image, ImageFilter
+
+from instrumentation import stats, timed
+from globals import SALIENCY_SAMPLE_WIDTH, SALIENCY_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+# faces are looked for on a copy of about this width
+FACE_SAMPLE_WIDTH = 640
+# OpenCV is optional (only used to find faces) and slow to import, so it is
+# only imported the first time a subject is looked for, see load_cv2()
+cv2 = None
+cv2_loaded = False
+# loaded the first time it is needed, see find_faces()
+face_cascade = None
+
+
+def load_cv2():
+    """
+    Returns whether OpenCV is installed.
+    """
+    global cv2, cv2_loaded
+    if not cv2_loaded:
+        try:
+            import cv2
+        except ImportError:
+            cv2 = None
+        cv2_loaded = True
+    return cv2 is not None
+
+
+def get_face_cascade():
+    global face_cascade
+    if face_cascade is None:
+        face_cascade = cv2.CascadeClassifier(
+            cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+    return face_cascade
+
+
+def to_fractions(box, size):
+    left, top, right, bottom = box
+    width, height = size
+    return (left / width, top / height, right / width, bottom / height)
+
+
+def find_faces(gray):
+    """
+    The box around all faces in the greyscale image, as fractions of its
+    size, or None if there are none.
+    """
+    import numpy
+
+    faces = get_face_cascade().detectMultiScale(
+        numpy.asarray(gray), scaleFactor=1.1, minNeighbors=5)
+    if len(faces) == 0:
+        return None
+    left = min(x for x, _, _, _ in faces)
+    top = min(y for _, y, _, _ in faces)
+    right = max(x + w for x, _, w, _ in faces)
+    bottom = max(y + h for _, y, _, h in faces)
+    return to_fractions((left, top, right, bottom), gray.size)
+
+
+def find_salient_box(gray):
+    """
+    The box around the busiest part of the greyscale image (the most
+    edge energy, which the sharp, detailed subject of a photo usually has
+    and a blurred or plain background does not), as fractions of its
+    size, or None if the image is plain.
+    """
+    if gray.width < 3 or gray.height < 3:
+        return None
+    edges = gray.filter(ImageFilter.FIND_EDGES)
+    # the outermost pixels have no neighbours to compare with
+    inner = edges.crop((1, 1, edges.width - 1, edges.height - 1))
+    edges.close()
+    energy = inner.filter(ImageFilter.BoxBlur(2))
+    inner.close()
+
+    _, peak = energy.getextrema()
+    if peak == 0:
+        energy.close()
+        return None
+    threshold = int(peak * SALIENCY_THRESHOLD)
+    mask = energy.point(lambda value: 255 if value >= threshold else 0)
+    box = mask.getbbox()
+    size = mask.size
+    mask.close()
+    energy.close()
+    if box is None:
+        return None
+    return to_fractions(box, size)
+
+
+@timed("find_subject")
+def find_subject(image_path):
+    """
+    The box (left, top, right, bottom) around the subject of an image, as
+    fractions of its width and height, or None if it has no obvious one.
+    Faces are used if OpenCV is installed and finds any, otherwise the
+    busiest part of the image.
+
+    This decodes the image, so it is meant for the background indexing
+    pass (see ImageIndex.extract_missing_subjects()), never for slide
+    time.
+    """
+    use_faces = load_cv2()
+    width = FACE_SAMPLE_WIDTH if use_faces else SALIENCY_SAMPLE_WIDTH
+    with Image.open(image_path) as original_image:
+        # JPEGs are only decoded at 1/8 of their size where possible
+        original_image.draft(
+            "L", (width, width * original_image.height //
+                  original_image.width))
+        gray = original_image.convert("L")
+
+    if gray.width > width:
+        resized = gray.resize(
+            (width, max(1, width * gray.height // gray.width)),
+            Image.BILINEAR)
+        gray.close()
+        gray = resized
+
+    try:
+        if use_faces:
+            box = find_faces(gray)
+            if box is not None:
+                stats.increment("subject.faces")
+                return box
+
+        if gray.width > SALIENCY_SAMPLE_WIDTH:
+            small = gray.resize(
+                (SALIENCY_SAMPLE_WIDTH,
+                 max(1, SALIENCY_SAMPLE_WIDTH * gray.height // gray.width)),
+                Image.BILINEAR)
+            box = find_salient_box(small)
+            small.close()
+        else:
+            box = find_salient_box(gray)
+        stats.increment("subject.saliency")
+        return box
+    finally:
+        gray.close()
@@ -0,0 +1,105 @@
+from array import array
+
+from duplicates import DuplicateClusters, DuplicateSpacing
+from perceptual_hash import find_clusters
+
+
+class ListSlides:
+    """
+    The same paths in the same order every pass, like a scheduler.
+    """
+
+    def __init__(self, image_paths):
+        self.image_paths = image_paths
+        self.index = 0
+
+    def at_end_of_pass(self):
+        return self.index == len(self.image_paths)
+
+    def add_new_images(self):
+        pass
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.image_paths:
+            raise StopIteration
+        if self.at_end_of_pass():
+            self.index = 0
+        self.index += 1
+        return self.image_paths[self.index - 1]
+
+
+class FakeIndex:
+    def __init__(self):
+        self.hashes = {}
+        self.ids = {}
+        self.hashed_ids = array("q")
+
+    def store_hash(self, image_path, dhash):
+        image_id = self.ids.setdefault(image_path, len(self.ids))
+        self.hashes[image_path] = dhash
+        self.hashed_ids.append(image_id)
+
+    def iter_hashes(self, ids=None):
+        ids = set(self.ids.values() if ids is None else ids)
+        for image_path, image_id in self.ids.items():
+            if image_id in ids:
+                yield image_path, self.hashes[image_path]
+
+
+def spaced(image_paths, clusters, mode, count, spacing=3, lookahead=4):
+    slides = DuplicateSpacing(ListSlides(image_paths), clusters, mode,
+                              spacing=spacing, lookahead=lookahead)
+    return [next(slides) for _ in range(count)]
+
+
+def test_space_keeps_duplicates_apart():
+    image_paths = ["a1", "a2", "b", "c", "d", "e", "f", "g"]
+    clusters = {"a1": "a1", "a2": "a1"}
+    shown = spaced(image_paths, clusters, "space", len(image_paths))
+    assert sorted(shown) == sorted(image_paths)
+    assert shown.index("a2") - shown.index("a1") > 3
+
+
+def test_space_shows_duplicates_when_nothing_else_is_left():
+    shown = spaced(["a1", "a2"], {"a1": "a1", "a2": "a1"}, "space", 4)
+    assert shown == ["a1", "a2", "a1", "a2"]
+
+
+def test_space_peek_matches_next():
+    image_paths = ["a1", "a2", "a3", "b", "c", "d", "e"]
+    clusters = {"a1": "a1", "a2": "a1", "a3": "a1"}
+    slides = DuplicateSpacing(ListSlides(image_paths), clusters, "space",
+                              spacing=2, lookahead=3)
+    upcoming = slides.peek(5)
+    assert [next(slides) for _ in range(5)] == upcoming
+
+
+def test_collapse_shows_one_per_pass():
+    image_paths = ["a1", "b", "a2", "c", "a3"]
+    clusters = {"a1": "a1", "a2": "a1", "a3": "a1"}
+    shown = spaced(image_paths, clusters, "collapse", 6)
+    # the second pass starts over with the first of each cluster
+    assert shown == ["a1", "b", "c", "a1", "b", "c"]
+
+
+def test_clusters_load_only_adds_new_hashes():
+    image_index = FakeIndex()
+    image_index.store_hash("a", 0b0000)
+    image_index.store_hash("b", 0b1111 << 20)
+    clusters = DuplicateClusters(image_index, max_distance=2)
+    clusters.load()
+    assert clusters.get("a") is None
+
+    image_index.store_hash("c", 0b0011)
+    image_index.store_hash("d", 0b1110 << 20)
+    image_index.iter_hashes = lambda ids=None: FakeIndex.iter_hashes(
+        image_index, [] if ids is None else ids)
+    clusters.load()
+    assert clusters.get("a") == clusters.get("c") is not None
+    assert clusters.get("b") == clusters.get("d") is not None
+    assert clusters.get("a") != clusters.get("b")
+    assert {path: clusters.get(path) for path in "abcd"} == find_clusters(
+        image_index.hashes.items(), 2)
@@ -0,0 +1,70 @@
+import random
+
+from perceptual_hash import BKTree, find_clusters, hamming_distance
+
+
+def brute_force_clusters(hashes, max_distance):
+    """
+    The connected components of "within max_distance", comparing every
+    pair, as a set of frozensets of keys (only groups of two or more).
+    """
+    keys = [key for key, _ in hashes]
+    values = dict(hashes)
+    groups = {key: {key} for key in keys}
+    for index, key in enumerate(keys):
+        for other in keys[index + 1:]:
+            if (hamming_distance(values[key], values[other]) <= max_distance
+                    and groups[key] is not groups[other]):
+                merged = groups[key] | groups[other]
+                for member in merged:
+                    groups[member] = merged
+    return {frozenset(group) for group in groups.values() if len(group) > 1}
+
+
+def as_groups(clusters):
+    groups = {}
+    for key, cluster in clusters.items():
+        groups.setdefault(cluster, set()).add(key)
+    return {frozenset(group) for group in groups.values()}
+
+
+def random_hashes(rand, count):
+    # a few base hashes with nearby variations, so there are clusters
+    bases = [rand.getrandbits(64) for _ in range(rand.randint(1, 4))]
+    hashes = []
+    for number in range(count):
+        value = rand.choice(bases)
+        for _ in range(rand.randint(0, 10)):
+            value ^= 1 << rand.randrange(64)
+        hashes.append((f"k{number}", value))
+    return hashes
+
+
+def test_find_clusters_matches_brute_force():
+    rand = random.Random(1)
+    for _ in range(3000):
+        hashes = random_hashes(rand, rand.randint(0, 12))
+        max_distance = rand.randint(0, 8)
+        clusters = find_clusters(hashes, max_distance)
+        assert as_groups(clusters) == brute_force_clusters(
+            hashes, max_distance)
+        # every key is mapped to a key of its own cluster
+        for key, cluster in clusters.items():
+            assert clusters[cluster] == cluster
+
+
+def test_find_clusters_identical_hashes():
+    clusters = find_clusters([("a", 5), ("b", 5), ("c", 1 << 40)], 0)
+    assert as_groups(clusters) == {frozenset({"a", "b"})}
+
+
+def test_bk_tree_search():
+    rand = random.Random(2)
+    values = {f"k{number}": rand.getrandbits(64) for number in range(200)}
+    tree = BKTree()
+    for key, value in values.items():
+        tree.add(value, key)
+    target = rand.getrandbits(64)
+    expected = {key for key, value in values.items()
+                if hamming_distance(target, value) <= 28}
+    assert set(tree.search(target, 28)) == expected
@@ -0,0 +1,223 @@
+import os
+import sys
+import glob
+import shutil
+import signal
+import logging
+import subprocess
+from datetime import datetime, timedelta
+
+from instrumentation import stats
+from globals import (
+    PROJECT_DIR,
+    QUIET_HOURS,
+    QUIET_SLIDESHOW_DELAY,
+    WARM_CACHE_LIST_PATH,
+    THERMAL_ZONE_PATTERN,
+    THERMAL_SOFT_LIMIT,
+    THERMAL_HARD_LIMIT,
+    THERMAL_MAX_SLOWDOWN,
+    IDLE_NICE,
+)
+import globals
+
+logger = logging.getLogger(__name__)
+
+RENDER_FRAMES_SCRIPT = os.path.join(PROJECT_DIR, "render_frames.py")
+# seconds to wait for the cache warming process to stop
+STOP_TIMEOUT = 5
+
+
+def parse_quiet_hours(text):
+    """
+    "23:00-07:00" -> ((23, 0), (7, 0)), raises ValueError if it is not
+    two times of day.
+    """
+    times = []
+    for time_of_day in text.split("-"):
+        hour, minute = time_of_day.strip().split(":")
+        hour, minute = int(hour), int(minute)
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            raise ValueError(f"Not a time of day: {time_of_day}")
+        times.append((hour, minute))
+    if len(times) != 2:
+        raise ValueError(f"Not a start and end time: {text}")
+    return tuple(times)
+
+
+def is_quiet(quiet_hours, now):
+    if quiet_hours is None:
+        return False
+    (start_hour, start_minute), (end_hour, end_minute) = quiet_hours
+    start = start_hour * 60 + start_minute
+    end = end_hour * 60 + end_minute
+    minute = now.hour * 60 + now.minute
+    if start <= end:
+        return start <= minute < end
+    # over midnight
+    return minute >= start or minute < end
+
+
+def seconds_until(hour, minute, now):
+    then = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if then <= now:
+        then += timedelta(days=1)
+    return (then - now).total_seconds()
+
+
+def read_cpu_temperature(pattern=THERMAL_ZONE_PATTERN):
+    """
+    The temperature of the hottest thermal zone in degrees C, or None if
+    there are none (e.g. not on linux).
+    """
+    temperatures = []
+    for path in glob.glob(pattern):
+        try:
+            with open(path) as zone:
+                # in millidegrees
+                temperatures.append(int(zone.read().strip()) / 1000)
+        except (OSError, ValueError):
+            continue
+    return max(temperatures) if temperatures else None
+
+
+def get_thermal_slowdown(temperature, soft_limit, hard_limit, max_slowdown):
+    """
+    1 up to "soft_limit", rising in a straight line to "max_slowdown" at
+    "hard_limit".
+    """
+    if temperature is None or temperature <= soft_limit:
+        return 1.0
+    if temperature >= hard_limit:
+        return float(max_slowdown)
+    return 1 + ((max_slowdown - 1) * (temperature - soft_limit) /
+                (hard_limit - soft_limit))
+
+
+def lower_priority(nice=IDLE_NICE):
+    """
+    Run this process (and the processes it starts) at the lowest CPU
+    priority and, where ionice is installed, in the idle I/O class, so it
+    only gets the CPU and SD card when nothing else wants them.
+    """
+    os.nice(max(0, nice - os.nice(0)))
+    ionice = shutil.which("ionice")
+    if ionice is None:
+        logger.info("ionice is not installed, only lowering the CPU "
+                    "priority")
+        return
+    result = subprocess.run(
+        [ionice, "-c", "3", "-p", str(os.getpid())],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        logger.warning(f"Could not lower the I/O priority: "
+                       f"{result.stderr.decode(errors='replace').strip()}")
+
+
+class RenderThrottle:
+    """
+    How long each slide stays on screen.  During the "quiet_hours" (e.g.
+    overnight) a slide stays up for "quiet_delay" seconds, or with a
+    "quiet_delay" of 0 until the quiet hours are over.  When the CPU is
+    hotter than "soft_limit" slides stay up longer, up to "max_slowdown"
+    times as long at "hard_limit", so fewer of them have to be rendered.
+    """
+
+    def __init__(self, quiet_hours=QUIET_HOURS,
+                 quiet_delay=QUIET_SLIDESHOW_DELAY,
+                 soft_limit=THERMAL_SOFT_LIMIT, hard_limit=THERMAL_HARD_LIMIT,
+                 max_slowdown=THERMAL_MAX_SLOWDOWN):
+        self.quiet_hours = quiet_hours
+        self.quiet_delay = quiet_delay
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.max_slowdown = max_slowdown
+        self.slowdown = 1.0
+
+    @property
+    def hot(self):
+        return self.slowdown > 1
+
+    def is_quiet(self, now=None):
+        return is_quiet(self.quiet_hours, now or datetime.now())
+
+    def check_temperature(self):
+        temperature = read_cpu_temperature()
+        if temperature is None:
+            return
+        stats.record_value("cpu_temperature_c", temperature)
+        slowdown = get_thermal_slowdown(
+            temperature, self.soft_limit, self.hard_limit, self.max_slowdown)
+        if (slowdown > 1) != self.hot:
+            logger.warning(
+                f"CPU at {temperature:.1f}C, "
+                f"{'slowing down' if slowdown > 1 else 'back to normal'}")
+        self.slowdown = slowdown
+
+    def slide_delay(self, delay, now=None):
+        """
+        Seconds until the next slide, "delay" being the usual delay.
+        """
+        now = now or datetime.now()
+        if self.is_quiet(now):
+            stats.increment("throttle.quiet")
+            if self.quiet_delay == 0:
+                end_hour, end_minute = self.quiet_hours[1]
+                return seconds_until(end_hour, end_minute, now)
+            delay = max(delay, self.quiet_delay)
+        if self.hot:
+            stats.increment("throttle.hot")
+        return delay * self.slowdown
+
+
+class CacheWarmer:
+    """
+    Renders slides into the frame cache with render_frames.py, in a
+    separate process at the lowest CPU and I/O priority, e.g. the next
+    slides during the quiet hours.
+    """
+
+    def __init__(self, screen_size, list_path=WARM_CACHE_LIST_PATH):
+        self.screen_size = screen_size
+        self.list_path = list_path
+        self.process = None
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self, image_paths):
+        self.stop()
+        list_dir = os.path.dirname(self.list_path)
+        if list_dir and not os.path.exists(list_dir):
+            os.makedirs(list_dir)
+        with open(self.list_path, "w") as list_file:
+            list_file.writelines(f"{image_path}\n"
+                                 for image_path in image_paths)
+
+        logger.info(f"Warming the frame cache for {len(image_paths)} slides")
+        width, height = self.screen_size
+        self.process = subprocess.Popen(
+            [sys.executable, RENDER_FRAMES_SCRIPT, globals.IMG_DIR,
+             "--warm_cache", "--idle", "--processes", "1",
+             "--paths", self.list_path,
+             "--width", str(width), "--height", str(height),
+             "--FIT_MODE", globals.FIT_MODE,
+             "--TEXT_STYLE", globals.TEXT_STYLE],
+            stdout=subprocess.DEVNULL,
+            # in a process group of its own, to stop its workers with it
+            start_new_session=True)
+
+    def stop(self):
+        if not self.running():
+            self.process = None
+            return
+        logger.info("Stopping the frame cache warming")
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            self.process.wait(STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+        except ProcessLookupError:
+            pass
+        self.process = None
@@ -0,0 +1,134 @@
+import time
+import queue
+import logging
+import threading
+
+from PIL import Image
+
+from instrumentation import stats
+import globals
+from globals import (
+    TRANSITION_FPS,
+    TRANSITION_DOWNSCALE,
+    TRANSITION_QUEUE_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+# how long the worker waits for room in the queue before checking if the
+# crossfade was cancelled, in seconds
+QUEUE_PUT_TIMEOUT = 0.1
+
+
+class Crossfade:
+    """
+    The frames of a crossfade from one frame to the next.  They are
+    blended on a worker thread at 1/"downscale" of the screen size (so a
+    4K fade only blends 1080p frames) and handed to the UI through a
+    bounded queue.
+
+    Every tick the UI shows the newest frame that is due by the clock
+    (see next_frame()), frames that were rendered too late are dropped
+    and the worker skips the steps the UI has already passed.  On a slow
+    CPU the fade has fewer steps, but it never takes longer than
+    "duration" (globals.TRANSITION_DURATION by default).
+    """
+
+    def __init__(self, old_image, new_image, executor, duration=None,
+                 fps=TRANSITION_FPS, downscale=TRANSITION_DOWNSCALE,
+                 queue_size=TRANSITION_QUEUE_SIZE):
+        if duration is None:
+            duration = globals.TRANSITION_DURATION
+        self.duration = duration
+        self.fps = fps
+        self.downscale = downscale
+        self.steps = max(1, round(duration * fps))
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._next = None
+        self._wanted_step = 0
+        self._cancelled = threading.Event()
+        self.started = time.monotonic()
+        self.future = executor.submit(self._render, old_image, new_image)
+
+    def _render(self, old_image, new_image):
+        size = (old_image.width // self.downscale,
+                old_image.height // self.downscale)
+        old_small = old_image.resize(size, Image.BILINEAR)
+        new_small = new_image.resize(size, Image.BILINEAR)
+
+        for step in range(1, self.steps):
+            if self._cancelled.is_set():
+                break
+            if step < self._wanted_step:
+                # fallen behind, the UI has already moved past this one
+                stats.increment("transition.skipped")
+                continue
+
+            with stats.timer("transition.blend"):
+                blended = Image.blend(old_small, new_small, step / self.steps)
+            while not self._cancelled.is_set():
+                try:
+                    self._queue.put((step, blended),
+                                    timeout=QUEUE_PUT_TIMEOUT)
+                    break
+                except queue.Full:
+                    pass
+
+        old_small.close()
+        new_small.close()
+
+    def due_step(self):
+        elapsed = time.monotonic() - self.started
+        return int(elapsed / self.duration * self.steps)
+
+    def done(self):
+        return time.monotonic() - self.started >= self.duration
+
+    def tick_delay(self):
+        """
+        Milliseconds until the next step is due.
+        """
+        step_seconds = self.duration / self.steps
+        elapsed = time.monotonic() - self.started
+        return max(1, int((step_seconds - elapsed % step_seconds) * 1000))
+
+    def next_frame(self):
+        """
+        The newest blended frame that is due, or None if there is no new
+        one yet.  The caller closes it.
+        """
+        due = self.due_step()
+        self._wanted_step = due
+
+        frame = None
+        while True:
+            if self._next is None:
+                try:
+                    self._next = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            step, image = self._next
+            if step > due:
+                break
+            if frame is not None:
+                stats.increment("transition.dropped")
+                frame.close()
+            frame = image
+            self._next = None
+
+        if frame is not None:
+            stats.increment("transition.shown")
+        return frame
+
+    def cancel(self):
+        self._cancelled.set()
+        if self._next is not None:
+            self._next[1].close()
+            self._next = None
+        while True:
+            try:
+                _, image = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            image.close()
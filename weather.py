@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from globals import (
+    API_URL,
+    GET_WEATHER_DELAY,
+    WEATHER_TIMEOUT,
+    WEATHER_RETRIES,
+    WEATHER_RETRY_DELAY,
+    WEATHER_CACHE_PATH,
+    WEATHER_CACHE_MAX_AGE,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def create_session(retries=WEATHER_RETRIES):
+    """
+    A session keeps its connection to the weather API open between
+    requests.  Failed requests are retried with an exponential backoff.
+
+    requests is only imported here (it is slow to import on the pi), so
+    it does not hold up showing the first slide.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=retries,
+        backoff_factor=1,
+        status_forcelist=(429, 500, 502, 503, 504),
+    )
+    adapter = HTTPAdapter(max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def parse_weather(json_res):
+    weather = json_res["hourly"][1]["weather"][0]
+    temp = json_res["hourly"][0]["temp"] - 273
+    temp = "{:2.0f}".format(temp)
+    temp = temp + u"\N{DEGREE SIGN}"
+    return weather, temp
+
+
+def get_weather_from_online(session, api_url=API_URL,
+                            timeout=WEATHER_TIMEOUT):
+    import requests
+
+    try:
+        response = session.get(api_url, timeout=timeout)
+
+        if response.status_code == 200:
+            weather, temp = parse_weather(json.loads(response.content))
+        else:
+            logger.warning(f"Weather API response did not return 200 "
+                           f"instead: {response.status_code}")
+            weather, temp = None, None
+    except requests.exceptions.RequestException as error:
+        logger.error(error)
+        weather, temp = None, None
+    except (ValueError, KeyError, IndexError, TypeError) as error:
+        logger.error(f"Unexpected weather API response: {error!r}")
+        weather, temp = None, None
+
+    return weather, temp
+
+
+class WeatherService:
+    """
+    Fetches the weather on a background thread, so a slow or unreachable
+    weather API never blocks the slideshow.
+
+    The last good forecast is saved to "cache_path", so it can be shown
+    straight away after a restart or while the API is unreachable, until
+    it is older than "max_age" seconds.
+    """
+
+    def __init__(self, api_url=API_URL, cache_path=WEATHER_CACHE_PATH,
+                 max_age=WEATHER_CACHE_MAX_AGE, timeout=WEATHER_TIMEOUT):
+        self.api_url = api_url
+        self.cache_path = cache_path
+        self.max_age = max_age
+        self.timeout = timeout
+
+        self._session = None
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="weather")
+        self._lock = threading.Lock()
+        self.failures = 0
+
+        # (weather, temp, fetched_at) of the last good response
+        self.last_good = self.load_cached()
+
+    def load_cached(self):
+        try:
+            with open(self.cache_path) as cache_file:
+                cached = json.load(cache_file)
+            last_good = (cached["weather"], cached["temp"],
+                         cached["fetched_at"])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as error:
+            logger.warning(f"Could not read cached weather: {error!r}")
+            return None
+
+        logger.info(f"Loaded cached weather from "
+                    f"{time.ctime(last_good[2])}")
+        return last_good
+
+    def save_cached(self):
+        weather, temp, fetched_at = self.last_good
+        cache_dir = os.path.dirname(self.cache_path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        tmp_path = f"{self.cache_path}.tmp"
+        try:
+            with open(tmp_path, "w") as cache_file:
+                json.dump({"weather": weather, "temp": temp,
+                           "fetched_at": fetched_at}, cache_file)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as error:
+            logger.warning(f"Could not save cached weather: {error}")
+
+    def current(self):
+        """
+        The last good (weather, temp), or (None, None) if there is none
+        or it has expired.
+        """
+        with self._lock:
+            last_good = self.last_good
+        if last_good is None:
+            return None, None
+
+        weather, temp, fetched_at = last_good
+        if time.time() - fetched_at > self.max_age:
+            return None, None
+        return weather, temp
+
+    def fetch(self):
+        """
+        Fetch the weather, returns True if it was successful.  This blocks
+        for up to the timeout (for every retry), see fetch_async().
+        """
+        if self._session is None:
+            self._session = create_session()
+
+        weather, temp = get_weather_from_online(
+            self._session, self.api_url, self.timeout)
+        if weather is None:
+            self.failures += 1
+            return False
+
+        self.failures = 0
+        with self._lock:
+            self.last_good = (weather, temp, time.time())
+        self.save_cached()
+        return True
+
+    def fetch_async(self):
+        return self._executor.submit(self.fetch)
+
+    def next_delay(self):
+        """
+        Seconds until the weather should be fetched again.  After a
+        failure this starts at WEATHER_RETRY_DELAY and doubles with every
+        failure in a row, up to GET_WEATHER_DELAY.
+        """
+        if self.failures == 0:
+            return GET_WEATHER_DELAY
+        return min(WEATHER_RETRY_DELAY * 2 ** (self.failures - 1),
+                   GET_WEATHER_DELAY)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+        if self._session is not None:
+            self._session.close()
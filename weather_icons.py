@@ -0,0 +1,59 @@
+import os
+import logging
+import threading
+
+from PIL import Image
+
+from globals import PROJECT_DIR, WEATHER_ICONS
+
+logger = logging.getLogger(__name__)
+
+ICON_DIR = os.path.join(PROJECT_DIR, "icons")
+ICON_SIZES = (32, 64, 128, 256, 512)
+
+# (icon name, height) -> RGBA image
+_icons = {}
+_icons_lock = threading.Lock()
+
+
+def get_icon_path(icon_name, height):
+    """
+    Path of the smallest version of the icon that is at least "height"
+    pixels high, so it only ever has to be scaled down.
+    """
+    for icon_size in ICON_SIZES:
+        if icon_size >= height:
+            break
+    return os.path.join(ICON_DIR, f"{icon_size}px", f"{icon_name}.png")
+
+
+def get_weather_icon(icon_code, height):
+    """
+    Return the icon for an OpenWeather icon code (e.g. "01d") as an RGBA
+    image exactly "height" pixels high, or None for an unknown code.
+    Icons are only read from disk and scaled the first time each
+    (icon, height) is asked for.
+    """
+    icon_name = WEATHER_ICONS.get(icon_code, None)
+    if icon_name is None:
+        logger.warning(f"No icon for weather: {icon_code}")
+        return None
+
+    key = (icon_name, height)
+    with _icons_lock:
+        icon = _icons.get(key)
+    if icon is not None:
+        return icon
+
+    icon_path = get_icon_path(icon_name, height)
+    logger.debug(f"loading weather icon: {icon_path}")
+    with Image.open(icon_path) as icon_file:
+        icon = icon_file.convert("RGBA")
+
+    if icon.height != height:
+        width = max(1, round(icon.width * height / icon.height))
+        icon = icon.resize((width, height), Image.ANTIALIAS)
+
+    with _icons_lock:
+        _icons[key] = icon
+    return icon